@@ -0,0 +1,135 @@
+"""
+Micro-benchmarks for the DDPG replay buffer. Usage:
+
+    python bench_replay.py
+    python bench_replay.py --replay_size 1000000 --batch_size 64
+    python bench_replay.py --which storage --ob_dim 376 --ac_dim 17
+
+`sample` times `ReplayBuffer.sample` at several fill levels against the
+previous implementation, which drew indices with
+`np.random.choice(max_index, num, replace=False)`.
+
+`storage` reports memory and speed of the compact storage options (the
+dimensions above are Humanoid's), and checks that quantized states come back
+within half a quantization step.
+
+The buffers are filled with random transitions directly, except for timing
+`add_sample`.
+"""
+
+import argparse
+import time
+import numpy as np
+from replay_buffer import ReplayBuffer
+
+
+def choice_sample(rbuffer, num):
+    """ The previous `ReplayBuffer.sample`, which permutes every index. """
+    max_index = min(rbuffer.num_in_buffer-1, rbuffer.size)
+    indices = np.random.choice(max_index, num, replace=False)
+    indices_next = (indices+1) * ((indices+1) < rbuffer.size).astype(int)
+    return (rbuffer.states_NO[indices], rbuffer.actions_NA[indices],
+            rbuffer.rewards_N[indices], rbuffer.states_NO[indices_next],
+            rbuffer.done_N[indices])
+
+
+def timeit(fn, num_iters):
+    t_start = time.time()
+    for _ in range(num_iters):
+        fn()
+    return (time.time() - t_start) / num_iters
+
+
+def bench_sample(args):
+    rbuffer = ReplayBuffer(args.replay_size, args.ob_dim, args.ac_dim)
+    rbuffer.states_NO[:] = np.random.randn(args.replay_size, args.ob_dim)
+    rbuffer.actions_NA[:] = np.random.randn(args.replay_size, args.ac_dim)
+    rbuffer.rewards_N[:] = np.random.randn(args.replay_size)
+
+    print("usec per minibatch of {} from a buffer of {} transitions:".format(
+            args.batch_size, args.replay_size))
+    fill = 10 * args.batch_size
+    while True:
+        fill = min(fill, args.replay_size)
+        rbuffer.num_in_buffer = fill
+        sec_old = timeit(lambda: choice_sample(rbuffer, args.batch_size), args.iters)
+        sec_new = timeit(lambda: rbuffer.sample(args.batch_size), args.iters)
+        sec_rep = timeit(lambda: rbuffer.sample(args.batch_size, replace=True), args.iters)
+        print("{:8d} stored:  np.random.choice {:8.1f},  without replacement {:6.1f}  "
+              "({:6.1f}x),  with replacement {:6.1f}".format(
+                fill, sec_old * 1e6, sec_new * 1e6, sec_old / sec_new, sec_rep * 1e6))
+        if fill == args.replay_size:
+            break
+        fill *= 10
+
+
+def bench_storage(args):
+    ob_high = 10.0 ** np.random.uniform(-1, 1, size=args.ob_dim).astype(np.float32)
+    ob_low = -ob_high
+    configs = [('float32',                  dict()),
+               ('float16',                  dict(state_dtype='float16', action_dtype='float16')),
+               ('float16, packed done',     dict(state_dtype='float16', action_dtype='float16',
+                                                 pack_done=True)),
+               ('uint16, packed done',      dict(state_dtype='uint16', action_dtype='float16',
+                                                 pack_done=True)),
+               ('uint8, packed done',       dict(state_dtype='uint8', action_dtype='float16',
+                                                 pack_done=True))]
+    print("{} transitions, ob_dim {}, ac_dim {}, batch size {}:".format(
+            args.replay_size, args.ob_dim, args.ac_dim, args.batch_size))
+    float32_nbytes = None
+    for name, kwargs in configs:
+        rbuffer = ReplayBuffer(args.replay_size, args.ob_dim, args.ac_dim,
+                               ob_low=ob_low, ob_high=ob_high, **kwargs)
+        float32_nbytes = float32_nbytes or rbuffer.nbytes
+        chunk = 10000
+        for start in range(0, args.replay_size, chunk):
+            states = np.random.uniform(ob_low, ob_high, size=(chunk, args.ob_dim))
+            rbuffer.states_NO[start:start + chunk] = rbuffer._encode_states(states)
+            rbuffer.actions_NA[start:start + chunk] = np.random.uniform(-1, 1, size=(chunk, args.ac_dim))
+        rbuffer.num_in_buffer = args.replay_size
+
+        # Round trip through add_sample and sample, including the done mask.
+        states = np.random.uniform(ob_low, ob_high, size=(args.iters, args.ob_dim)).astype(np.float32)
+        dones = np.random.rand(args.iters) < 0.5
+        rbuffer.next_idx = 0
+        t_start = time.time()
+        for s, done in zip(states, dones):
+            rbuffer.add_sample(s, np.zeros(args.ac_dim), 0.0, done)
+        sec_add = (time.time() - t_start) / args.iters
+        indices = np.arange(args.iters)
+        error = np.abs(rbuffer._decode_states(rbuffer.states_NO[indices]) - states)
+        if rbuffer.state_dtype.kind == 'u':
+            # Half a step, plus float32 rounding in decoding.
+            rounding = 4 * np.finfo(np.float32).eps * np.maximum(np.abs(ob_low), np.abs(ob_high))
+            assert np.all(error <= rbuffer.ob_step / 2 + rounding), \
+                "{}: error above half a quantization step".format(name)
+        if rbuffer.pack_done:
+            stored = (rbuffer.done_N[indices >> 3] >> (indices & 7)) & 1
+        else:
+            stored = rbuffer.done_N[indices]
+        assert np.array_equal(stored, dones), "{}: done mask differs".format(name)
+
+        sec_sample = timeit(lambda: rbuffer.sample(args.batch_size), args.iters)
+        print("{:22s} {:8.1f} MB ({:4.2f}x less),  add_sample {:5.1f} usec,  sample {:6.1f} usec,  "
+              "max |state error| / range {:.1e}".format(
+                name, rbuffer.nbytes / 2.0**20, float(float32_nbytes) / rbuffer.nbytes,
+                sec_add * 1e6, sec_sample * 1e6, np.max(error / (ob_high - ob_low))))
+        # Free this buffer before the next one is allocated.
+        rbuffer = None
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('--which', type=str, default='sample', choices=['sample', 'storage'])
+    p.add_argument('--replay_size', type=int, default=1000000)
+    p.add_argument('--batch_size', type=int, default=64)
+    p.add_argument('--ob_dim', type=int, default=17)
+    p.add_argument('--ac_dim', type=int, default=6)
+    p.add_argument('--iters', type=int, default=200)
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+    np.random.seed(args.seed)
+    if args.which == 'sample':
+        bench_sample(args)
+    else:
+        bench_storage(args)
@@ -19,18 +19,32 @@ from utils import logz
 
 class DDPGAgent(object):
 
-    def __init__(self, sess, env, test_env, args):
+    def __init__(self, sess, env, test_envs, args, ob_bounds=None):
+        """ `ob_bounds` is an optional (low, high) pair of per-dimension state
+        bounds for a quantized replay buffer, instead of the env's. """
         self.sess = sess
         self.args = args
         self.env = env
-        self.test_env = test_env
+        self.test_envs = test_envs
         self.ob_dim = env.observation_space.shape[0]
         self.ac_dim = env.action_space.shape[0]
 
         # Construct the networks and the experience replay buffer.
         self.actor   = Actor(sess, env, args)
         self.critic  = Critic(sess, env, args)
-        self.rbuffer = ReplayBuffer(args.replay_size, self.ob_dim, self.ac_dim)
+        if not args.separate_updates:
+            self._build_fused_update()
+            if args.updates_per_step > 1:
+                self._build_update_loop()
+        self.fit_ob_bounds = (getattr(args, 'replay_ob_bounds', None) == 'fit' and
+                              np.dtype(args.replay_state_dtype).kind == 'u')
+        if self.fit_ob_bounds:
+            # Float32 until the bounds are fitted, see `_fit_ob_bounds`.
+            self.rbuffer = ReplayBuffer(args.wait_until_rbuffer + 1, self.ob_dim, self.ac_dim)
+        else:
+            if ob_bounds is None:
+                ob_bounds = (env.observation_space.low, env.observation_space.high)
+            self.rbuffer = self._new_rbuffer(*ob_bounds)
 
         # Initialize then run, also setting current=target to start.
         self._debug_print()
@@ -45,6 +59,7 @@ class DDPGAgent(object):
         """
         num_episodes = 0
         t_start = time.time()
+        update_seconds = []
         obs = self.env.reset()
 
         for t in range(self.args.n_iter):
@@ -55,6 +70,8 @@ class DDPGAgent(object):
             act = self.actor.sample_action(obs, train=True)
             new_obs, rew, done, info = self.env.step(act)
             self.rbuffer.add_sample(s=obs, a=act, r=rew, done=done)
+            if self.fit_ob_bounds and t == self.args.wait_until_rbuffer:
+                self._fit_ob_bounds()
             if done:
                 obs = self.env.reset()
                 num_episodes += 1
@@ -62,23 +79,26 @@ class DDPGAgent(object):
                 obs = new_obs
 
             if (t > self.args.wait_until_rbuffer) and (t % self.args.learning_freq == 0):
-                # Sample from the replay buffer.
-                states_t_BO, actions_t_BA, rewards_t_B, states_tp1_BO, done_mask_B = \
-                        self.rbuffer.sample(num=self.args.batch_size)
-
-                feed = {'obs_t_BO':    states_t_BO, 
-                        'act_t_BA':    actions_t_BA, 
-                        'rew_t_B':     rewards_t_B, 
-                        'obs_tp1_BO':  states_tp1_BO, 
-                        'done_mask_B': done_mask_B}
-
-                # Update the critic, get sampled policy gradients, update actor.
-                a_grads_BA, l2_error = self.critic.update_weights(feed)
-                actor_gradients = self.actor.update_weights(feed, a_grads_BA)
-
-                # Update both target networks.
-                self.critic.update_target_net()
-                self.actor.update_target_net()
+                t_update = time.time()
+                if self.args.separate_updates:
+                    for _ in range(self.args.updates_per_step):
+                        feed = self._sample_feed(self.args.batch_size)
+
+                        # Update the critic, get sampled policy gradients, update actor.
+                        a_grads_BA, l2_error = self.critic.update_weights(feed)
+                        actor_gradients = self.actor.update_weights(feed, a_grads_BA)
+                        a_grads_norm = np.linalg.norm(a_grads_BA)
+
+                        # Update both target networks.
+                        self.critic.update_target_net()
+                        self.actor.update_target_net()
+                elif self.args.updates_per_step == 1:
+                    feed = self._sample_feed(self.args.batch_size)
+                    l2_error, a_grads_norm = self.update_weights(feed)
+                else:
+                    feed = self._sample_feed(self.args.updates_per_step * self.args.batch_size)
+                    l2_error, a_grads_norm = self.update_weights_loop(feed)
+                update_seconds.append(time.time() - t_update)
 
             if (t % self.args.log_every_t_iter == 0) and (t > self.args.wait_until_rbuffer):
                 # Do some rollouts here and then record statistics.  Note that
@@ -94,38 +114,205 @@ class DDPGAgent(object):
                 logz.log_tabular("MeanLength",     np.mean(stats['length']))
                 logz.log_tabular("NumTrainingEps", num_episodes)
                 logz.log_tabular("L2ErrorCritic",  l2_error)
-                logz.log_tabular("QaGradL2Norm",   np.linalg.norm(a_grads_BA))
+                logz.log_tabular("QaGradL2Norm",   a_grads_norm)
+                logz.log_tabular("UpdateMsec",     1000 * np.mean(update_seconds))
                 logz.log_tabular("TimeHours",      hours)
                 logz.log_tabular("Iterations",     t)
                 logz.dump_tabular()
+                update_seconds = []
+
+
+    def _new_rbuffer(self, ob_low, ob_high):
+        return ReplayBuffer(self.args.replay_size, self.ob_dim, self.ac_dim,
+                            state_dtype=self.args.replay_state_dtype,
+                            action_dtype=self.args.replay_action_dtype,
+                            pack_done=self.args.replay_pack_done,
+                            ob_low=ob_low,
+                            ob_high=ob_high)
+
+
+    def _fit_ob_bounds(self, margin=0.5):
+        """ Swaps the float32 warm-up buffer for the quantized one, with state
+        bounds fitted to the warm-up states and then frozen. Each dimension's
+        range is widened by `margin` times itself on both sides, since later
+        states beyond the bounds are clipped. """
+        warmup = self.rbuffer
+        num = warmup.num_in_buffer
+        states_NO = warmup.states_NO[:num]
+        ob_low, ob_high = states_NO.min(axis=0), states_NO.max(axis=0)
+        span_O = np.maximum(ob_high - ob_low, 1e-3)
+        self.rbuffer = self._new_rbuffer(ob_low - margin * span_O, ob_high + margin * span_O)
+        for i in range(num):
+            self.rbuffer.add_sample(s=states_NO[i], a=warmup.actions_NA[i],
+                                    r=warmup.rewards_N[i], done=warmup.done_N[i])
+        self.fit_ob_bounds = False
+        print("Fitted replay state bounds on {} states, widest range {:.3f}.".format(
+                num, np.max(span_O) * (1 + 2 * margin)))
+
+
+    def _sample_feed(self, num):
+        """ Samples `num` transitions from the replay buffer. """
+        states_t_BO, actions_t_BA, rewards_t_B, states_tp1_BO, done_mask_B = \
+                self.rbuffer.sample(num=num, replace=self.args.replay_with_replacement)
+
+        feed = {'obs_t_BO':    states_t_BO, 
+                'act_t_BA':    actions_t_BA, 
+                'rew_t_B':     rewards_t_B, 
+                'obs_tp1_BO':  states_tp1_BO, 
+                'done_mask_B': done_mask_B}
+        return feed
+
+
+    def _build_fused_update(self):
+        """ A whole training step as one op: the critic update, dQ/da, the
+        actor update and both smooth target updates.
+
+        Computes what `critic.update_weights`, `actor.update_weights` and the
+        two `update_target_net` calls do, in one `session.run` instead of
+        four, and dQ/da goes from the critic to the actor inside the graph
+        instead of through numpy. The optimizers (and their Adam slots) are
+        shared with those methods, which stay around for debugging with
+        `--separate_updates`.
+        """
+        a_grads_BA = self.critic.act_grads_BA[0]
+        actor_gradients = tf.gradients(self.actor.actions_BA, self.actor.weights, -a_grads_BA)
+        # dQ/da and the loss are taken before the critic's weights change.
+        with tf.control_dependencies([a_grads_BA, self.critic.l2_error]):
+            update_c = self.critic.optimizer.apply_gradients(self.critic.grads_and_vars)
+        update_a = self.actor.optimizer.apply_gradients(zip(actor_gradients, self.actor.weights))
+        # Built here, so the targets move after both updates.
+        with tf.control_dependencies([update_c, update_a]):
+            self.fused_update = tf.group(self.critic.build_target_update(smooth=True),
+                                         self.actor.build_target_update(smooth=True))
+        self.a_grads_norm = tf.norm(a_grads_BA)
+
+
+    def _build_update_loop(self):
+        """ Several fused training steps as one op, a `tf.while_loop` over
+        minibatches stacked along a new first axis (K of them, K being
+        `--updates_per_step`).
+
+        The loop body is the same computation as `_build_fused_update`, on
+        copies of the nets built inside it. Their weights are read with
+        `read_value`, so each iteration sees the weights as updated by the
+        previous one, and the gradients are taken w.r.t. these reads. The
+        iterations run one at a time (`parallel_iterations=1`).
+        """
+        self.obs_t_KBO    = tf.placeholder(tf.float32, [None, None, self.ob_dim])
+        self.act_t_KBA    = tf.placeholder(tf.float32, [None, None, self.ac_dim])
+        self.rew_t_KB     = tf.placeholder(tf.float32, [None, None])
+        self.done_mask_KB = tf.placeholder(tf.float32, [None, None])
+        critic_vars = [v for g, v in self.critic.grads_and_vars if g is not None]
+
+        def body(k, l2_error, a_grads_norm):
+            reads = {}
+            def read_current(getter, *args, **kwargs):
+                var = getter(*args, **kwargs)
+                reads[var] = var.read_value()
+                return reads[var]
+
+            obs_t_BO, act_t_BA = self.obs_t_KBO[k], self.act_t_KBA[k]
+            qvals_B = self.critic._build_net(obs_t_BO, act_t_BA, scope='CriticNet',
+                                             reuse=True, custom_getter=read_current)
+            qvals_targ_B = self.critic._build_net(obs_t_BO, act_t_BA, scope='TargCriticNet',
+                                                  reuse=True, custom_getter=read_current)
+            actions_BA = self.actor._build_net(obs_t_BO, scope='ActorNet',
+                                               reuse=True, custom_getter=read_current)
+            l2_error = self.critic.build_loss(qvals_B, qvals_targ_B,
+                                              self.rew_t_KB[k], self.done_mask_KB[k])
+            a_grads_BA = tf.gradients(qvals_B, act_t_BA)[0]
+            critic_gradients = tf.gradients(l2_error, [reads[v] for v in critic_vars])
+            actor_gradients = tf.gradients(actions_BA, [reads[v] for v in self.actor.weights],
+                                           -a_grads_BA)
+
+            with tf.control_dependencies([a_grads_BA, l2_error]):
+                update_c = self.critic.optimizer.apply_gradients(zip(critic_gradients, critic_vars))
+            update_a = self.actor.optimizer.apply_gradients(zip(actor_gradients, self.actor.weights))
+            with tf.control_dependencies([update_c, update_a]):
+                update_targets = tf.group(self.critic.build_target_update(smooth=True),
+                                          self.actor.build_target_update(smooth=True))
+            with tf.control_dependencies([update_targets]):
+                return k + 1, tf.identity(l2_error), tf.norm(a_grads_BA)
+
+        num_updates = tf.shape(self.obs_t_KBO)[0]
+        _, self.loop_l2_error, self.loop_a_grads_norm = tf.while_loop(
+                lambda k, l2_error, a_grads_norm: k < num_updates, body,
+                [tf.constant(0), tf.constant(0.0), tf.constant(0.0)],
+                parallel_iterations=1, back_prop=False)
+
+
+    def update_weights_loop(self, f):
+        """ `--updates_per_step` fused training steps in one `session.run`,
+        on consecutive `batch_size` slices of the transitions in `f`. Returns
+        the critic's loss and the norm of dQ/da of the last step. """
+        K = self.args.updates_per_step
+        feed = {
+            self.obs_t_KBO:    f['obs_t_BO'].reshape((K, -1, self.ob_dim)),
+            self.act_t_KBA:    f['act_t_BA'].reshape((K, -1, self.ac_dim)),
+            self.rew_t_KB:     f['rew_t_B'].reshape((K, -1)),
+            self.done_mask_KB: f['done_mask_B'].reshape((K, -1))
+        }
+        return self.sess.run([self.loop_l2_error, self.loop_a_grads_norm], feed)
+
+
+    def update_weights(self, f):
+        """ One fused training step on minibatch `f` (see `_build_fused_update`).
+        Returns the critic's loss and the norm of dQ/da, as they were before
+        the step. """
+        feed = {
+            self.actor.obs_t_BO:     f['obs_t_BO'],
+            self.critic.obs_t_BO:    f['obs_t_BO'],
+            self.critic.act_t_BA:    f['act_t_BA'],
+            self.critic.rew_t_B:     f['rew_t_B'],
+            self.critic.obs_tp1_BO:  f['obs_tp1_BO'],
+            self.critic.done_mask_B: f['done_mask_B']
+        }
+        _, l2_error, a_grads_norm = self.sess.run([self.fused_update,
+                self.critic.l2_error, self.a_grads_norm], feed)
+        return l2_error, a_grads_norm
 
 
     def _do_rollouts(self):
         """ 
         Some rollouts to evaluate the agent's progress.  Returns a dictionary
-        containing relevant statistics. Later, I should parallelize this using
-        an array of environments.
+        containing relevant statistics.
+
+        The episodes are spread over `self.test_envs`, which are stepped in
+        lockstep: each step, the actions of all envs still in an episode come
+        from one forward pass of the actor (without noise). An env whose
+        episode ends starts the next one until `num_episodes` are started.
         """
         num_episodes = 50
         stats = defaultdict(list)
-
-        for i in range(num_episodes):
-            obs = self.test_env.reset()
-            ep_time = 0
-            ep_reward = 0
-
-            # Run one episode ...
-            while True:
-                act = self.actor.sample_action(obs, train=False)
-                new_obs, rew, done, info = self.test_env.step(act)
-                ep_time += 1
-                ep_reward += rew
+        num_envs = len(self.test_envs)
+        obs_NO = np.zeros((num_envs, self.ob_dim), dtype=np.float32)
+        ep_time = np.zeros(num_envs, dtype=np.int64)
+        ep_reward = np.zeros(num_envs)
+        active = np.zeros(num_envs, dtype=bool)
+
+        num_started = 0
+        for i in range(min(num_envs, num_episodes)):
+            obs_NO[i] = self.test_envs[i].reset()
+            active[i] = True
+            num_started += 1
+
+        while active.any():
+            idxes = np.flatnonzero(active)
+            acts_BA = self.sess.run(self.actor.actions_BA, {self.actor.obs_t_BO: obs_NO[idxes]})
+            for i, act in zip(idxes, acts_BA):
+                new_obs, rew, done, info = self.test_envs[i].step(act)
+                ep_time[i] += 1
+                ep_reward[i] += rew
+                obs_NO[i] = new_obs
                 if done:
-                    break
-
-            # ... and collect its information here.
-            stats['length'].append(ep_time)
-            stats['reward'].append(ep_reward)
+                    stats['length'].append(ep_time[i])
+                    stats['reward'].append(ep_reward[i])
+                    ep_time[i], ep_reward[i] = 0, 0.0
+                    if num_started < num_episodes:
+                        obs_NO[i] = self.test_envs[i].reset()
+                        num_started += 1
+                    else:
+                        active[i] = False
 
         return stats
 
@@ -174,6 +361,23 @@ class Network(object):
         self.done_mask_B = tf.placeholder(tf.float32, [None])
 
 
+    def build_target_update(self, smooth=True):
+        """ Op moving the target weights towards the current ones (by `tau`,
+        or all the way if not smooth). Each call builds new assign ops, which
+        read the weights with `read_value`, so when built under control
+        dependencies they see the weights as updated by them. """
+        updates = []
+        for var, var_target in zip(sorted(self.weights,      key=lambda v: v.name),
+                                   sorted(self.weights_targ, key=lambda v: v.name)):
+            if smooth:
+                update_sm = self.args.tau * var.read_value() + \
+                        (1 - self.args.tau) * var_target.read_value()
+                updates.append(var_target.assign(update_sm))
+            else:
+                updates.append(var_target.assign(var.read_value()))
+        return tf.group(*updates)
+
+
 
 class Actor(Network):
     """ Given input as a batch of states, the actor deterministically provides
@@ -202,34 +406,29 @@ class Actor(Network):
         self.num_weights = np.sum([np.prod(sh) for sh in self.w_shapes])
 
         # Update the target action network. Provide hard and smooth updates.
-        target_smooth = []
-        target_hard = []
-        for var, var_target in zip(sorted(self.weights,      key=lambda v: v.name),
-                                   sorted(self.weights_targ, key=lambda v: v.name)):
-            update_sm = self.args.tau * var + (1 - self.args.tau) * var_target
-            target_smooth.append(var_target.assign(update_sm))
-            target_hard.append(var_target.assign(var))
-        self.update_target_smooth = tf.group(*target_smooth)
-        self.update_target_hard   = tf.group(*target_hard)
+        self.update_target_smooth = self.build_target_update(smooth=True)
+        self.update_target_hard   = self.build_target_update(smooth=False)
 
         # The Actor _update_, with one gradient provided by the critic which
         # serves as initialization (I think) since we need to multiply. Negate
         # it (I think) since we we want to minimize a loss function.
         self.a_grads_BA = tf.placeholder(tf.float32, [None,self.ac_dim])
         self.actor_gradients = tf.gradients(self.actions_BA, self.weights, -self.a_grads_BA)
-        self.optimize_a = tf.train.AdamOptimizer(self.args.step_size_actor).\
-                    apply_gradients(zip(self.actor_gradients, self.weights))
+        self.optimizer = tf.train.AdamOptimizer(self.args.step_size_actor)
+        self.optimize_a = self.optimizer.apply_gradients(zip(self.actor_gradients, self.weights))
 
 
-    def _build_net(self, input_BO, scope):
+    def _build_net(self, input_BO, scope, reuse=False, custom_getter=None):
         """ The Actor network.
         
         Uses ReLUs for all hidden layers, but a tanh to the output to bound the
         action. This follows their 'low-dimensional networks' using 400 and 300
-        units for the hidden layers. Set `reuse=False`. I don't use batch
-        normalization or their precise weight initialization.
+        units for the hidden layers. Set `reuse=False`, unless building another
+        copy of an existing net (with `custom_getter` deciding how its weights
+        are read). I don't use batch normalization or their precise weight
+        initialization.
         """
-        with tf.variable_scope(scope, reuse=False):
+        with tf.variable_scope(scope, reuse=reuse, custom_getter=custom_getter):
             hidden1 = layers.fully_connected(input_BO,
                     num_outputs=400,
                     weights_initializer=layers.xavier_initializer(),
@@ -315,23 +514,15 @@ class Critic(Network):
         self.num_weights = np.sum([np.prod(sh) for sh in self.w_shapes])
 
         # Update the target action network. Provide hard and smooth updates.
-        target_smooth = []
-        target_hard = []
-        for var, var_target in zip(sorted(self.weights,      key=lambda v: v.name),
-                                   sorted(self.weights_targ, key=lambda v: v.name)):
-            update_sm = self.args.tau * var + (1 - self.args.tau) * var_target
-            target_smooth.append(var_target.assign(update_sm))
-            target_hard.append(var_target.assign(var))
-        self.update_target_smooth = tf.group(*target_smooth)
-        self.update_target_hard   = tf.group(*target_hard)
+        self.update_target_smooth = self.build_target_update(smooth=True)
+        self.update_target_hard   = self.build_target_update(smooth=False)
 
-        # The _critic_ uses y_i, the target for its loss. Depends on `done` mask! 
-        self.target_val_B = self.rew_t_B + (self.args.Q_gamma * self.qvals_targ_B) * (1 - self.done_mask_B)
-        self.l2_error = tf.reduce_mean(tf.square(self.target_val_B - self.qvals_B))
-        # TODO l2 weight decay?
+        self.l2_error = self.build_loss(self.qvals_B, self.qvals_targ_B, self.rew_t_B, self.done_mask_B)
 
         # Use the built-in Adam optimizer, but might want to try gradient clipping?
-        self.optimize_c = tf.train.AdamOptimizer(self.args.step_size_critic).minimize(self.l2_error) 
+        self.optimizer = tf.train.AdamOptimizer(self.args.step_size_critic)
+        self.grads_and_vars = self.optimizer.compute_gradients(self.l2_error)
+        self.optimize_c = self.optimizer.apply_gradients(self.grads_and_vars)
 
         # Then return this in the gradient step to provide to the Actor.
         # TODO should check this, it _should_ deal with gradients row-wise, and
@@ -342,18 +533,27 @@ class Critic(Network):
         self.act_grads_BA = tf.gradients(self.qvals_B, self.act_t_BA)
 
 
-    def _build_net(self, input_BO, acts_BO, scope):
+    def build_loss(self, qvals_B, qvals_targ_B, rew_t_B, done_mask_B):
+        """ The critic's loss, given the outputs of both nets. """
+        # The _critic_ uses y_i, the target for its loss. Depends on `done` mask! 
+        target_val_B = rew_t_B + (self.args.Q_gamma * qvals_targ_B) * (1 - done_mask_B)
+        # TODO l2 weight decay?
+        return tf.reduce_mean(tf.square(target_val_B - qvals_B))
+
+
+    def _build_net(self, input_BO, acts_BO, scope, reuse=False, custom_getter=None):
         """ The critic network.
         
         Use ReLUs for all hidden layers. The output consists of one Q-value for
-        each batch. Set `reuse=False`. I don't use batch normalization or their
+        each batch. Set `reuse=False`, unless building another copy of an
+        existing net, as for the Actor. I don't use batch normalization or their
         precise weight initialization.
 
         Unlike the critic, it uses actions here but they are NOT included in the
         first hidden layer. In addition, we do a tf.reshape to get an output of
         shape (B,), not (B,1). Seems like tf.squeeze doesn't work with `?`.
         """
-        with tf.variable_scope(scope, reuse=False):
+        with tf.variable_scope(scope, reuse=reuse, custom_getter=custom_getter):
             hidden1 = layers.fully_connected(input_BO,
                     num_outputs=400,
                     weights_initializer=layers.xavier_initializer(),
@@ -42,10 +42,50 @@ if __name__ == "__main__":
     p.add_argument('--log_every_t_iter', type=int, default=50)
     p.add_argument('--max_gradient', type=float, default=10.0)
     p.add_argument('--n_iter', type=int, default=10000)
+    p.add_argument('--num_test_envs', type=int, default=10)
+    p.add_argument('--replay_action_dtype', type=str, default='float32',
+                   choices=['float32', 'float16'])
+    p.add_argument('--replay_ob_bounds', type=str, default=None,
+                   help='For uint8/uint16 replay states: a text file with two rows, '
+                        'the per-dimension low and high state bounds, or "fit" to fit '
+                        'them to the states seen until --wait_until_rbuffer. '
+                        'Default: the env\'s observation bounds.')
+    p.add_argument('--replay_pack_done', action='store_true')
+    p.add_argument('--replay_state_dtype', type=str, default='float32',
+                   choices=['float32', 'float16', 'uint8', 'uint16'])
+    p.add_argument('--replay_with_replacement', action='store_true')
     p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--separate_updates', action='store_true',
+                   help='Debug: four session.run calls per update instead of one fused op.')
+    p.add_argument('--updates_per_step', type=int, default=1,
+                   help='Minibatch updates every learning_freq steps, in one session.run.')
     p.add_argument('--wait_until_rbuffer', type=int, default=1000)
     args = p.parse_args()
 
+    # Other stuff for seeding and getting things set up.
+    tf.set_random_seed(args.seed)
+    np.random.seed(args.seed)
+    env = gym.make(args.envname)
+
+    # Quantized replay states need finite bounds, which MuJoCo envs don't report.
+    ob_bounds = None
+    if np.dtype(args.replay_state_dtype).kind == 'u':
+        ob_dim = env.observation_space.shape[0]
+        if args.replay_ob_bounds is None:
+            if not (np.all(np.isfinite(env.observation_space.low)) and
+                    np.all(np.isfinite(env.observation_space.high))):
+                p.error("--replay_state_dtype {} needs finite observation bounds, and {} "
+                        "has infinite ones. Use --replay_ob_bounds FILE or "
+                        "--replay_ob_bounds fit.".format(args.replay_state_dtype, args.envname))
+        elif args.replay_ob_bounds != 'fit':
+            ob_bounds = np.loadtxt(args.replay_ob_bounds, ndmin=2)
+            if ob_bounds.shape != (2, ob_dim) or not np.all(np.isfinite(ob_bounds)) or \
+                    not np.all(ob_bounds[0] < ob_bounds[1]):
+                p.error("--replay_ob_bounds {} must hold two rows of {} finite numbers, "
+                        "low < high.".format(args.replay_ob_bounds, ob_dim))
+    elif args.replay_ob_bounds is not None:
+        p.error("--replay_ob_bounds only applies to --replay_state_dtype uint8 or uint16.")
+
     # Handle the log directory and save the arguments.
     logdir = 'out/' +args.envname+ '/seed' +str(args.seed).zfill(2)
     if args.do_not_save:
@@ -56,14 +96,10 @@ if __name__ == "__main__":
             pickle.dump(args, f)
     print("Saving in logdir: {}".format(logdir))
 
-    # Other stuff for seeding and getting things set up.
-    tf.set_random_seed(args.seed)
-    np.random.seed(args.seed)
-    env = gym.make(args.envname)
-    test_env = gym.make(args.envname)
+    test_envs = [gym.make(args.envname) for _ in range(args.num_test_envs)]
     tf_config = tf.ConfigProto(inter_op_parallelism_threads=1, 
                                intra_op_parallelism_threads=1) 
     sess = tf.Session(config=tf_config)
 
-    ddpg = DDPGAgent(sess, env, test_env, args)
+    ddpg = DDPGAgent(sess, env, test_envs, args, ob_bounds=ob_bounds)
     ddpg.train()
@@ -2,9 +2,29 @@ import numpy as np
 import sys
 
 
+def sample_unique_ints(high, num):
+    """ Sample `num` distinct integers from [0, high), as a sorted np.array.
+
+    Same distribution as `np.random.choice(high, num, replace=False)`, but
+    that permutes all of [0, high) on every call. Here we draw `num` integers
+    at a time and redraw the duplicates, which costs O(num log num) no matter
+    how large `high` is (duplicates are rare when `num` << `high`).
+    """
+    assert num <= high
+    if high <= 16 * num:
+        # Duplicates would be common, and permuting is cheap anyway.
+        return np.sort(np.random.permutation(high)[:num])
+    indices = np.unique(np.random.randint(high, size=num))
+    while len(indices) < num:
+        extra = np.random.randint(high, size=num - len(indices))
+        indices = np.unique(np.concatenate([indices, extra]))
+    return indices
+
+
 class ReplayBuffer(object):
 
-    def __init__(self, size, ob_dim, ac_dim):
+    def __init__(self, size, ob_dim, ac_dim, state_dtype='float32',
+                 action_dtype='float32', pack_done=False, ob_low=None, ob_high=None):
         """ A replay buffer to store transitions (s,a,r,s') for DDPG.
 
         - We save with numpy arrays, because there doesn't seem to be a better
@@ -31,6 +51,14 @@ class ReplayBuffer(object):
           end of an episode when doing env.step(), which is equivalent to saying
           that the next state stored in this buffer is a start state.
 
+        - To save memory, states and actions can be stored at lower precision.
+          With `state_dtype` 'uint8' or 'uint16', each state dimension is
+          quantized to that many levels between `ob_low` and `ob_high`, so it
+          comes back off by at most half a level, (high-low)/(2*levels-2)
+          (plus float32 rounding), as long as it was within the bounds
+          (values outside are clipped).
+          Whatever the storage, `sample` returns float32 states and actions.
+
         Parameters
         ----------
         size: [int]
@@ -40,14 +68,47 @@ class ReplayBuffer(object):
             State dimension, assumes an integer and not a list or tuple.
         ac_dim: [int]
             Action dimension, assumes an integer and not a list or tuple.
+        state_dtype: [str]
+            One of 'float32', 'float16', 'uint8' or 'uint16'.
+        action_dtype: [str]
+            One of 'float32' or 'float16'.
+        pack_done: [bool]
+            If True, the done mask is stored as bits, 8 per byte.
+        ob_low, ob_high: [np.array or None]
+            Per-dimension state bounds, needed (and finite) for the integer
+            state dtypes.
         """
         self.next_idx = 0
         self.num_in_buffer = 0
         self.size = size
-        self.states_NO  = np.zeros((size, ob_dim), dtype=np.float32)
-        self.actions_NA = np.zeros((size, ac_dim), dtype=np.float32)
+        self.state_dtype = np.dtype(state_dtype)
+        self.pack_done = pack_done
+        assert self.state_dtype in (np.float32, np.float16, np.uint8, np.uint16)
+        assert np.dtype(action_dtype) in (np.float32, np.float16)
+        if self.state_dtype.kind == 'u':
+            assert ob_low is not None and ob_high is not None, \
+                "Quantized states need the observation bounds."
+            ob_low  = np.asarray(ob_low,  dtype=np.float32) * np.ones(ob_dim, dtype=np.float32)
+            ob_high = np.asarray(ob_high, dtype=np.float32) * np.ones(ob_dim, dtype=np.float32)
+            assert np.all(np.isfinite(ob_low)) and np.all(np.isfinite(ob_high)) and \
+                np.all(ob_high > ob_low), "Quantized states need finite bounds, low < high."
+            self.ob_low = ob_low
+            self.ob_step = (ob_high - ob_low) / np.iinfo(self.state_dtype).max
+
+        self.states_NO  = np.zeros((size, ob_dim), dtype=self.state_dtype)
+        self.actions_NA = np.zeros((size, ac_dim), dtype=action_dtype)
         self.rewards_N  = np.zeros((size,), dtype=np.float32)
-        self.done_N     = np.zeros((size,), dtype=np.uint8)
+        if pack_done:
+            self.done_N = np.zeros(((size + 7) // 8,), dtype=np.uint8)
+        else:
+            self.done_N = np.zeros((size,), dtype=np.uint8)
+
+
+    @property
+    def nbytes(self):
+        """ Memory taken by the stored transitions, in bytes. """
+        return (self.states_NO.nbytes + self.actions_NA.nbytes +
+                self.rewards_N.nbytes + self.done_N.nbytes)
 
 
     def add_sample(self, s, a, r, done):
@@ -66,20 +127,29 @@ class ReplayBuffer(object):
         Use `self.next_idx` to store the index, NOT `self.num_in_buffer`. The
         former will automatically override old samples.
         """
-        self.states_NO[self.next_idx] = s 
+        self.states_NO[self.next_idx] = self._encode_states(s)
         self.actions_NA[self.next_idx] = a
         self.rewards_N[self.next_idx] = r
-        self.done_N[self.next_idx] = int(done)
+        if self.pack_done:
+            byte, bit = divmod(self.next_idx, 8)
+            if done:
+                self.done_N[byte] |= (1 << bit)
+            else:
+                self.done_N[byte] &= ~(1 << bit) & 0xff
+        else:
+            self.done_N[self.next_idx] = int(done)
         self.num_in_buffer += 1
         self.next_idx = (self.next_idx + 1) % self.size
 
 
-    def sample(self, num):
+    def sample(self, num, replace=False):
         """ Sample `num` transitions (s,a,r,s') for a minibatch. 
         
         We can use the minimum of the number we've added so far and the max
         buffer size to determine the range of indices to consider when sampling
-        (_without_ replacement). When taking the successor states, we increment
+        (_without_ replacement, unless `replace=True`, which is a bit cheaper
+        and hardly differs for a minibatch much smaller than the buffer).
+        Either way the cost grows with `num`, not the buffer size. When taking the successor states, we increment
         the indices by one and wrap to zero as needed.
 
         Don't forget the `done` mask! This means we ignore the state at time t
@@ -92,16 +162,37 @@ class ReplayBuffer(object):
         """
         assert num < self.num_in_buffer
         max_index = min(self.num_in_buffer-1, self.size)
-        indices = np.random.choice(max_index, num, replace=False)
+        if replace:
+            indices = np.random.randint(max_index, size=num)
+        else:
+            indices = sample_unique_ints(max_index, num)
 
         # Make next indices (+1) equal to index `self.size` back to zero.
         below_thresh = ((indices+1) < self.size).astype(int)
         indices_next = (indices+1) * below_thresh 
 
         # Get the minibatches for training purposes.
-        states_t_BO   = self.states_NO[indices]
-        actions_t_BA  = self.actions_NA[indices]
+        states_t_BO   = self._decode_states(self.states_NO[indices])
+        actions_t_BA  = self.actions_NA[indices].astype(np.float32, copy=False)
         rewards_t_B   = self.rewards_N[indices]
-        states_tp1_BO = self.states_NO[indices_next]
-        done_mask_B   = self.done_N[indices]
+        states_tp1_BO = self._decode_states(self.states_NO[indices_next])
+        if self.pack_done:
+            done_mask_B = ((self.done_N[indices >> 3] >> (indices & 7)) & 1).astype(np.uint8)
+        else:
+            done_mask_B = self.done_N[indices]
         return (states_t_BO, actions_t_BA, rewards_t_B, states_tp1_BO, done_mask_B)
+
+
+    def _encode_states(self, s):
+        """ Quantizes state(s) `s` if the states are stored as integers. """
+        if self.state_dtype.kind != 'u':
+            return s
+        levels = np.rint((np.asarray(s, dtype=np.float32) - self.ob_low) / self.ob_step)
+        return np.clip(levels, 0, np.iinfo(self.state_dtype).max)
+
+
+    def _decode_states(self, states):
+        """ Float32 version of states as stored in `self.states_NO`. """
+        if self.state_dtype.kind != 'u':
+            return states.astype(np.float32, copy=False)
+        return self.ob_low + states * self.ob_step
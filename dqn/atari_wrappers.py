@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-from collections import deque
 import gym
 from gym import spaces
 
@@ -78,8 +77,10 @@ class MaxAndSkipEnv(gym.Wrapper):
     def __init__(self, env=None, skip=4):
         """Return only every `skip`-th frame"""
         super(MaxAndSkipEnv, self).__init__(env)
-        # most recent raw observations (for max pooling across time steps)
-        self._obs_buffer = deque(maxlen=2)
+        # two most recent raw observations (for max pooling across time steps),
+        # written alternately
+        self._obs_buffer = [None, None]
+        self._next_slot  = 0
         self._skip       = skip
 
     def _step(self, action):
@@ -87,20 +88,23 @@ class MaxAndSkipEnv(gym.Wrapper):
         done = None
         for _ in range(self._skip):
             obs, reward, done, info = self.env.step(action)
-            self._obs_buffer.append(obs)
+            self._obs_buffer[self._next_slot] = obs
+            self._next_slot ^= 1
             total_reward += reward
             if done:
                 break
 
-        max_frame = np.max(np.stack(self._obs_buffer), axis=0)
+        max_frame = np.maximum(self._obs_buffer[0], self._obs_buffer[1])
 
         return max_frame, total_reward, done, info
 
     def _reset(self):
         """Clear past frame buffer and init. to first obs. from inner env."""
-        self._obs_buffer.clear()
         obs = self.env.reset()
-        self._obs_buffer.append(obs)
+        # With the first obs in both slots, the max over the slots is the max
+        # over the observations seen since the reset.
+        self._obs_buffer = [obs, obs]
+        self._next_slot  = 0
         return obs
 
 def _process_frame84(frame):
@@ -111,17 +115,37 @@ def _process_frame84(frame):
     x_t = np.reshape(x_t, [84, 84, 1])
     return x_t.astype(np.uint8)
 
+class FrameProcessor84(object):
+    def __init__(self):
+        """Same as `_process_frame84` without float images; pixels differ by
+        at most 1, since OpenCV's uint8 kernels round where the float
+        version truncates.
+
+        Uses OpenCV's fixed-point grayscale conversion (same weights) and
+        resize into buffers allocated once. Only the returned (84, 84, 1)
+        frame is new on each call.
+        """
+        self._gray    = np.empty((210, 160), dtype=np.uint8)
+        self._resized = np.empty((110, 84),  dtype=np.uint8)
+
+    def __call__(self, frame):
+        frame = np.reshape(frame, [210, 160, 3])
+        cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=self._gray)
+        cv2.resize(self._gray, (84, 110), dst=self._resized, interpolation=cv2.INTER_LINEAR)
+        return self._resized[18:102, :, None].copy()
+
 class ProcessFrame84(gym.Wrapper):
     def __init__(self, env=None):
         super(ProcessFrame84, self).__init__(env)
         self.observation_space = spaces.Box(low=0, high=255, shape=(84, 84, 1))
+        self._process_frame84 = FrameProcessor84()
 
     def _step(self, action):
         obs, reward, done, info = self.env.step(action)
-        return _process_frame84(obs), reward, done, info
+        return self._process_frame84(obs), reward, done, info
 
     def _reset(self):
-        return _process_frame84(self.env.reset())
+        return self._process_frame84(self.env.reset())
 
 class ClippedRewardsWrapper(gym.Wrapper):
     def _step(self, action):
@@ -137,13 +161,17 @@ def wrap_deepmind_ram(env):
     env = ClippedRewardsWrapper(env)
     return env
 
-def wrap_deepmind(env):
+def wrap_deepmind(env, episode_life=True, clip_rewards=True):
+    """Training uses the defaults; evaluation turns both off, to score
+    whole games with the game's own rewards."""
     assert 'NoFrameskip' in env.spec.id
-    env = EpisodicLifeEnv(env)
+    if episode_life:
+        env = EpisodicLifeEnv(env)
     env = NoopResetEnv(env, noop_max=30)
     env = MaxAndSkipEnv(env, skip=4)
     if 'FIRE' in env.unwrapped.get_action_meanings():
         env = FireResetEnv(env)
     env = ProcessFrame84(env)
-    env = ClippedRewardsWrapper(env)
+    if clip_rewards:
+        env = ClippedRewardsWrapper(env)
     return env
@@ -0,0 +1,335 @@
+"""
+Micro-benchmarks for the DQN replay buffer in `dqn_utils.py`.
+
+Fills a buffer with random 84x84 frames (and random episode boundaries), then
+reports minibatch sampling throughput. Usage:
+
+    python bench_replay.py --size 100000
+    python bench_replay.py --which prioritized
+    python bench_replay.py --which compressed --codec zlib
+    python bench_replay.py --which tf
+    python bench_replay.py --which ram
+    python bench_replay.py --which sequence --size 1000000
+
+The default benchmark compares `ReplayBuffer.sample` with a copy of the
+original implementation (`baseline_sample` below): unique indices drawn one at
+a time with `random.randint` and an O(n^2) membership check, then one
+`_encode_observation` call per index. It also checks that both encode the same
+indices into exactly the same tensors.
+
+Random frames don't compress, so the `compressed` benchmark fills the buffer
+with synthetic Pong-like frames instead (flat background, two paddles and a
+ball), which is a rough stand-in for real preprocessed Atari frames.
+"""
+
+import argparse
+import random
+import time
+import numpy as np
+import tensorflow as tf
+from dqn_utils import ReplayBuffer, PrioritizedReplayBuffer, TFReplayBuffer
+
+
+def fill_buffer(replay_buffer, num_frames, frame_shape, episode_len=1000):
+    """Store `num_frames` random frames, ending an episode every so often."""
+    for t in range(num_frames):
+        frame = np.random.randint(0, 256, size=frame_shape, dtype=np.uint8)
+        idx = replay_buffer.store_frame(frame)
+        done = np.random.rand() < (1.0 / episode_len)
+        replay_buffer.store_effect(idx, np.random.randint(6), 0.0, done)
+    return replay_buffer
+
+
+def fill_buffer_synthetic(replay_buffer, num_frames, episode_len=1000):
+    """Like `fill_buffer`, but with frames that look like preprocessed Pong."""
+    frame = np.empty((84, 84, 1), dtype=np.uint8)
+    paddles = np.array([42, 42])
+    ball = np.array([42.0, 42.0])
+    velocity = np.array([1.3, 0.9])
+    for t in range(num_frames):
+        paddles = np.clip(paddles + np.random.randint(-2, 3, size=2), 4, 76)
+        ball += velocity
+        for axis in range(2):
+            if not 2 <= ball[axis] <= 80:
+                velocity[axis] *= -1
+                ball[axis] = np.clip(ball[axis], 2, 80)
+        frame[:] = 87
+        frame[:10] = 236
+        frame[paddles[0] - 4:paddles[0] + 4, 8:10] = 147
+        frame[paddles[1] - 4:paddles[1] + 4, 74:76] = 148
+        frame[int(ball[0]):int(ball[0]) + 2, int(ball[1]):int(ball[1]) + 2] = 236
+        idx = replay_buffer.store_frame(frame)
+        done = np.random.rand() < (1.0 / episode_len)
+        replay_buffer.store_effect(idx, np.random.randint(6), 0.0, done)
+    return replay_buffer
+
+
+def sample_n_unique(sampling_f, n):
+    """The original helper that `ReplayBuffer.sample` drew indices with."""
+    res = []
+    while len(res) < n:
+        candidate = sampling_f()
+        if candidate not in res:
+            res.append(candidate)
+    return res
+
+
+def baseline_encode_observation(replay_buffer, idx):
+    """The original `ReplayBuffer._encode_observation`, unchanged."""
+    self = replay_buffer
+    end_idx   = idx + 1 # make noninclusive
+    start_idx = end_idx - self.frame_history_len
+    # this checks if we are using low-dimensional observations, such as RAM
+    # state, in which case we just directly return the latest RAM.
+    if len(self.obs.shape) == 2:
+        return self.obs[end_idx-1]
+    # if there weren't enough frames ever in the buffer for context
+    if start_idx < 0 and self.num_in_buffer != self.size:
+        start_idx = 0
+    for idx in range(start_idx, end_idx - 1):
+        if self.done[idx % self.size]:
+            start_idx = idx + 1
+    missing_context = self.frame_history_len - (end_idx - start_idx)
+    # if zero padding is needed for missing context
+    # or we are on the boundry of the buffer
+    if start_idx < 0 or missing_context > 0:
+        frames = [np.zeros_like(self.obs[0]) for _ in range(missing_context)]
+        for idx in range(start_idx, end_idx):
+            frames.append(self.obs[idx % self.size])
+        return np.concatenate(frames, 2)
+    else:
+        # this optimization has potential to saves about 30% compute time \o/
+        img_h, img_w = self.obs.shape[1], self.obs.shape[2]
+        return self.obs[start_idx:end_idx].transpose(1, 2, 0, 3).reshape(img_h, img_w, -1)
+
+
+def baseline_encode_sample(replay_buffer, idxes):
+    """The original `ReplayBuffer._encode_sample`, unchanged."""
+    self = replay_buffer
+    obs_batch      = np.concatenate([baseline_encode_observation(self, idx)[None] for idx in idxes], 0)
+    act_batch      = self.action[idxes]
+    rew_batch      = self.reward[idxes]
+    next_obs_batch = np.concatenate([baseline_encode_observation(self, idx + 1)[None] for idx in idxes], 0)
+    done_mask      = np.array([1.0 if self.done[idx] else 0.0 for idx in idxes], dtype=np.float32)
+
+    return obs_batch, act_batch, rew_batch, next_obs_batch, done_mask
+
+
+def baseline_sample(replay_buffer, batch_size):
+    """The original `ReplayBuffer.sample`, unchanged."""
+    assert replay_buffer.can_sample(batch_size)
+    idxes = sample_n_unique(lambda: random.randint(0, replay_buffer.num_in_buffer - 2), batch_size)
+    return baseline_encode_sample(replay_buffer, idxes)
+
+
+def per_index_encode_sample(replay_buffer, idxes):
+    """Observations from the current per-index `_encode_observation`, as a
+    reference for RAM histories (which the original code didn't stack).
+
+    `_encode_observation` may return a reused scratch array, hence the copies.
+    """
+    obs_batch      = np.concatenate([replay_buffer._encode_observation(idx)[None].copy() for idx in idxes], 0)
+    next_obs_batch = np.concatenate([replay_buffer._encode_observation(idx + 1)[None].copy() for idx in idxes], 0)
+    return obs_batch, next_obs_batch
+
+
+def timeit(fn, num_iters, num_repeats=3):
+    """Best average time per call over `num_repeats` runs, after a warm-up call."""
+    fn()
+    best = float("inf")
+    for _ in range(num_repeats):
+        t_start = time.time()
+        for _ in range(num_iters):
+            fn()
+        best = min(best, (time.time() - t_start) / num_iters)
+    return best
+
+
+def bench_sample(args):
+    print("\n*** Uniform sampling, buffer size {} ***".format(args.size))
+    frame_shape = (84, 84, 1)
+    replay_buffer = fill_buffer(ReplayBuffer(args.size, args.frame_history_len),
+                                args.size + args.size // 3, frame_shape)
+
+    for batch_size in (32, 256, 1024):
+        idxes = np.random.randint(replay_buffer.num_in_buffer - 1, size=batch_size)
+        new = replay_buffer._encode_sample(idxes)
+        old = baseline_encode_sample(replay_buffer, idxes)
+        assert all(np.array_equal(a, b) for a, b in zip(new, old))
+
+        sec_new = timeit(lambda: replay_buffer.sample(batch_size), args.iters)
+        sec_old = timeit(lambda: baseline_sample(replay_buffer, batch_size), args.iters)
+        print("batch {:5d}:  batched {:10.1f} samples/sec,  original {:10.1f} samples/sec,  "
+              "speedup {:.1f}x".format(batch_size, batch_size / sec_new,
+                                       batch_size / sec_old, sec_old / sec_new))
+
+
+def bench_sequence(args):
+    """Uniform sampling of runs of consecutive transitions.
+
+    The buffer has to be much bigger than the CPU caches for this to show,
+    e.g. --size 1000000 (7 GB of frames).
+    """
+    print("\n*** Sequence sampling, buffer size {}, batch size {} ***".format(
+            args.size, args.batch_size))
+    replay_buffer = fill_buffer(ReplayBuffer(args.size, args.frame_history_len),
+                                args.size, (84, 84, 1))
+    for sequence_len in (1, 2, 4, 8, 16, 32):
+        if sequence_len > args.batch_size:
+            break
+        sec = timeit(lambda: replay_buffer.sample(args.batch_size, sequence_len=sequence_len),
+                     args.iters)
+        print("sequence_len {:3d}:  {:10.1f} samples/sec".format(sequence_len, args.batch_size / sec))
+
+
+def bench_prioritized(args):
+    """Cost of one sample + priority update, which should not grow with N.
+
+    Uses small RAM-style observations so the timing is dominated by the
+    sum/min trees, and fills the buffer directly rather than frame by frame.
+    """
+    print("\n*** Prioritized sampling + update, batch size {} ***".format(args.batch_size))
+    for size in (10**4, 10**5, 10**6):
+        replay_buffer = PrioritizedReplayBuffer(size, 1, alpha=0.6)
+        replay_buffer.store_frame(np.zeros(128, dtype=np.uint8))
+        replay_buffer.done[:] = np.random.rand(size) < 0.001
+        replay_buffer.next_idx, replay_buffer.num_in_buffer = 0, size
+        replay_buffer.update_priorities(np.arange(size - 1), np.random.rand(size - 1) + 1e-6)
+
+        def step():
+            idxes = replay_buffer.sample(args.batch_size, beta=0.4)[-1]
+            replay_buffer.update_priorities(idxes, np.random.rand(args.batch_size) + 1e-6)
+        sec = timeit(step, args.iters)
+        print("N = {:8d}:  {:8.1f} usec per sample+update".format(size, sec * 1e6))
+
+
+def bench_ram(args):
+    """Sampling 128-byte RAM observations, against the MLP of `run_dqn_ram.py`.
+
+    The forward pass is done in numpy on the CPU, as a rough lower bound on
+    what one update costs the network.
+    """
+    print("\n*** RAM observations, buffer size {}, batch size {} ***".format(
+            args.size, args.batch_size))
+    for frame_history_len in (1, args.frame_history_len):
+        replay_buffer = fill_buffer(ReplayBuffer(args.size, frame_history_len),
+                                    args.size + args.size // 3, (128,))
+        idxes = np.random.randint(replay_buffer.num_in_buffer - 1, size=args.batch_size)
+        obs, _, _, next_obs, _ = replay_buffer._encode_sample(idxes)
+        obs_old, next_obs_old = per_index_encode_sample(replay_buffer, idxes)
+        assert np.array_equal(obs, obs_old) and np.array_equal(next_obs, next_obs_old)
+
+        layers = [np.random.randn(n_in, n_out).astype(np.float32) / np.sqrt(n_in)
+                  for n_in, n_out in ((128 * frame_history_len, 256), (256, 128), (128, 64), (64, 6))]
+        def forward():
+            out = obs.astype(np.float32) / 255.0
+            for w in layers:
+                out = np.maximum(out.dot(w), 0)
+            return out
+
+        sec_new = timeit(lambda: replay_buffer.sample(args.batch_size), args.iters)
+        sec_mlp = timeit(forward, args.iters)
+        # The original code returned only the latest RAM whatever frame_history_len.
+        if frame_history_len == 1:
+            sec_old = timeit(lambda: baseline_sample(replay_buffer, args.batch_size), args.iters)
+            original = "original {:7.1f} usec".format(sec_old * 1e6)
+        else:
+            original = "original n/a (no RAM history)"
+        print("frame_history_len {}:  batched {:7.1f} usec,  {},  "
+              "MLP forward {:7.1f} usec per minibatch".format(
+                frame_history_len, sec_new * 1e6, original, sec_mlp * 1e6))
+
+
+def bench_compressed(args):
+    """Bytes per frame and sampling throughput of compressed vs raw frames."""
+    print("\n*** Compressed ({}) vs raw frames, buffer size {}, batch size {} ***".format(
+            args.codec, args.size, args.batch_size))
+    raw = ReplayBuffer(args.size, args.frame_history_len)
+    compressed = ReplayBuffer(args.size, args.frame_history_len, frame_codec=args.codec)
+    np.random.seed(args.seed)
+    fill_buffer_synthetic(raw, args.size + args.size // 3)
+    np.random.seed(args.seed)
+    t_start = time.time()
+    fill_buffer_synthetic(compressed, args.size + args.size // 3)
+    fill_sec = time.time() - t_start
+
+    idxes = np.random.randint(raw.num_in_buffer - 1, size=args.batch_size)
+    for x, y in zip(raw._encode_sample(idxes), compressed._encode_sample(idxes)):
+        assert np.array_equal(x, y)
+
+    for name, replay_buffer in (('raw', raw), (args.codec, compressed)):
+        bytes_per_frame = float(replay_buffer.obs.nbytes) / args.size
+        sec = timeit(lambda: replay_buffer.sample(args.batch_size), args.iters)
+        print("{:5s}: {:8.1f} bytes/frame ({:6.2f} GB per 1M frames), {:10.1f} samples/sec".format(
+                name, bytes_per_frame, bytes_per_frame * 1e6 / 2**30, args.batch_size / sec))
+    print("(filling the compressed buffer took {:.1f} usec per frame)".format(
+            fill_sec * 1e6 / (args.size + args.size // 3)))
+
+
+def bench_tf(args):
+    """numpy ReplayBuffer + feed_dict vs TFReplayBuffer, on the CPU.
+
+    Each update runs a trivial op consuming the whole minibatch, so the
+    timing is sampling plus getting the minibatch into the graph.
+    """
+    print("\n*** numpy vs TF replay buffer on CPU, buffer size {}, batch size {} ***".format(
+            args.size, args.batch_size))
+    frame_shape = (84, 84, 1)
+    session = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+    tf_buffer = TFReplayBuffer(args.size, args.frame_history_len, frame_shape,
+                               args.batch_size, session)
+    np_buffer = ReplayBuffer(args.size, args.frame_history_len)
+    num_frames = args.size + args.size // 3
+
+    def consume(obs_t, act_t, rew_t, obs_tp1, done_mask):
+        return (tf.reduce_sum(tf.cast(obs_t, tf.float32)) + tf.reduce_sum(tf.cast(obs_tp1, tf.float32)) +
+                tf.reduce_sum(tf.cast(act_t, tf.float32)) + tf.reduce_sum(rew_t) + tf.reduce_sum(done_mask))
+
+    obs_shape = [None, 84, 84, args.frame_history_len]
+    phs = [tf.placeholder(tf.uint8, obs_shape), tf.placeholder(tf.int32, [None]),
+           tf.placeholder(tf.float32, [None]), tf.placeholder(tf.uint8, obs_shape),
+           tf.placeholder(tf.float32, [None])]
+    np_op = consume(*phs)
+    tf_op = consume(tf_buffer.obs_t, tf_buffer.act_t, tf_buffer.rew_t,
+                    tf_buffer.obs_tp1, tf_buffer.done_mask)
+
+    for name, replay_buffer in (('numpy', np_buffer), ('tf', tf_buffer)):
+        np.random.seed(args.seed)
+        t_start = time.time()
+        fill_buffer(replay_buffer, num_frames, frame_shape)
+        print("{:5s}: {:8.1f} usec per stored transition".format(
+                name, (time.time() - t_start) * 1e6 / num_frames))
+
+    np_update = lambda: session.run(np_op, feed_dict=dict(zip(phs, np_buffer.sample(args.batch_size))))
+    tf_update = lambda: session.run(tf_op)
+    for name, update in (('numpy', np_update), ('tf', tf_update)):
+        update()
+        sec = timeit(update, args.iters)
+        print("{:5s}: {:8.1f} usec per minibatch ({:.1f} minibatches/sec)".format(
+                name, sec * 1e6, 1.0 / sec))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--which', type=str, default='sample',
+                        choices=['sample', 'sequence', 'prioritized', 'compressed', 'tf', 'ram'])
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--frame_history_len', type=int, default=4)
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--codec', type=str, default='zlib', choices=['zlib', 'lz4'])
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    if args.which == 'sample':
+        bench_sample(args)
+    elif args.which == 'sequence':
+        bench_sequence(args)
+    elif args.which == 'prioritized':
+        bench_prioritized(args)
+    elif args.which == 'compressed':
+        bench_compressed(args)
+    elif args.which == 'ram':
+        bench_ram(args)
+    else:
+        bench_tf(args)
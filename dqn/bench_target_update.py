@@ -0,0 +1,92 @@
+"""
+Step-time benchmark for the target network update in `dqn.learn`.
+
+Times training steps of the Atari Q network on random minibatches, under three
+schedules for the target network:
+
+    every-step   the previous schedule: train_fn, then a separate session.run
+                 copying the Q network into the target network (which the old
+                 `if (num_param_updates % target_update_freq)` did on all
+                 updates but every 10,000th)
+    fused-hard   train_fn alone, with the copy fused into the training step's
+                 session.run once every `--target_update_freq` updates
+    fused-polyak Polyak averaging fused into every training step
+
+It also checks that the fused copy sees the weights *after* the gradient step.
+Usage:
+
+    python bench_target_update.py --steps 500
+"""
+
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from dqn import OptimizerSpec
+from dqn_utils import build_dqn_graph, build_update_target_fn
+from run_dqn_atari import atari_model
+
+
+def build(args):
+    optimizer_spec = OptimizerSpec(constructor=tf.train.AdamOptimizer, kwargs={},
+                                   lr_schedule=None)
+    graph = build_dqn_graph(atari_model, (84, 84, 4), args.num_actions, optimizer_spec,
+                            args.batch_size)
+    with tf.control_dependencies([graph.train_fn]):
+        train_and_polyak_fn = build_update_target_fn(
+                graph.q_func_vars, graph.target_q_func_vars, tau=0.001)
+    obs_shape = (args.batch_size, 84, 84, 4)
+    feed = {graph.obs_t_ph: np.random.randint(0, 256, size=obs_shape, dtype=np.uint8),
+            graph.act_t_ph: np.random.randint(args.num_actions, size=args.batch_size),
+            graph.rew_t_ph: np.random.randn(args.batch_size),
+            graph.obs_tp1_ph: np.random.randint(0, 256, size=obs_shape, dtype=np.uint8),
+            graph.done_mask_ph: np.zeros(args.batch_size),
+            graph.learning_rate: 1e-4}
+    return graph.q_func_vars, graph.target_q_func_vars, graph.train_fn, \
+        graph.update_target_fn, graph.train_and_update_target_fn, train_and_polyak_fn, feed
+
+
+def time_steps(session, ops_for_step, feed, num_steps):
+    for t in range(10):
+        for op in ops_for_step(t):
+            session.run(op, feed_dict=feed)
+    t_start = time.time()
+    for t in range(num_steps):
+        for op in ops_for_step(t):
+            session.run(op, feed_dict=feed)
+    return (time.time() - t_start) / num_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_actions', type=int, default=6)
+    parser.add_argument('--target_update_freq', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    tf.set_random_seed(args.seed)
+    q_vars, target_vars, train_fn, update_target_fn, train_and_copy_fn, \
+        train_and_polyak_fn, feed = build(args)
+    session = tf.Session()
+    session.run(tf.global_variables_initializer())
+
+    # The fused copy must read the Q network after the gradient step.
+    session.run(train_and_copy_fn, feed_dict=feed)
+    q_values, target_values = session.run([q_vars, target_vars])
+    assert all(np.array_equal(a, b) for a, b in zip(q_values, target_values)), \
+        "fused copy read the weights from before the gradient step"
+
+    freq = args.target_update_freq
+    schedules = [
+        ('every-step',   lambda t: [train_fn] if (t + 1) % freq == 0 else [train_fn, update_target_fn]),
+        ('fused-hard',   lambda t: [train_and_copy_fn] if (t + 1) % freq == 0 else [train_fn]),
+        ('fused-polyak', lambda t: [train_and_polyak_fn]),
+    ]
+    print("msec per training step (batch {}, {} steps):".format(args.batch_size, args.steps))
+    baseline = None
+    for name, ops_for_step in schedules:
+        sec = time_steps(session, ops_for_step, feed, args.steps)
+        baseline = baseline or sec
+        print("{:12s} {:7.2f} msec  ({:4.2f}x every-step)".format(name, sec * 1e3, baseline / sec))
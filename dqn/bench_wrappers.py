@@ -0,0 +1,123 @@
+"""
+Micro-benchmarks for the frame preprocessing in `atari_wrappers.py`.
+
+Runs the wrappers on a fake environment that replays synthetic 210x160x3
+frames (flat background and a few solid blocks, like Atari screens), so no ALE
+is needed. Usage:
+
+    python bench_wrappers.py
+
+Each wrapper is compared with its previous implementation, which is kept as a
+reference: `_process_frame84` for ProcessFrame84 and the deque version below
+for MaxAndSkipEnv. The benchmark also checks that the results agree.
+"""
+
+import argparse
+import time
+from collections import deque
+import gym
+from gym import spaces
+import numpy as np
+from atari_wrappers import MaxAndSkipEnv, ProcessFrame84, _process_frame84
+
+
+def synthetic_frames(num_frames):
+    frames = np.empty((num_frames, 210, 160, 3), dtype=np.uint8)
+    for frame in frames:
+        frame[:] = np.random.randint(0, 256, size=3)
+        for _ in range(20):
+            y, x = np.random.randint(0, 200), np.random.randint(0, 150)
+            h, w = np.random.randint(2, 30, size=2)
+            frame[y:y + h, x:x + w] = np.random.randint(0, 256, size=3)
+    return frames
+
+
+class FakeAtariEnv(gym.Env):
+    """Cycles through `frames`, ending an episode every `episode_len` steps.
+
+    Returns the frames themselves rather than copies, so that the timings are
+    of the wrappers alone; none of them writes to its input.
+    """
+    def __init__(self, frames, episode_len=1000):
+        self.frames = frames
+        self.episode_len = episode_len
+        self.action_space = spaces.Discrete(6)
+        self.observation_space = spaces.Box(low=0, high=255, shape=frames.shape[1:])
+        self._t = 0
+
+    def _step(self, action):
+        self._t += 1
+        obs = self.frames[self._t % len(self.frames)]
+        return obs, 0.0, self._t % self.episode_len == 0, {}
+
+    def _reset(self):
+        return self.frames[self._t % len(self.frames)]
+
+
+class DequeMaxAndSkipEnv(gym.Wrapper):
+    """The previous MaxAndSkipEnv, which stacks a deque every step."""
+    def __init__(self, env=None, skip=4):
+        super(DequeMaxAndSkipEnv, self).__init__(env)
+        self._obs_buffer = deque(maxlen=2)
+        self._skip       = skip
+
+    def _step(self, action):
+        total_reward = 0.0
+        done = None
+        for _ in range(self._skip):
+            obs, reward, done, info = self.env.step(action)
+            self._obs_buffer.append(obs)
+            total_reward += reward
+            if done:
+                break
+        max_frame = np.max(np.stack(self._obs_buffer), axis=0)
+        return max_frame, total_reward, done, info
+
+    def _reset(self):
+        self._obs_buffer.clear()
+        obs = self.env.reset()
+        self._obs_buffer.append(obs)
+        return obs
+
+
+class FunctionProcessFrame84(ProcessFrame84):
+    """ProcessFrame84 with the previous float32 `_process_frame84`."""
+    def __init__(self, env=None):
+        super(FunctionProcessFrame84, self).__init__(env)
+        self._process_frame84 = _process_frame84
+
+
+def run_steps(env, num_steps):
+    """Steps `env` (resetting when done), returns the observations and frames/sec."""
+    observations = [env.reset()]
+    t_start = time.time()
+    for _ in range(num_steps):
+        obs, _, done, _ = env.step(0)
+        if done:
+            obs = env.reset()
+        observations.append(obs)
+    return observations, num_steps / (time.time() - t_start)
+
+
+def bench_wrapper(name, old_cls, new_cls, frames, args, max_abs_diff):
+    old_obs, old_fps = run_steps(old_cls(FakeAtariEnv(frames, args.episode_len)), args.steps)
+    new_obs, new_fps = run_steps(new_cls(FakeAtariEnv(frames, args.episode_len)), args.steps)
+    diff = max(np.abs(a.astype(np.int32) - b.astype(np.int32)).max()
+               for a, b in zip(old_obs, new_obs))
+    assert diff <= max_abs_diff, "{}: results differ by {}".format(name, diff)
+    print("{:15s}  old {:9.1f} frames/sec,  new {:9.1f} frames/sec,  speedup {:.1f}x,  "
+          "max |diff| {}".format(name, old_fps, new_fps, new_fps / old_fps, diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=10000)
+    parser.add_argument('--episode_len', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    frames = synthetic_frames(64)
+    print("Frames per second of each wrapper alone ({} steps):".format(args.steps))
+    bench_wrapper('ProcessFrame84', FunctionProcessFrame84, ProcessFrame84, frames, args, 1)
+    # MaxAndSkipEnv returns one frame per `skip` steps of the fake env.
+    bench_wrapper('MaxAndSkipEnv', DequeMaxAndSkipEnv, MaxAndSkipEnv, frames, args, 0)
@@ -1,6 +1,6 @@
 import sys
 import time
-import pickle
+import os.path as osp
 import gym.spaces
 import itertools
 import numpy as np
@@ -9,6 +9,7 @@ import tensorflow                as tf
 import tensorflow.contrib.layers as layers
 from collections import namedtuple
 from dqn_utils import *
+from training_log import TrainingLog
 
 OptimizerSpec = namedtuple("OptimizerSpec", ["constructor", "kwargs", "lr_schedule"])
 
@@ -26,7 +27,21 @@ def learn(env,
           frame_history_len=4,
           target_update_freq=10000,
           grad_norm_clipping=10,
-          log_file='./logs_pkls/rewards.pkl'):
+          target_update_tau=None,
+          log_file='./logs_pkls/rewards.pkl',
+          replay_buffer_dir=None,
+          prioritized_replay=False,
+          prioritized_replay_alpha=0.6,
+          prioritized_replay_beta=LinearSchedule(10000000, 1.0, initial_p=0.4),
+          prioritized_replay_eps=1e-6,
+          num_prefetch_batches=0,
+          replay_sequence_len=1,
+          frame_codec=None,
+          tf_replay_buffer=False,
+          save_path=None,
+          checkpoint_dir=None,
+          checkpoint_freq=250000,
+          resume=False):
     """Run Deep Q-learning algorithm.
 
     You can specify your own convnet using q_func.
@@ -70,15 +85,82 @@ def learn(env,
     learning_freq: int
         How many steps of environment to take between every experience replay
     frame_history_len: int
-        How many past frames to include as input to the model.
+        How many past frames to include as input to the model. RAM
+        observations are concatenated end to end.
     target_update_freq: int
         How many experience replay rounds (not steps!) to perform between
         each update to the target Q network
     grad_norm_clipping: float or None
         If not None gradients' norms are clipped to this value.
+    target_update_tau: float or None
+        If None, the Q network is copied to the target Q network every
+        `target_update_freq` updates. Otherwise the target network tracks
+        it with Polyak averaging, target <- (1 - tau) * target + tau * q,
+        after every update, and `target_update_freq` is ignored.
     log_file: string
         Indicates where to save the resulting scores, for plotting later.
+        Scores are appended to `logs_pkls/<log_file without extension>.scores`
+        and `.episodes` as they come in, see training_log.py.
+    replay_buffer_dir: string or None
+        If not None, the replay buffer is memory-mapped from files in this
+        directory instead of held in RAM. It is flushed every
+        LOG_EVERY_N_STEPS steps, and a restarted run pointed at the same
+        directory reopens it instead of refilling `learning_starts` frames.
+    prioritized_replay: bool
+        If True, use a PrioritizedReplayBuffer and sample transitions in
+        proportion to their last TD error, correcting the loss with
+        importance weights.
+    prioritized_replay_alpha: float
+        How much prioritization is used (0 = uniform sampling).
+    prioritized_replay_beta: rl_algs.deepq.utils.schedules.Schedule
+        schedule for the importance-weight exponent, usually annealed to 1.
+    prioritized_replay_eps: float
+        Added to the absolute TD errors so no priority is ever zero.
+    num_prefetch_batches: int
+        If positive, minibatches are sampled on a background thread into a
+        queue holding at most this many, so sampling overlaps with the
+        session.run of the previous update. 0 samples in the training loop.
+    replay_sequence_len: int
+        If more than 1, minibatches are made of runs of this many consecutive
+        transitions from random places in the buffer (see
+        ReplayBuffer.sample), which reads memory more sequentially. 1
+        samples transitions independently.
+    frame_codec: string or None
+        If not None ('zlib' or 'lz4'), replay frames are stored compressed
+        in chunks, which fits several times more frames in the same memory
+        at some cost in sampling speed. Can't be combined with
+        `replay_buffer_dir`.
+    tf_replay_buffer: bool
+        If True, use a TFReplayBuffer, which keeps the replay buffer in
+        TensorFlow variables and samples minibatches inside the graph, so
+        training steps feed nothing but the learning rate. Minibatches are
+        sampled with replacement. Can't be combined with the other replay
+        buffer options above.
+    save_path: string or None
+        If not None, the Q network's variables are saved to this path (with
+        tf.train.Saver) whenever progress is logged, e.g. for eval_dqn.py.
+    checkpoint_dir: string or None
+        If not None, every `checkpoint_freq` steps all global variables (Q
+        and target networks, optimizer slots) are saved here together with
+        `t`, `num_param_updates` and the env step count, by a background
+        thread (see Checkpointer). The schedules only depend on `t`. Use
+        `replay_buffer_dir` as well to also keep the replay buffer, which is
+        flushed at each checkpoint.
+    checkpoint_freq: int
+        Number of steps between checkpoints.
+    resume: bool
+        If True, continue from the checkpoint in `checkpoint_dir`, if any.
+        Without a reopened replay buffer, training waits for
+        `learning_starts` new frames first. The environment itself starts
+        from a reset.
     """
+    assert not tf_replay_buffer or not (prioritized_replay or replay_buffer_dir or
+                                        frame_codec or num_prefetch_batches), \
+        "tf_replay_buffer only supports uniform sampling from RAM."
+    assert replay_sequence_len == 1 or not (prioritized_replay or tf_replay_buffer), \
+        "replay_sequence_len only applies to uniform sampling from a ReplayBuffer."
+    assert 1 <= replay_sequence_len <= batch_size
+    assert not resume or checkpoint_dir is not None, "resume needs a checkpoint_dir."
     assert type(env.observation_space) == gym.spaces.Box
     assert type(env.action_space)      == gym.spaces.Discrete
 
@@ -88,92 +170,99 @@ def learn(env,
 
     if len(env.observation_space.shape) == 1:
         # This means we are running on low-dimensional observations (e.g. RAM)
-        input_shape = env.observation_space.shape
+        input_shape = (frame_history_len * env.observation_space.shape[0],)
     else:
         img_h, img_w, img_c = env.observation_space.shape
         input_shape = (img_h, img_w, frame_history_len * img_c)
     num_actions = env.action_space.n
 
-    # set up placeholders
-    # placeholder for current observation (or state)
-    obs_t_ph              = tf.placeholder(tf.uint8, [None] + list(input_shape))
-    # placeholder for current action
-    act_t_ph              = tf.placeholder(tf.int32,   [None])
-    # placeholder for current reward
-    rew_t_ph              = tf.placeholder(tf.float32, [None])
-    # placeholder for next observation (or state)
-    obs_tp1_ph            = tf.placeholder(tf.uint8, [None] + list(input_shape))
-    # placeholder for end of episode mask
-    # this value is 1 if the next state corresponds to the end of an episode,
-    # in which case there is no Q-value at the next state; at the end of an
-    # episode, only the current state reward contributes to the target, not the
-    # next state Q-value (i.e. target is just rew_t_ph, not rew_t_ph + gamma * q_tp1)
-    done_mask_ph          = tf.placeholder(tf.float32, [None])
+    if tf_replay_buffer:
+        replay_buffer = TFReplayBuffer(replay_buffer_size, frame_history_len,
+                                       env.observation_space.shape, batch_size, session)
 
-    # casting to float on GPU ensures lower data transfer times.
-    obs_t_float   = tf.cast(obs_t_ph,   tf.float32) / 255.0
-    obs_tp1_float = tf.cast(obs_tp1_ph, tf.float32) / 255.0
+    # Placeholders, Q and target networks, Bellman error and training ops.
+    # With a TFReplayBuffer, minibatches come from the graph unless fed.
+    graph = build_dqn_graph(q_func, input_shape, num_actions, optimizer_spec, batch_size,
+                            gamma=gamma, grad_norm_clipping=grad_norm_clipping,
+                            target_update_tau=target_update_tau,
+                            default_minibatch=replay_buffer if tf_replay_buffer else None)
+    obs_t_ph, act_t_ph, rew_t_ph = graph.obs_t_ph, graph.act_t_ph, graph.rew_t_ph
+    obs_tp1_ph, done_mask_ph = graph.obs_tp1_ph, graph.done_mask_ph
+    importance_weights_ph, learning_rate = graph.importance_weights_ph, graph.learning_rate
+    current_net, td_error, q_func_vars = graph.current_net, graph.td_error, graph.q_func_vars
+    # update_target_fn will be called periodically to copy Q network to target
+    # Q network. When the target network is due for an update, it is instead
+    # updated in the same session.run as the training step, right after the
+    # gradient step, with train_and_update_target_fn.
+    train_fn, update_target_fn = graph.train_fn, graph.update_target_fn
+    train_and_update_target_fn = graph.train_and_update_target_fn
 
-    # Here, you should fill in your own code to compute the Bellman error. This requires
-    # evaluating the current and next Q-values and constructing the corresponding error.
-    # TensorFlow will differentiate this error for you, you just need to pass it to the
-    # optimizer. See assignment text for details.
-    # Your code should produce one scalar-valued tensor: total_error
-    # This will be passed to the optimizer in the provided code below.
-    # Your code should also produce two collections of variables:
-    # q_func_vars
-    # target_q_func_vars
-    # These should hold all of the variables of the Q-function network and target network,
-    # respectively. A convenient way to get these is to make use of TF's "scope" feature.
-    # For example, you can create your Q-function network with the scope "q_func" like this:
-    # <something> = q_func(obs_t_float, num_actions, scope="q_func", reuse=False)
-    # And then you can obtain the variables like this:
-    # q_func_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='q_func')
-    # Older versions of TensorFlow may require using "VARIABLES" instead of "GLOBAL_VARIABLES"
-    ######
+    q_func_saver = tf.train.Saver(var_list=q_func_vars) if save_path is not None else None
 
-    # Building the networks. Have current_net so I can also call Q-values.
-    act_one_hot = tf.one_hot(act_t_ph, num_actions, on_value=1.0, off_value=0.0)
-    current_net = q_func(obs_t_float, num_actions, scope="q_func")
-    current_q = tf.reduce_sum(current_net * act_one_hot, axis=1)
-    target_q = tf.reduce_max(q_func(obs_tp1_float, num_actions, scope="target_q_func"), axis=1)
+    # construct the replay buffer (a TFReplayBuffer was built with the placeholders)
+    if prioritized_replay:
+        replay_buffer = PrioritizedReplayBuffer(replay_buffer_size, frame_history_len,
+                                                alpha=prioritized_replay_alpha,
+                                                storage_dir=replay_buffer_dir,
+                                                frame_codec=frame_codec)
+    elif not tf_replay_buffer:
+        replay_buffer = ReplayBuffer(replay_buffer_size, frame_history_len,
+                                     storage_dir=replay_buffer_dir,
+                                     frame_codec=frame_codec)
+    if replay_buffer.num_in_buffer > 0:
+        print("Reopened replay buffer in {} with {} frames.".format(
+                replay_buffer_dir, replay_buffer.num_in_buffer))
+        # The env is reset below, so the previous run's last episode ends
+        # here: its last frame must not be followed by the new first frame.
+        replay_buffer.end_episode()
+        learning_starts = max(0, learning_starts - replay_buffer.num_in_buffer)
 
-    # Now form the loss function and collect variables.
-    target_val = rew_t_ph + (gamma * target_q) * (1 - done_mask_ph)
-    total_error = tf.nn.l2_loss(target_val-current_q) / batch_size
-    q_func_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='q_func')
-    target_q_func_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='target_q_func')
-    ######
+    checkpointer = None
+    resume_state = None
+    if checkpoint_dir is not None:
+        checkpointer = Checkpointer(session, tf.global_variables(), checkpoint_dir)
+        if resume:
+            session.run(tf.variables_initializer(tf.global_variables()))
+            resume_state = checkpointer.restore()
+            if resume_state is None:
+                print("No checkpoint in {}, starting from scratch.".format(checkpoint_dir))
+            else:
+                print("Resuming from {} at step {}.".format(checkpoint_dir, resume_state['next_t']))
+                learning_starts += resume_state['next_t']
 
-    # construct optimization op (with gradient clipping)
-    learning_rate = tf.placeholder(tf.float32, (), name="learning_rate")
-    optimizer = optimizer_spec.constructor(learning_rate=learning_rate, **optimizer_spec.kwargs)
-    train_fn = minimize_and_clip(optimizer, total_error,
-                 var_list=q_func_vars, clip_val=grad_norm_clipping)
-
-    # update_target_fn will be called periodically to copy Q network to target Q network
-    update_target_fn = []
-    for var, var_target in zip(sorted(q_func_vars,        key=lambda v: v.name),
-                               sorted(target_q_func_vars, key=lambda v: v.name)):
-        update_target_fn.append(var_target.assign(var))
-    update_target_fn = tf.group(*update_target_fn)
-
-    # construct the replay buffer
-    replay_buffer = ReplayBuffer(replay_buffer_size, frame_history_len)
+    def sample_minibatch():
+        # Reads the current `t` of the loop below, also from the prefetcher.
+        if prioritized_replay:
+            return replay_buffer.sample(batch_size, beta=prioritized_replay_beta.value(t))
+        return (replay_buffer.sample(batch_size, sequence_len=replay_sequence_len) +
+                (np.ones(batch_size, dtype=np.float32), None))
+    prefetcher = None
 
     ###############
     # RUN ENV     #
     ###############
-    scores_for_log = []
     model_initialized = False
     num_param_updates = 0
-    mean_episode_reward      = -float('nan')
-    best_mean_episode_reward = -float('inf')
+    start_t = 0
+    prior_env_steps = 0
+    training_log_prefix = './logs_pkls/' + osp.splitext(log_file)[0]
+    if resume_state is not None:
+        model_initialized = True
+        num_param_updates = resume_state['num_param_updates']
+        start_t = resume_state['next_t']
+        prior_env_steps = resume_state['env_steps']
+        training_log = TrainingLog(training_log_prefix, resume_t=start_t - 1,
+                                   resume_num_episodes=resume_state['num_episodes'])
+    else:
+        training_log = TrainingLog(training_log_prefix)
+    monitor = get_wrapper_by_name(env, "Monitor")
+    num_monitor_episodes = 0
     last_obs = env.reset() # A numpy structure with shape (height, width, 1).
     LOG_EVERY_N_STEPS = 10000
     t_start = time.time()
+    t_last_log, num_param_updates_last_log = t_start, num_param_updates
 
-    for t in itertools.count():
+    for t in itertools.count(start_t):
         ### 1. Check stopping criterion
         if stopping_criterion is not None and stopping_criterion(env, t):
             break
@@ -225,6 +314,10 @@ def learn(env,
         replay_buffer.store_effect(rb_index, action, reward, done)
         if done:
             obs = env.reset()
+            # The Monitor only records an episode once its env is reset.
+            new_episode_rewards = monitor.get_episode_rewards()[num_monitor_episodes:]
+            num_monitor_episodes += len(new_episode_rewards)
+            training_log.add_episodes(new_episode_rewards)
         last_obs = obs
         #####
 
@@ -273,60 +366,84 @@ def learn(env,
             # you should update every target_update_freq steps, and you may find the
             # variable num_param_updates useful for this (it was initialized to 0)
             #####
-            obs_t_batch, act_batch, rew_batch, obs_tp1_batch, done_mask = \
-                    replay_buffer.sample(batch_size)
+            if tf_replay_buffer:
+                minibatch_feed_dict = {}
+            else:
+                if num_prefetch_batches > 0:
+                    if prefetcher is None:
+                        prefetcher = MinibatchPrefetcher(sample_minibatch, num_prefetch_batches)
+                    minibatch = prefetcher.get()
+                else:
+                    minibatch = sample_minibatch()
+                obs_t_batch, act_batch, rew_batch, obs_tp1_batch, done_mask, weights, idxes = minibatch
+                minibatch_feed_dict = {
+                    obs_t_ph: obs_t_batch,
+                    act_t_ph: act_batch,
+                    rew_t_ph: rew_batch,
+                    obs_tp1_ph: obs_tp1_batch,
+                    done_mask_ph: done_mask,
+                    importance_weights_ph: weights,
+                }
 
             if (not model_initialized):
                 initialize_interdependent_variables(session, tf.global_variables(), {
-                    obs_t_ph: obs_t_batch,
-                    obs_tp1_ph: obs_tp1_batch,
+                    ph: minibatch_feed_dict[ph] for ph in (obs_t_ph, obs_tp1_ph)
+                    if ph in minibatch_feed_dict
                 })
+                session.run(update_target_fn)
                 model_initialized = True
 
-            session.run(train_fn, 
-                        feed_dict = {
-                            obs_t_ph: obs_t_batch,
-                            act_t_ph: act_batch,
-                            rew_t_ph: rew_batch,
-                            obs_tp1_ph: obs_tp1_batch,
-                            done_mask_ph: done_mask,
-                            learning_rate: optimizer_spec.lr_schedule.value(t)
-                        }
-            )
-
             # After some number of xp-replay updates, update the target network.
-            if (num_param_updates % target_update_freq):
-                session.run(update_target_fn)
+            if target_update_tau is not None or \
+                    (num_param_updates + 1) % target_update_freq == 0:
+                train_op = train_and_update_target_fn
+            else:
+                train_op = train_fn
+            minibatch_feed_dict[learning_rate] = optimizer_spec.lr_schedule.value(t)
+            if prioritized_replay:
+                _, td_errors = session.run([train_op, td_error], feed_dict=minibatch_feed_dict)
+                replay_buffer.update_priorities(idxes, np.abs(td_errors) + prioritized_replay_eps)
+            else:
+                session.run(train_op, feed_dict=minibatch_feed_dict)
             num_param_updates += 1
             #####
 
         ### 4. Log progress. 
-        episode_rewards = get_wrapper_by_name(env, "Monitor").get_episode_rewards()
-        if len(episode_rewards) > 0:
-            mean_episode_reward = np.mean(episode_rewards[-100:])
-        if len(episode_rewards) > 100:
-            best_mean_episode_reward = max(best_mean_episode_reward, mean_episode_reward)
+        if t % LOG_EVERY_N_STEPS == 0:
+            replay_buffer.flush()
 
         # Report results, write to file. If case handles very last iteration.
         if ((t % LOG_EVERY_N_STEPS == 0 and model_initialized) or
             (stopping_criterion is not None and stopping_criterion(env,t+1))):
 
-            current_episode_reward = episode_rewards[-1]
             print("\nTimestep: {}".format(t))
-            print("mean reward (100 episodes): {:.4f}".format(mean_episode_reward))
-            print("best mean reward: {:.4f}".format(best_mean_episode_reward))
-            print("current episode reward: {:.4f}".format(current_episode_reward))
-            print("episodes: {}".format(len(episode_rewards)))
+            print("mean reward (100 episodes): {:.4f}".format(training_log.mean_episode_reward))
+            print("best mean reward: {:.4f}".format(training_log.best_mean_episode_reward))
+            print("current episode reward: {:.4f}".format(training_log.last_episode_reward))
+            print("episodes: {}".format(training_log.num_episodes))
             print("exploration: {:.5f}".format(exploration.value(t)))
             print("learning_rate: {:.5f}".format(optimizer_spec.lr_schedule.value(t)))
             seconds = (time.time()-t_start)
             hours = (time.time()-t_start) / (60*60)
             print("elapsed time: {:.1f} seconds ({:.2f} hours)".format(seconds,hours))
+            print("updates/sec: {:.2f}".format(
+                (num_param_updates - num_param_updates_last_log) / (time.time() - t_last_log)))
+            t_last_log, num_param_updates_last_log = time.time(), num_param_updates
             sys.stdout.flush()
-            scores_for_log.append((t, 
-                                   mean_episode_reward, 
-                                   best_mean_episode_reward,
-                                   current_episode_reward))
-            with open('./logs_pkls/'+log_file,'wb') as f:
-                pickle.dump(scores_for_log, f)
-                pickle.dump(episode_rewards, f)
+            training_log.add_scores(t)
+            if q_func_saver is not None:
+                q_func_saver.save(session, save_path)
+
+        if (checkpointer is not None and model_initialized and t > start_t and
+                t % checkpoint_freq == 0):
+            replay_buffer.flush()
+            checkpointer.save({'next_t':            t + 1,
+                               'num_param_updates': num_param_updates,
+                               'env_steps':         prior_env_steps + monitor.get_total_steps(),
+                               'num_episodes':      training_log.num_episodes})
+
+    if checkpointer is not None:
+        checkpointer.close()
+    training_log.close()
+    if prefetcher is not None:
+        prefetcher.stop()
@@ -0,0 +1,325 @@
+"""
+Ape-X style DQN (Horgan et al., 2018): several actor processes step their own
+environments and write into a shared replay buffer, while one learner process
+trains the Q network continuously and periodically publishes its weights.
+
+Each actor owns one segment of the replay buffer (a SharedReplayBuffer), so
+frame histories never mix transitions from different environments. Actors use
+the fixed per-actor epsilons of the Ape-X paper instead of a schedule, and run
+their Q network on the CPU.
+"""
+import ctypes
+import gym.spaces
+import itertools
+import multiprocessing
+import os.path as osp
+import random
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from dqn_utils import *
+from training_log import TrainingLog
+
+
+class SharedWeights(object):
+    def __init__(self, num_weights):
+        """Flat float32 copy of the Q network weights in shared memory, plus
+        a version counter so actors only copy weights that changed."""
+        self._lock = multiprocessing.Lock()
+        self._version = multiprocessing.RawValue(ctypes.c_int64, 0)
+        self._flat = np.frombuffer(multiprocessing.RawArray(ctypes.c_float, int(num_weights)),
+                                   dtype=np.float32)
+
+    def publish(self, flat_weights):
+        with self._lock:
+            self._flat[:] = flat_weights
+            self._version.value += 1
+
+    def fetch(self, last_version):
+        """Returns (version, weights), with weights None if not newer."""
+        with self._lock:
+            if self._version.value == last_version:
+                return last_version, None
+            return self._version.value, self._flat.copy()
+
+
+def _sorted_vars(scope):
+    return sorted(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=scope),
+                  key=lambda v: v.name)
+
+
+def _get_flat(session, variables):
+    return np.concatenate([np.reshape(w, [-1]) for w in session.run(variables)])
+
+
+def _build_flat_setter(variables):
+    """Returns (placeholder, op) assigning a flat weight vector to `variables`."""
+    flat_ph = tf.placeholder(tf.float32, [sum(int(np.prod(v.get_shape().as_list())) for v in variables)])
+    updates = []
+    start = 0
+    for v in variables:
+        shape = v.get_shape().as_list()
+        size = int(np.prod(shape))
+        updates.append(tf.assign(v, tf.reshape(flat_ph[start:start+size], shape)))
+        start += size
+    return flat_ph, tf.group(*updates)
+
+
+def actor_epsilon(actor_id, num_actors, base=0.4, alpha=7.0):
+    """Ape-X exploration: actor i uses base^(1 + alpha * i / (N-1))."""
+    if num_actors == 1:
+        return base
+    return base ** (1.0 + alpha * actor_id / float(num_actors - 1))
+
+
+def _run_actor(actor_id, env_fn, q_func, replay_buffer, shared_weights, epsilon,
+               input_shape, num_actions, env_steps, episode_queue, stop_event,
+               weight_sync_freq, seed):
+    """Body of one actor process."""
+    np.random.seed(seed)
+    random.seed(seed)
+    env = env_fn(actor_id)
+
+    tf.reset_default_graph()
+    tf.set_random_seed(seed)
+    obs_ph = tf.placeholder(tf.uint8, [None] + list(input_shape))
+    q_values = q_func(tf.cast(obs_ph, tf.float32) / 255.0, num_actions, scope="q_func")
+    flat_ph, set_weights_op = _build_flat_setter(_sorted_vars('q_func'))
+    session = tf.Session(config=tf.ConfigProto(
+        inter_op_parallelism_threads=1,
+        intra_op_parallelism_threads=1,
+        device_count={'GPU': 0}))
+    session.run(tf.global_variables_initializer())
+
+    monitor = get_wrapper_by_name(env, "Monitor")
+    num_episodes = 0
+    version = 0
+    last_obs = env.reset()
+
+    for t in itertools.count():
+        if stop_event.is_set():
+            break
+        if t % weight_sync_freq == 0:
+            new_version, flat = shared_weights.fetch(version)
+            if flat is not None:
+                session.run(set_weights_op, {flat_ph: flat})
+                version = new_version
+
+        idx = replay_buffer.store_frame(last_obs)
+        # Act randomly until the learner has published weights once.
+        if version == 0 or np.random.rand() < epsilon:
+            action = np.random.randint(num_actions)
+        else:
+            current_phi = replay_buffer.encode_recent_observation()[None]
+            action = np.argmax(session.run(q_values, {obs_ph: current_phi})[0])
+
+        obs, reward, done, info = env.step(action)
+        replay_buffer.store_effect(idx, action, reward, done)
+        env_steps[actor_id] += 1
+        if done:
+            obs = env.reset()
+            episode_rewards = monitor.get_episode_rewards()
+            for r in episode_rewards[num_episodes:]:
+                episode_queue.put(r)
+            num_episodes = len(episode_rewards)
+        last_obs = obs
+
+    env.close()
+
+
+def _dead_actors(actors):
+    return ["{} (exit code {})".format(i, p.exitcode)
+            for (i, p) in enumerate(actors) if not p.is_alive()]
+
+
+def _stop_actors(actors, stop_event, episode_queue):
+    # Keep draining the queue, since an actor cannot exit with unsent items.
+    stop_event.set()
+    while any(p.is_alive() for p in actors):
+        while not episode_queue.empty():
+            episode_queue.get()
+        for p in actors:
+            p.join(timeout=0.1)
+
+
+def sample_segments(segments, batch_size):
+    """Sample a minibatch across replay buffer segments, proportionally to
+    how many transitions each one holds."""
+    counts = np.array([s.num_in_buffer - 1 for s in segments], dtype=np.float64)
+    per_segment = np.random.multinomial(batch_size, counts / counts.sum())
+    parts = [s.sample(n) for s, n in zip(segments, per_segment) if n > 0]
+    return tuple(np.concatenate(arrays, 0) for arrays in zip(*parts))
+
+
+def learn(env_fn,
+          q_func,
+          optimizer_spec,
+          session_fn,
+          num_actors=4,
+          max_steps=10000000,
+          replay_buffer_size=1000000,
+          batch_size=32,
+          gamma=0.99,
+          learning_starts=50000,
+          frame_history_len=4,
+          target_update_freq=2500,
+          weight_publish_freq=100,
+          weight_sync_freq=400,
+          grad_norm_clipping=10,
+          seed=0,
+          log_file='rewards.pkl',
+          save_path=None):
+    """Run DQN with `num_actors` actor processes and one learner (this process).
+
+    Parameters not listed are as in dqn.learn. Note that `target_update_freq`
+    counts learner updates, and that the learner is not throttled: it trains
+    as fast as it can once every segment holds `learning_starts / num_actors`
+    transitions. If an actor process dies, the others are stopped and
+    RuntimeError is raised.
+
+    Parameters
+    ----------
+    env_fn: int -> gym.Env
+        Makes the (Monitor-wrapped) environment of the actor with this id;
+        each actor should get its own seed and Monitor directory. Also called
+        once with id 0 in this process to read the spaces.
+    session_fn: () -> tf.Session
+        Makes the learner's session. It is called only after the actors are
+        forked, since a process must not fork once TensorFlow has a session.
+    num_actors: int
+        Number of actor processes.
+    max_steps: int
+        Stop after the actors took this many (wrapped) environment steps.
+    weight_publish_freq: int
+        Learner updates between publishing the Q network weights.
+    weight_sync_freq: int
+        Environment steps between an actor's checks for new weights.
+    seed: int
+        Actor i seeds numpy, random and TensorFlow with seed + i.
+    save_path: string or None
+        If not None, the Q network's variables are saved to this path (with
+        tf.train.Saver) whenever progress is logged, e.g. for eval_dqn.py.
+    """
+    probe_env = env_fn(0)
+    assert type(probe_env.observation_space) == gym.spaces.Box
+    assert type(probe_env.action_space)      == gym.spaces.Discrete
+    frame_shape = probe_env.observation_space.shape
+    num_actions = probe_env.action_space.n
+    probe_env.close()
+    if len(frame_shape) == 1:
+        input_shape = (frame_history_len * frame_shape[0],)
+    else:
+        img_h, img_w, img_c = frame_shape
+        input_shape = (img_h, img_w, frame_history_len * img_c)
+
+    # Shared state, all created before forking.
+    segments = [SharedReplayBuffer(replay_buffer_size // num_actors, frame_history_len, frame_shape)
+                for _ in range(num_actors)]
+    with tf.Graph().as_default():
+        q_func(tf.placeholder(tf.float32, [None] + list(input_shape)), num_actions, scope="q_func")
+        num_weights = sum(int(np.prod(v.get_shape().as_list())) for v in _sorted_vars('q_func'))
+    shared_weights = SharedWeights(num_weights)
+    env_steps = np.frombuffer(multiprocessing.RawArray(ctypes.c_int64, num_actors), dtype=np.int64)
+    episode_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+
+    actors = []
+    for i in range(num_actors):
+        epsilon = actor_epsilon(i, num_actors)
+        print("actor {}: epsilon {:.4f}".format(i, epsilon))
+        p = multiprocessing.Process(target=_run_actor, args=(
+                i, env_fn, q_func, segments[i], shared_weights, epsilon, input_shape,
+                num_actions, env_steps, episode_queue, stop_event, weight_sync_freq, seed + i))
+        p.daemon = True
+        p.start()
+        actors.append(p)
+
+    ###############
+    # BUILD MODEL #
+    ###############
+    session = session_fn()
+    graph = build_dqn_graph(q_func, input_shape, num_actions, optimizer_spec, batch_size,
+                            gamma=gamma, grad_norm_clipping=grad_norm_clipping)
+    # Sorted like the actors' variables, for the flat weight vector.
+    q_func_vars = _sorted_vars('q_func')
+    q_func_saver = tf.train.Saver(var_list=graph.q_func_vars) if save_path is not None else None
+    session.run(tf.global_variables_initializer())
+    session.run(graph.update_target_fn)
+    shared_weights.publish(_get_flat(session, q_func_vars))
+
+    ###############
+    # RUN LEARNER #
+    ###############
+    per_segment_start = max(learning_starts // num_actors, batch_size + 1)
+    while min(s.num_in_buffer for s in segments) < per_segment_start:
+        dead_actors = _dead_actors(actors)
+        if dead_actors:
+            _stop_actors(actors, stop_event, episode_queue)
+            raise RuntimeError("Actor {} died.".format(", ".join(dead_actors)))
+        time.sleep(1.0)
+
+    training_log = TrainingLog('./logs_pkls/' + osp.splitext(log_file)[0])
+    LOG_EVERY_N_SECONDS = 60
+    CHECK_ACTORS_EVERY_N_SECONDS = 5
+    t_start = t_last_log = t_last_check = time.time()
+    dead_actors = []
+    steps_last_log = updates_last_log = 0
+
+    for num_param_updates in itertools.count():
+        steps = int(env_steps.sum())
+        if steps >= max_steps:
+            break
+        # Without its actors the buffer stops growing, and so does `steps`.
+        if time.time() - t_last_check > CHECK_ACTORS_EVERY_N_SECONDS:
+            dead_actors = _dead_actors(actors)
+            if dead_actors:
+                break
+            t_last_check = time.time()
+
+        obs_t_batch, act_batch, rew_batch, obs_tp1_batch, done_mask = \
+                sample_segments(segments, batch_size)
+        # As in dqn.learn, the target network is updated right after every
+        # target_update_freq-th gradient step, in the same session.run.
+        if (num_param_updates + 1) % target_update_freq == 0:
+            train_op = graph.train_and_update_target_fn
+        else:
+            train_op = graph.train_fn
+        session.run(train_op, feed_dict={
+            graph.obs_t_ph: obs_t_batch,
+            graph.act_t_ph: act_batch,
+            graph.rew_t_ph: rew_batch,
+            graph.obs_tp1_ph: obs_tp1_batch,
+            graph.done_mask_ph: done_mask,
+            graph.learning_rate: optimizer_spec.lr_schedule.value(steps)
+        })
+        if num_param_updates % weight_publish_freq == 0:
+            shared_weights.publish(_get_flat(session, q_func_vars))
+
+        if time.time() - t_last_log > LOG_EVERY_N_SECONDS:
+            new_episode_rewards = []
+            while not episode_queue.empty():
+                new_episode_rewards.append(episode_queue.get())
+            training_log.add_episodes(new_episode_rewards)
+            if training_log.num_episodes == 0:
+                continue
+            now = time.time()
+            print("\nEnv steps: {}".format(steps))
+            print("updates: {}".format(num_param_updates))
+            print("mean reward (100 episodes): {:.4f}".format(training_log.mean_episode_reward))
+            print("best mean reward: {:.4f}".format(training_log.best_mean_episode_reward))
+            print("episodes: {}".format(training_log.num_episodes))
+            print("env steps/sec: {:.1f}".format((steps - steps_last_log) / (now - t_last_log)))
+            print("updates/sec: {:.2f}".format((num_param_updates - updates_last_log) / (now - t_last_log)))
+            print("elapsed time: {:.2f} hours".format((now - t_start) / (60*60)))
+            sys.stdout.flush()
+            t_last_log, steps_last_log, updates_last_log = now, steps, num_param_updates
+            training_log.add_scores(steps)
+            if q_func_saver is not None:
+                q_func_saver.save(session, save_path)
+
+    training_log.close()
+    _stop_actors(actors, stop_event, episode_queue)
+    if dead_actors:
+        raise RuntimeError("Actor {} died, training stopped after {} updates.".format(
+                ", ".join(dead_actors), num_param_updates))
@@ -1,9 +1,23 @@
 """This file includes a collection of utility functions that are useful for
 implementing DQN."""
+import ctypes
 import gym
+import json
+import multiprocessing
+import os
 import tensorflow as tf
 import numpy as np
-import random
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 def huber_loss(x, delta=1.0):
     # https://en.wikipedia.org/wiki/Huber_loss
@@ -13,15 +27,19 @@ def huber_loss(x, delta=1.0):
         delta * (tf.abs(x) - 0.5 * delta)
     )
 
-def sample_n_unique(sampling_f, n):
-    """Helper function. Given a function `sampling_f` that returns
-    comparable objects, sample n such unique objects.
+def sample_n_unique_ints(high, n):
+    """Sample n unique integers from [0, high), returned as a sorted np.array.
+
+    Uniform over n-subsets, like drawing integers one at a time and
+    rejecting repeats, but draws whole batches and deduplicates with
+    `np.unique`, so the cost is O(n log n) rather than O(n^2), and
+    independent of `high`.
     """
-    res = []
+    assert n <= high
+    res = np.unique(np.random.randint(high, size=n))
     while len(res) < n:
-        candidate = sampling_f()
-        if candidate not in res:
-            res.append(candidate)
+        extra = np.random.randint(high, size=n - len(res))
+        res = np.unique(np.concatenate([res, extra]))
     return res
 
 class Schedule(object):
@@ -138,6 +156,96 @@ def minimize_and_clip(optimizer, objective, var_list, clip_val=10):
             gradients[i] = (tf.clip_by_norm(grad, clip_val), var)
     return optimizer.apply_gradients(gradients)
 
+def build_update_target_fn(q_func_vars, target_q_func_vars, tau=None):
+    """Op copying the Q network to the target Q network, or with `tau`,
+    moving the target towards it: target <- (1 - tau) * target + tau * q.
+
+    The variables are read with `read_value()`, so when this is built under
+    `tf.control_dependencies([train_fn])` the reads happen after the
+    gradient step. (Reading the ref variables directly would not be ordered
+    by the control dependency, and could copy the weights from before it.)
+    """
+    update_target_fn = []
+    for var, var_target in zip(sorted(q_func_vars,        key=lambda v: v.name),
+                               sorted(target_q_func_vars, key=lambda v: v.name)):
+        if tau is None:
+            update_target_fn.append(var_target.assign(var.read_value()))
+        else:
+            update_target_fn.append(var_target.assign(
+                    (1.0 - tau) * var_target.read_value() + tau * var.read_value()))
+    return tf.group(*update_target_fn)
+
+DQNGraph = namedtuple("DQNGraph", [
+        "obs_t_ph", "act_t_ph", "rew_t_ph", "obs_tp1_ph", "done_mask_ph",
+        "importance_weights_ph", "learning_rate", "current_net", "td_error",
+        "total_error", "q_func_vars", "target_q_func_vars", "train_fn",
+        "update_target_fn", "train_and_update_target_fn"])
+
+def build_dqn_graph(q_func, input_shape, num_actions, optimizer_spec, batch_size,
+                    gamma=0.99, grad_norm_clipping=10, target_update_tau=None,
+                    default_minibatch=None):
+    """Build the DQN placeholders, the Q and target Q networks (in scopes
+    "q_func" and "target_q_func"), the Bellman error and the training and
+    target update ops. Shared by dqn.learn and dqn_apex.learn.
+
+    The loss is the importance-weighted squared TD error over 2 * batch_size;
+    `importance_weights_ph` defaults to all ones. `update_target_fn` copies the
+    Q network to the target network, and `train_and_update_target_fn` takes a
+    gradient step and then copies (or with `target_update_tau`, moves) the
+    target network towards the updated Q network, see build_update_target_fn.
+
+    If `default_minibatch` is given (e.g. a TFReplayBuffer), the minibatch
+    placeholders default to its obs_t, act_t, rew_t, obs_tp1 and done_mask
+    tensors unless they are fed.
+
+    Returns a DQNGraph.
+    """
+    def minibatch_placeholder(name, dtype, shape):
+        if default_minibatch is not None:
+            return tf.placeholder_with_default(getattr(default_minibatch, name), shape)
+        return tf.placeholder(dtype, shape)
+
+    obs_t_ph              = minibatch_placeholder('obs_t', tf.uint8, [None] + list(input_shape))
+    act_t_ph              = minibatch_placeholder('act_t', tf.int32,   [None])
+    rew_t_ph              = minibatch_placeholder('rew_t', tf.float32, [None])
+    obs_tp1_ph            = minibatch_placeholder('obs_tp1', tf.uint8, [None] + list(input_shape))
+    # 1 if the next state ends the episode, in which case the target is just
+    # the reward, with no Q-value of the next state.
+    done_mask_ph          = minibatch_placeholder('done_mask', tf.float32, [None])
+    # importance weights for prioritized replay; all ones when not fed
+    importance_weights_ph = tf.placeholder_with_default(tf.ones_like(rew_t_ph), [None])
+
+    # casting to float on GPU ensures lower data transfer times.
+    obs_t_float   = tf.cast(obs_t_ph,   tf.float32) / 255.0
+    obs_tp1_float = tf.cast(obs_tp1_ph, tf.float32) / 255.0
+
+    act_one_hot = tf.one_hot(act_t_ph, num_actions, on_value=1.0, off_value=0.0)
+    current_net = q_func(obs_t_float, num_actions, scope="q_func")
+    current_q = tf.reduce_sum(current_net * act_one_hot, axis=1)
+    target_q = tf.reduce_max(q_func(obs_tp1_float, num_actions, scope="target_q_func"), axis=1)
+
+    target_val = rew_t_ph + (gamma * target_q) * (1 - done_mask_ph)
+    td_error = target_val - current_q
+    total_error = tf.reduce_sum(importance_weights_ph * tf.square(td_error)) / (2.0 * batch_size)
+    q_func_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='q_func')
+    target_q_func_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='target_q_func')
+
+    # construct optimization op (with gradient clipping)
+    learning_rate = tf.placeholder(tf.float32, (), name="learning_rate")
+    optimizer = optimizer_spec.constructor(learning_rate=learning_rate, **optimizer_spec.kwargs)
+    train_fn = minimize_and_clip(optimizer, total_error,
+                 var_list=q_func_vars, clip_val=grad_norm_clipping)
+
+    update_target_fn = build_update_target_fn(q_func_vars, target_q_func_vars)
+    with tf.control_dependencies([train_fn]):
+        train_and_update_target_fn = build_update_target_fn(
+                q_func_vars, target_q_func_vars, tau=target_update_tau)
+
+    return DQNGraph(obs_t_ph, act_t_ph, rew_t_ph, obs_tp1_ph, done_mask_ph,
+                    importance_weights_ph, learning_rate, current_net, td_error,
+                    total_error, q_func_vars, target_q_func_vars, train_fn,
+                    update_target_fn, train_and_update_target_fn)
+
 def initialize_interdependent_variables(session, vars_list, feed_dict):
     """Initialize a list of variables one at a time, which is useful if
     initialization of some variables depends on initialization of the others.
@@ -172,7 +280,7 @@ def get_wrapper_by_name(env, classname):
             raise ValueError("Couldn't find wrapper named %s"%classname)
 
 class ReplayBuffer(object):
-    def __init__(self, size, frame_history_len):
+    def __init__(self, size, frame_history_len, storage_dir=None, frame_codec=None):
         """This is a memory efficient implementation of the replay buffer.
 
         The sepecific memory optimizations use here are:
@@ -197,9 +305,25 @@ class ReplayBuffer(object):
             overflows the old memories are dropped.
         frame_history_len: int
             Number of memories to be retried for each observation.
+        storage_dir: str or None
+            If not None, obs/action/reward/done are stored as `np.memmap`-ed
+            .npy files in this directory, so the OS page cache (rather than
+            the process) decides which parts of the buffer stay in RAM. If
+            the directory already holds a buffer saved by `flush`, it is
+            reopened, which lets a restarted run skip refilling the buffer.
+        frame_codec: str or None
+            If not None ('zlib' or 'lz4'), frames are kept compressed in
+            chunks by a CompressedFrameStore, at the cost of slower sampling.
         """
+        assert storage_dir is None or frame_codec is None, \
+            "Compressed frames can not be memory-mapped."
         self.size = size
         self.frame_history_len = frame_history_len
+        self.storage_dir = storage_dir
+        self.frame_codec = frame_codec
+        # Guards writes against sampling from another thread (see
+        # MinibatchPrefetcher); uncontended, it costs next to nothing.
+        self._lock = threading.RLock()
 
         self.next_idx      = 0
         self.num_in_buffer = 0
@@ -208,22 +332,37 @@ class ReplayBuffer(object):
         self.action   = None
         self.reward   = None
         self.done     = None
+        # Unless compressed, `obs` is a view of `_obs_storage` starting at its
+        # frame `_obs_pad`; the first `_obs_pad` (= frame_history_len - 1)
+        # frames of `_obs_storage` mirror the last ones of `obs`, so every
+        # frame history is `_obs_storage[idx:idx + frame_history_len]`, and
+        # `_obs_windows[idx]` is that same history, as a strided view.
+        self._obs_storage = None
+        self._obs_pad     = 0
+        self._obs_scratch = None
+        self._obs_windows = None
+
+        if storage_dir is not None and os.path.exists(self._storage_path('meta.json')):
+            self._reopen_storage()
 
     def can_sample(self, batch_size):
         """Returns true if `batch_size` different transitions can be sampled from the buffer."""
         return batch_size + 1 <= self.num_in_buffer
 
     def _encode_sample(self, idxes):
-        obs_batch      = np.concatenate([self._encode_observation(idx)[None] for idx in idxes], 0)
+        idxes          = np.asarray(idxes)
+        # obs_t and obs_tp1 of the whole minibatch in one gather.
+        both_obs       = self._encode_observations(np.concatenate([idxes, idxes + 1]))
+        obs_batch      = both_obs[:len(idxes)]
         act_batch      = self.action[idxes]
         rew_batch      = self.reward[idxes]
-        next_obs_batch = np.concatenate([self._encode_observation(idx + 1)[None] for idx in idxes], 0)
-        done_mask      = np.array([1.0 if self.done[idx] else 0.0 for idx in idxes], dtype=np.float32)
+        next_obs_batch = both_obs[len(idxes):]
+        done_mask      = self.done[idxes].astype(np.float32)
 
         return obs_batch, act_batch, rew_batch, next_obs_batch, done_mask
 
 
-    def sample(self, batch_size):
+    def sample(self, batch_size, sequence_len=1):
         """Sample `batch_size` different transitions.
 
         i-th sample transition is the following:
@@ -238,13 +377,21 @@ class ReplayBuffer(object):
         ----------
         batch_size: int
             How many transitions to sample.
+        sequence_len: int
+            If more than 1, sample ceil(batch_size / sequence_len) different
+            starting transitions and take `sequence_len` consecutive
+            transitions from each (the last sequence may be cut short).
+            Frames are then read from fewer, contiguous places in memory, and
+            neighbouring observations share most of them. Sequences can
+            overlap, and transitions within a minibatch are correlated.
 
         Returns
         -------
         obs_batch: np.array
             Array of shape
             (batch_size, img_h, img_w, img_c * frame_history_len)
-            and dtype np.uint8
+            and dtype np.uint8, or (batch_size, ram_size * frame_history_len)
+            for RAM observations
         act_batch: np.array
             Array of shape (batch_size,) and dtype np.int32
         rew_batch: np.array
@@ -256,19 +403,31 @@ class ReplayBuffer(object):
         done_mask: np.array
             Array of shape (batch_size,) and dtype np.float32
         """
-        assert self.can_sample(batch_size)
-        idxes = sample_n_unique(lambda: random.randint(0, self.num_in_buffer - 2), batch_size)
-        return self._encode_sample(idxes)
+        with self._lock:
+            assert self.can_sample(batch_size)
+            if sequence_len > 1:
+                num_sequences = -(-batch_size // sequence_len)
+                starts = sample_n_unique_ints(self.num_in_buffer - sequence_len, num_sequences)
+                idxes = (starts[:, None] + np.arange(sequence_len)).ravel()[:batch_size]
+            else:
+                idxes = sample_n_unique_ints(self.num_in_buffer - 1, batch_size)
+            return self._encode_sample(idxes)
 
     def encode_recent_observation(self):
         """Return the most recent `frame_history_len` frames.
 
+        With single-channel frames this allocates nothing: the result is a
+        view of the buffer, or of a scratch array reused by the next call
+        when it needs zero padding. Copy it to keep it around.
+
         Returns
         -------
         observation: np.array
             Array of shape (img_h, img_w, img_c * frame_history_len)
             and dtype np.uint8, where observation[:, :, i*img_c:(i+1)*img_c]
-            encodes frame at time `t - frame_history_len + i`
+            encodes frame at time `t - frame_history_len + i`. For RAM
+            observations the frames are concatenated, giving shape
+            (ram_size * frame_history_len,).
         """
         assert self.num_in_buffer > 0
         return self._encode_observation((self.next_idx - 1) % self.size)
@@ -277,8 +436,8 @@ class ReplayBuffer(object):
         end_idx   = idx + 1 # make noninclusive
         start_idx = end_idx - self.frame_history_len
         # this checks if we are using low-dimensional observations, such as RAM
-        # state, in which case we just directly return the latest RAM.
-        if len(self.obs.shape) == 2:
+        # state, without history, in which case we just directly return the latest RAM.
+        if len(self.obs.shape) == 2 and self.frame_history_len == 1:
             return self.obs[end_idx-1]
         # if there weren't enough frames ever in the buffer for context
         if start_idx < 0 and self.num_in_buffer != self.size:
@@ -287,17 +446,72 @@ class ReplayBuffer(object):
             if self.done[idx % self.size]:
                 start_idx = idx + 1
         missing_context = self.frame_history_len - (end_idx - start_idx)
+        if self._obs_pad > 0:
+            return self._encode_padded_observation((end_idx - 1) % self.size, missing_context)
         # if zero padding is needed for missing context
         # or we are on the boundry of the buffer
         if start_idx < 0 or missing_context > 0:
             frames = [np.zeros_like(self.obs[0]) for _ in range(missing_context)]
             for idx in range(start_idx, end_idx):
                 frames.append(self.obs[idx % self.size])
-            return np.concatenate(frames, 2)
+            return self._stack_history(np.stack(frames))
         else:
             # this optimization has potential to saves about 30% compute time \o/
-            img_h, img_w = self.obs.shape[1], self.obs.shape[2]
-            return self.obs[start_idx:end_idx].transpose(1, 2, 0, 3).reshape(img_h, img_w, -1)
+            return self._stack_history(self.obs[start_idx:end_idx])
+
+    def _encode_padded_observation(self, idx, missing_context):
+        # obs[idx] is _obs_storage[idx + frame_history_len - 1], so its history
+        # starts at _obs_storage[idx], mirrored frames included.
+        frames = self._obs_storage[idx:idx + self.frame_history_len]
+        if missing_context > 0:
+            self._obs_scratch[:missing_context] = 0
+            self._obs_scratch[missing_context:] = frames[missing_context:]
+            frames = self._obs_scratch
+        return self._stack_history(frames)
+
+    def _encode_observations(self, idxes):
+        """Batched `_encode_observation`, returns the same values for each idx.
+
+        All `frame_history_len` frames of every observation are gathered with
+        one fancy-indexing operation, and frames that lie before an episode
+        boundary (or before the start of a not-yet-full buffer) are zeroed with
+        a validity mask computed from `self.done`, instead of branching per
+        index.
+        """
+        if self.frame_history_len == 1:
+            # Nothing to mask: the last frame always belongs to the observation.
+            return self._stack_history(self.obs[idxes % self.size][:, None])
+        # offsets[i, j] is the j-th frame (oldest first) of the i-th observation.
+        offsets = idxes[:, None] + np.arange(1 - self.frame_history_len, 1)
+        # A frame is dropped if it, or any later frame except the last one,
+        # ended an episode. Reversed cumulative OR spreads a done leftwards.
+        dones = self.done[offsets[:, :-1] % self.size]
+        valid = np.ones(offsets.shape, dtype=np.bool)
+        valid[:, :-1] = ~np.logical_or.accumulate(dones[:, ::-1], axis=1)[:, ::-1]
+        # if there weren't enough frames ever in the buffer for context
+        if self.num_in_buffer != self.size:
+            valid &= offsets >= 0
+        if self._obs_windows is not None:
+            # One row per observation, no wrap-around in the padded layout.
+            frames = self._obs_windows[idxes % self.size]
+        else:
+            frames = self.obs[offsets % self.size]
+        frames[~valid] = 0
+        return self._stack_history(frames)
+
+    def _stack_history(self, frames):
+        """Turns frames of shape (..., frame_history_len) + frame_shape into
+        stacked observations: image frames are concatenated along the
+        channels, RAM frames end to end. Returns a view when it can, e.g.
+        always for RAM or single-channel frames.
+        """
+        lead = frames.shape[:-len(self.obs.shape)]
+        if len(self.obs.shape) == 2:
+            return frames.reshape(lead + (-1,))
+        n = len(lead)
+        img_h, img_w = self.obs.shape[1], self.obs.shape[2]
+        axes = tuple(range(n)) + (n + 1, n + 2, n, n + 3)
+        return frames.transpose(axes).reshape(lead + (img_h, img_w, -1))
 
     def store_frame(self, frame):
         """Store a single frame in the buffer at the next available index, overwriting
@@ -314,18 +528,19 @@ class ReplayBuffer(object):
         idx: int
             Index at which the frame is stored. To be used for `store_effect` later.
         """
-        if self.obs is None:
-            self.obs      = np.empty([self.size] + list(frame.shape), dtype=np.uint8)
-            self.action   = np.empty([self.size],                     dtype=np.int32)
-            self.reward   = np.empty([self.size],                     dtype=np.float32)
-            self.done     = np.empty([self.size],                     dtype=np.bool)
-        self.obs[self.next_idx] = frame
+        with self._lock:
+            if self.obs is None:
+                self._allocate(frame.shape)
+            self.obs[self.next_idx] = frame
+            mirror_idx = self.next_idx - (self.size - self._obs_pad)
+            if mirror_idx >= 0:
+                self._obs_storage[mirror_idx] = frame
 
-        ret = self.next_idx
-        self.next_idx = (self.next_idx + 1) % self.size
-        self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
+            ret = self.next_idx
+            self.next_idx = (self.next_idx + 1) % self.size
+            self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
 
-        return ret
+            return ret
 
     def store_effect(self, idx, action, reward, done):
         """Store effects of action taken after observing frame stored at index
@@ -344,7 +559,742 @@ class ReplayBuffer(object):
         done: bool
             True if episode was finished after performing that action.
         """
-        self.action[idx] = action
-        self.reward[idx] = reward
-        self.done[idx]   = done
+        with self._lock:
+            self.action[idx] = action
+            self.reward[idx] = reward
+            self.done[idx]   = done
+
+    def end_episode(self):
+        """Mark the most recent transition as the last of its episode, for
+        when the environment is reset although it wasn't done, e.g. when a
+        run resumes from a reopened buffer. Its effect must already be
+        stored. Does nothing for an empty buffer.
+        """
+        with self._lock:
+            if self.num_in_buffer > 0:
+                self.done[(self.next_idx - 1) % self.size] = True
+
+    def flush(self):
+        """Write a disk-backed buffer to its `storage_dir` so that it can be
+        reopened later. Transitions stored after the last flush are lost if
+        the process dies. Does nothing for an in-memory buffer.
+        """
+        if self.storage_dir is None or self.obs is None:
+            return
+        with self._lock:
+            for arr in (self._obs_storage, self.action, self.reward, self.done):
+                arr.flush()
+            meta = {'size':          self.size,
+                    'next_idx':      self.next_idx,
+                    'num_in_buffer': self.num_in_buffer,
+                    'frame_shape':   list(self.obs.shape[1:])}
+        # Write then rename, so a crash never leaves a half-written meta file.
+        with open(self._storage_path('meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(self._storage_path('meta.json.tmp'), self._storage_path('meta.json'))
+
+    def _allocate(self, frame_shape):
+        pad = 0
+        if self.frame_codec is None:
+            pad = self.frame_history_len - 1
+        shapes = {'obs':    ([self.size + pad] + list(frame_shape), np.uint8),
+                  'action': ([self.size],                           np.int32),
+                  'reward': ([self.size],                           np.float32),
+                  'done':   ([self.size],                           np.bool)}
+        for name, (shape, dtype) in shapes.items():
+            setattr(self, name, self._new_array(name, shape, dtype))
+        self._set_obs_storage(self.obs)
+
+    def _set_obs_storage(self, obs_storage):
+        self._obs_storage = obs_storage
+        self._obs_pad = len(obs_storage) - self.size
+        self.obs = obs_storage[self._obs_pad:] if self._obs_pad > 0 else obs_storage
+        if self._obs_pad > 0:
+            self._obs_scratch = np.empty((self.frame_history_len,) + self.obs.shape[1:],
+                                         dtype=np.uint8)
+        if isinstance(obs_storage, np.ndarray) and self._obs_pad == self.frame_history_len - 1:
+            # Windows of frame_history_len consecutive frames, overlapping in
+            # memory: gathering rows of this copies each history at once.
+            self._obs_windows = np.lib.stride_tricks.as_strided(
+                obs_storage, shape=(self.size, self.frame_history_len) + self.obs.shape[1:],
+                strides=obs_storage.strides[:1] + obs_storage.strides, writeable=False)
+
+    def _new_array(self, name, shape, dtype):
+        if name == 'obs' and self.frame_codec is not None:
+            return CompressedFrameStore(shape[0], shape[1:], codec=self.frame_codec)
+        if self.storage_dir is None:
+            return np.empty(shape, dtype=dtype)
+        if not os.path.exists(self.storage_dir):
+            os.makedirs(self.storage_dir)
+        return np.lib.format.open_memmap(self._storage_path(name + '.npy'),
+                                         mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def _reopen_storage(self):
+        with open(self._storage_path('meta.json'), 'r') as f:
+            meta = json.load(f)
+        assert meta['size'] == self.size, \
+            "Buffer in {} has size {}, not {}".format(self.storage_dir, meta['size'], self.size)
+        for name in ('obs', 'action', 'reward', 'done'):
+            setattr(self, name, np.load(self._storage_path(name + '.npy'), mmap_mode='r+'))
+        if len(self.obs) != self.size + self.frame_history_len - 1:
+            # Saved without padding, or with another frame_history_len.
+            self.obs = self.obs[len(self.obs) - self.size:]
+        self._set_obs_storage(self.obs)
+        self.next_idx      = meta['next_idx']
+        self.num_in_buffer = meta['num_in_buffer']
+
+    def _storage_path(self, name):
+        return os.path.join(self.storage_dir, name)
+
+
+class SegmentTree(object):
+    def __init__(self, capacity, operation, neutral_element):
+        """Array-based segment tree, with every operation vectorized over a
+        whole batch of indices.
+
+        Node 1 is the root, node i has children 2i and 2i+1, and the leaves
+        (the values the user sets) live at nodes `capacity .. 2*capacity-1`.
+
+        Parameters
+        ----------
+        capacity: int
+            Number of leaves, must be a power of two.
+        operation: np.ufunc
+            Associative binary operation combining two children, e.g.
+            `np.add` or `np.minimum`.
+        neutral_element: float
+            Neutral element of `operation`, e.g. 0 for sum, inf for min.
+        """
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be a power of 2"
+        self._capacity = capacity
+        self._operation = operation
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
+
+    def update(self, idxes, values):
+        """Set leaves `idxes` to `values`, then recompute their ancestors one
+        tree level at a time, so a minibatch costs O(batch_size * log N)."""
+        nodes = np.asarray(idxes) + self._capacity
+        if len(nodes) == 0:
+            return
+        self._value[nodes] = values
+        # Duplicate parents just recompute the same value, which is cheaper
+        # than deduplicating at every level.
+        while nodes[0] > 1:
+            nodes = nodes // 2
+            self._value[nodes] = self._operation(self._value[2 * nodes],
+                                                 self._value[2 * nodes + 1])
+
+    def reduce(self):
+        """Result of `operation` over all leaves."""
+        return self._value[1]
+
+    def __getitem__(self, idxes):
+        return self._value[np.asarray(idxes) + self._capacity]
+
+class SumSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumSegmentTree, self).__init__(capacity, np.add, 0.0)
+
+    def sum(self):
+        return self.reduce()
+
+    def find_prefixsum_idx(self, prefixsums):
+        """For each `prefixsum`, find the highest index i such that
+        sum(leaves[:i]) <= prefixsum, by walking down the tree for the whole
+        batch at once in O(log N) vectorized steps.
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(len(prefixsums), dtype=np.int64)
+        while nodes[0] < self._capacity:
+            left = 2 * nodes
+            go_right = prefixsums > self._value[left]
+            prefixsums -= self._value[left] * go_right
+            nodes = left + go_right
+        return nodes - self._capacity
+
+class MinSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinSegmentTree, self).__init__(capacity, np.minimum, float('inf'))
+
+    def min(self):
+        return self.reduce()
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self, size, frame_history_len, alpha, **kwargs):
+        """Replay buffer sampling transitions with probability proportional
+        to priority^alpha, as in Prioritized Experience Replay (Schaul et al.).
+
+        Priorities live in a sum-tree (for O(log N) proportional sampling)
+        and a min-tree (for the largest importance weight, used to normalize
+        the others). New transitions get the largest priority seen so far.
+        Transition idx only becomes sampleable once frame idx+1 is stored,
+        since before that it has no next observation.
+
+        Parameters
+        ----------
+        size, frame_history_len, **kwargs:
+            See ReplayBuffer.
+        alpha: float
+            How much prioritization is used (0 = uniform sampling).
+        """
+        super(PrioritizedReplayBuffer, self).__init__(size, frame_history_len, **kwargs)
+        assert alpha >= 0
+        self._alpha = alpha
+        self._max_priority = 1.0
+
+        capacity = 1
+        while capacity < size:
+            capacity *= 2
+        self._sum_tree = SumSegmentTree(capacity)
+        self._min_tree = MinSegmentTree(capacity)
+
+        # A buffer reopened from disk comes back without priorities.
+        if self.num_in_buffer > 1:
+            idxes = np.arange(self.num_in_buffer)
+            idxes = idxes[idxes != (self.next_idx - 1) % self.size]
+            self._set_priorities(idxes, self._max_priority ** self._alpha)
+
+    def store_frame(self, frame):
+        """See ReplayBuffer.store_frame"""
+        with self._lock:
+            idx = super(PrioritizedReplayBuffer, self).store_frame(frame)
+            # The transition ending in the overwritten frame is gone, and the
+            # one before it now has its next observation.
+            self._set_priorities([idx], 0.0)
+            if self.num_in_buffer > 1:
+                self._set_priorities([(idx - 1) % self.size], self._max_priority ** self._alpha)
+            return idx
+
+    def sample(self, batch_size, beta):
+        """Sample `batch_size` transitions proportionally to their priority.
+
+        The total priority mass is split into `batch_size` equal segments and
+        one transition is drawn from each, so the batch is stratified. Unlike
+        ReplayBuffer.sample, the same transition may appear twice.
+
+        Parameters
+        ----------
+        batch_size: int
+            How many transitions to sample.
+        beta: float
+            To what degree to use importance weights
+            (0 = no corrections, 1 = full correction).
+
+        Returns
+        -------
+        obs_batch, act_batch, rew_batch, next_obs_batch, done_mask:
+            See ReplayBuffer.sample
+        weights: np.array
+            Array of shape (batch_size,) and dtype np.float32 with the
+            importance weight of each sampled transition, normalized so
+            that the largest possible weight is 1.
+        idxes: np.array
+            Array of shape (batch_size,) and dtype np.int64, the buffer
+            indices to pass back to `update_priorities`.
+        """
+        assert beta > 0
+        with self._lock:
+            assert self.can_sample(batch_size)
+            total = self._sum_tree.sum()
+            prefixsums = (np.arange(batch_size) + np.random.rand(batch_size)) * (total / batch_size)
+            idxes = self._sum_tree.find_prefixsum_idx(prefixsums)
+
+            num_valid = self.num_in_buffer - 1
+            p_min = self._min_tree.min() / total
+            max_weight = (p_min * num_valid) ** (-beta)
+            p_sample = self._sum_tree[idxes] / total
+            weights = ((p_sample * num_valid) ** (-beta) / max_weight).astype(np.float32)
+
+            return self._encode_sample(idxes) + (weights, idxes)
+
+    def update_priorities(self, idxes, priorities):
+        """Set the priorities of sampled transitions, e.g. to |TD error| plus
+        a small epsilon. Transitions whose next frame has been overwritten
+        since they were sampled are left alone.
+
+        Parameters
+        ----------
+        idxes: np.array
+            Indices returned by `sample`.
+        priorities: np.array
+            Positive priorities, one for each index.
+        """
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert (priorities > 0).all()
+        with self._lock:
+            keep = idxes != (self.next_idx - 1) % self.size
+            self._set_priorities(idxes[keep], priorities[keep] ** self._alpha)
+            self._max_priority = max(self._max_priority, priorities.max())
+
+    def _set_priorities(self, idxes, priorities_alpha):
+        self._sum_tree.update(idxes, priorities_alpha)
+        if np.isscalar(priorities_alpha) and priorities_alpha == 0.0:
+            # Keep empty slots out of the minimum priority.
+            self._min_tree.update(idxes, float('inf'))
+        else:
+            self._min_tree.update(idxes, priorities_alpha)
+
+class MinibatchPrefetcher(object):
+    def __init__(self, sample_fn, num_batches=2):
+        """Calls `sample_fn` on a background thread and keeps up to
+        `num_batches` of its results in a bounded queue, so that building
+        the next minibatch overlaps with the `session.run` of the current
+        one (which releases the GIL).
+
+        Consistency with `store_frame`/`store_effect` on the training thread
+        comes from the replay buffer's lock: every minibatch is sampled from
+        one consistent state of the buffer, but may be up to `num_batches`
+        updates old. With prioritized replay, the priorities of a transition
+        overwritten in the meantime are set on its replacement.
+
+        Parameters
+        ----------
+        sample_fn: () -> object
+            Returns one minibatch, e.g. `lambda: replay_buffer.sample(32)`.
+        num_batches: int
+            Maximum number of ready minibatches.
+        """
+        self._sample_fn = sample_fn
+        self._queue = queue.Queue(maxsize=num_batches)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self):
+        """Returns the oldest ready minibatch, waiting for one if needed."""
+        batch, error = self._queue.get()
+        if error is not None:
+            raise error
+        return batch
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                item = (self._sample_fn(), None)
+            except Exception as e:
+                item = (None, e)
+            # Time out now and then so that `stop` is noticed when full.
+            while not self._stopped.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[1] is not None:
+                return
+
+class SharedReplayBuffer(ReplayBuffer):
+    def __init__(self, size, frame_history_len, frame_shape):
+        """ReplayBuffer whose arrays and counters live in shared memory, so
+        that a child process forked after construction writes transitions
+        the parent can sample (and vice versa).
+
+        Everything is allocated up front, so `frame_shape` is needed here.
+        The buffer lock is a multiprocessing lock, making one writer process
+        and any number of sampling processes safe. Build every buffer before
+        forking, since constructing one resets its counters.
+
+        Parameters
+        ----------
+        size, frame_history_len:
+            See ReplayBuffer.
+        frame_shape: tuple
+            Shape of a single frame, e.g. (84, 84, 1).
+        """
+        self._counters = np.frombuffer(multiprocessing.RawArray(ctypes.c_int64, 2), dtype=np.int64)
+        super(SharedReplayBuffer, self).__init__(size, frame_history_len)
+        self._lock = multiprocessing.RLock()
+        self._allocate(frame_shape)
+
+    @property
+    def next_idx(self):
+        return int(self._counters[0])
+
+    @next_idx.setter
+    def next_idx(self, value):
+        self._counters[0] = value
+
+    @property
+    def num_in_buffer(self):
+        return int(self._counters[1])
+
+    @num_in_buffer.setter
+    def num_in_buffer(self, value):
+        self._counters[1] = value
+
+    def _new_array(self, name, shape, dtype):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        raw = multiprocessing.RawArray(ctypes.c_uint8, nbytes)
+        return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+class CompressedFrameStore(object):
+    def __init__(self, size, frame_shape, chunk_size=8, cache_chunks=256, codec='zlib'):
+        """Drop-in replacement for the `obs` array of ReplayBuffer that keeps
+        frames compressed, in chunks of `chunk_size` consecutive frames.
+
+        Consecutive Atari frames are nearly identical, so a chunk compresses
+        far better than single frames would. The chunk currently being
+        written is kept uncompressed, and compressed once writing moves on to
+        the next chunk. Reads decompress whole chunks into an LRU cache, so
+        the chunks behind a minibatch are decompressed once for both its
+        observations and next observations. Small chunks keep that cheap
+        for random access; with 8 frames per chunk, a 1M frame buffer of
+        preprocessed Atari frames needs well under 2 GB instead of ~7 GB.
+
+        Supports what ReplayBuffer does with `obs`: `shape`, reading with an
+        int, slice or integer array, and writing a single frame at an int.
+
+        Parameters
+        ----------
+        size: int
+            Number of frames.
+        frame_shape: tuple
+            Shape of a single np.uint8 frame.
+        chunk_size: int
+            Frames per compressed chunk. Larger chunks compress a little
+            better but make random sampling slower.
+        cache_chunks: int
+            Number of decompressed chunks to keep around for reading; should
+            cover the (batch_size * 2) chunks one minibatch touches.
+        codec: str
+            'zlib' (always available) or 'lz4' (needs the lz4 package, and is
+            several times faster to decompress).
+        """
+        assert codec in ('zlib', 'lz4')
+        assert codec != 'lz4' or lz4_frame is not None, "lz4 is not installed"
+        self.shape = (size,) + tuple(frame_shape)
+        self.dtype = np.dtype(np.uint8)
+        self._chunk_size = chunk_size
+        self._cache_chunks = cache_chunks
+        self._codec = codec
+        self._chunks = [None] * ((size + chunk_size - 1) // chunk_size)
+        self._cache = OrderedDict()
+        self._open_id = None
+        self._open = None
+        self._zeros = np.zeros((chunk_size,) + tuple(frame_shape), dtype=np.uint8)
+
+    @property
+    def nbytes(self):
+        """Bytes currently used by compressed chunks and uncompressed buffers."""
+        compressed = sum(len(c) for c in self._chunks if c is not None)
+        return compressed + (len(self._cache) + 1) * self._zeros.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, idx, frame):
+        chunk_id = idx // self._chunk_size
+        if chunk_id != self._open_id:
+            self._open_chunk(chunk_id)
+        self._open[idx - chunk_id * self._chunk_size] = frame
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(self.shape[0]))
+        if np.isscalar(key):
+            chunk_id = key // self._chunk_size
+            return self._get_chunk(chunk_id)[key - chunk_id * self._chunk_size]
+        idxes = np.asarray(key)
+        flat = idxes.ravel()
+        out = np.empty((len(flat),) + self.shape[1:], dtype=np.uint8)
+        chunk_ids = flat // self._chunk_size
+        # Group the indices by chunk, so each chunk is looked up once.
+        order = np.argsort(chunk_ids, kind='mergesort')
+        unique_ids, starts = np.unique(chunk_ids[order], return_index=True)
+        ends = np.append(starts[1:], len(flat))
+        for chunk_id, start, end in zip(unique_ids, starts, ends):
+            sel = order[start:end]
+            out[sel] = self._get_chunk(chunk_id)[flat[sel] - chunk_id * self._chunk_size]
+        return out.reshape(idxes.shape + self.shape[1:])
+
+    def _chunk_len(self, chunk_id):
+        return min(self._chunk_size, self.shape[0] - chunk_id * self._chunk_size)
+
+    def _open_chunk(self, chunk_id):
+        if self._open_id is not None:
+            self._chunks[self._open_id] = self._compress(self._open)
+        # Start from the old contents, since those frames are still valid
+        # until they are overwritten one by one.
+        self._open = np.array(self._get_chunk(chunk_id))
+        self._cache.pop(chunk_id, None)
+        self._open_id = chunk_id
+
+    def _get_chunk(self, chunk_id):
+        if chunk_id == self._open_id:
+            return self._open
+        if self._chunks[chunk_id] is None:
+            # Never written; only read for frames that get masked out anyway.
+            return self._zeros[:self._chunk_len(chunk_id)]
+        if chunk_id in self._cache:
+            chunk = self._cache.pop(chunk_id)
+        else:
+            chunk = self._decompress(self._chunks[chunk_id], chunk_id)
+            if len(self._cache) >= self._cache_chunks:
+                self._cache.popitem(last=False)
+        self._cache[chunk_id] = chunk
+        return chunk
+
+    def _compress(self, chunk):
+        if self._codec == 'lz4':
+            return lz4_frame.compress(chunk.tobytes())
+        return zlib.compress(chunk.tobytes(), 1)
+
+    def _decompress(self, data, chunk_id):
+        if self._codec == 'lz4':
+            raw = lz4_frame.decompress(data)
+        else:
+            raw = zlib.decompress(data)
+        shape = (self._chunk_len(chunk_id),) + self.shape[1:]
+        return np.frombuffer(raw, dtype=np.uint8).reshape(shape)
+
+class TFReplayBuffer(object):
+    def __init__(self, size, frame_history_len, frame_shape, batch_size, session):
+        """Replay buffer kept in TensorFlow variables on the CPU, sampled
+        inside the graph.
+
+        Has the same `store_frame` / `store_effect` /
+        `encode_recent_observation` interface as ReplayBuffer, but instead
+        of `sample` it exposes `obs_t`, `act_t`, `rew_t`, `obs_tp1` and
+        `done_mask` tensors: every `session.run` that evaluates them draws a
+        fresh uniform minibatch of `batch_size` transitions (with
+        replacement), with frame histories stacked and zero-padded at
+        episode boundaries in the graph. Training then needs no feed_dict
+        for the minibatch.
+
+        Each `store_effect` is a single `session.run` that writes the frame
+        and its effect. The last few frames are also kept in numpy, so
+        `encode_recent_observation` does not touch the graph.
+
+        The variables are local variables (not in `tf.global_variables()`),
+        initialized here, so initializing or saving the model leaves them
+        alone.
+
+        Parameters
+        ----------
+        size, frame_history_len:
+            See ReplayBuffer.
+        frame_shape: tuple
+            Shape of a single np.uint8 frame, e.g. (84, 84, 1) or (128,).
+            As in ReplayBuffer, 1-D (RAM) frames are stacked end to end.
+        batch_size: int
+            Number of transitions in each sampled minibatch.
+        session: tf.Session
+            Session used to initialize and write the buffer.
+        """
+        self.size = size
+        self.frame_history_len = frame_history_len
+        self.frame_shape = tuple(frame_shape)
+        self.session = session
+        self.next_idx = 0
+        self.num_in_buffer = 0
+        self._recent = np.zeros((frame_history_len,) + self.frame_shape, dtype=np.uint8)
+        self._recent_done = False
+
+        def local_variable(name, shape, dtype):
+            return tf.Variable(tf.zeros(shape, dtype=dtype), name=name, trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        with tf.device('/cpu:0'), tf.variable_scope('replay_buffer'):
+            self._obs    = local_variable('obs',    (size,) + self.frame_shape, tf.uint8)
+            self._action = local_variable('action', (size,), tf.int32)
+            self._reward = local_variable('reward', (size,), tf.float32)
+            self._done   = local_variable('done',   (size,), tf.bool)
+            self._counters = local_variable('counters', (2,), tf.int32)
+            self.variables = [self._obs, self._action, self._reward, self._done, self._counters]
+
+            self._idx_ph      = tf.placeholder(tf.int32,   [])
+            self._frame_ph    = tf.placeholder(tf.uint8,   self.frame_shape)
+            self._action_ph   = tf.placeholder(tf.int32,   [])
+            self._reward_ph   = tf.placeholder(tf.float32, [])
+            self._done_ph     = tf.placeholder(tf.bool,    [])
+            self._counters_ph = tf.placeholder(tf.int32,   [2])
+            idx = tf.expand_dims(self._idx_ph, 0)
+            self._store_op = tf.group(
+                tf.scatter_update(self._obs,    idx, tf.expand_dims(self._frame_ph, 0)),
+                tf.scatter_update(self._action, idx, tf.expand_dims(self._action_ph, 0)),
+                tf.scatter_update(self._reward, idx, tf.expand_dims(self._reward_ph, 0)),
+                tf.scatter_update(self._done,   idx, tf.expand_dims(self._done_ph, 0)),
+                self._counters.assign(self._counters_ph))
+
+            self._build_sample(batch_size)
+        session.run(tf.variables_initializer(self.variables))
+
+    def _build_sample(self, batch_size):
+        H = self.frame_history_len
+        next_idx, num_in_buffer = self._counters[0], self._counters[1]
+        oldest = tf.floormod(next_idx - num_in_buffer, self.size)
+        # Positions relative to the oldest transition; the most recent one
+        # has no next frame yet, so it is never sampled.
+        pos = tf.random_uniform([batch_size], 0, num_in_buffer - 1, dtype=tf.int32)
+        # Columns hold the frames pos-H+1 .. pos+1, covering obs_t and obs_tp1.
+        window = tf.expand_dims(pos, 1) + tf.range(1 - H, 2)
+        slots = tf.floormod(oldest + window, self.size)
+        frames = tf.gather(self._obs, slots)
+        idx = slots[:, H - 1]
+        self.act_t = tf.gather(self._action, idx)
+        self.rew_t = tf.gather(self._reward, idx)
+        self.done_mask = tf.cast(tf.gather(self._done, idx), tf.float32)
+
+        if H == 1:
+            self.obs_t, self.obs_tp1 = frames[:, 0], frames[:, 1]
+            return
+
+        # A frame belongs to an observation if it was stored (window >= 0)
+        # and no episode ended between it and the observation's last frame.
+        dones = tf.cast(tf.gather(self._done, slots), tf.int32)
+        def encode(frames, dones, window):
+            ended_after = tf.cumsum(dones[:, :-1], axis=1, reverse=True)
+            valid = tf.concat([tf.equal(ended_after, 0),
+                               tf.ones([batch_size, 1], dtype=tf.bool)], axis=1)
+            valid = tf.logical_and(valid, window >= 0)
+            mask = tf.cast(tf.reshape(valid, [batch_size, H] + [1] * len(self.frame_shape)), tf.uint8)
+            if len(self.frame_shape) == 1:
+                return tf.reshape(frames * mask, [batch_size, H * self.frame_shape[0]])
+            img_h, img_w, img_c = self.frame_shape
+            frames = tf.transpose(frames * mask, [0, 2, 3, 1, 4])
+            return tf.reshape(frames, [batch_size, img_h, img_w, H * img_c])
+        self.obs_t   = encode(frames[:, :-1], dones[:, :-1], window[:, :-1])
+        self.obs_tp1 = encode(frames[:, 1:], dones[:, 1:], window[:, 1:])
+
+    def can_sample(self, batch_size):
+        """Returns true if `batch_size` different transitions can be sampled from the buffer."""
+        return batch_size + 1 <= self.num_in_buffer
+
+    def flush(self):
+        pass
+
+    def store_frame(self, frame):
+        """Keeps `frame` for `encode_recent_observation`; it is written to
+        the buffer together with its effect by `store_effect`.
+
+        Returns
+        -------
+        idx: int
+            Index at which the frame will be stored.
+        """
+        if self._recent_done:
+            self._recent[:] = 0
+            self._recent_done = False
+        self._recent[:-1] = self._recent[1:]
+        self._recent[-1] = frame
+        return self.next_idx
+
+    def store_effect(self, idx, action, reward, done):
+        """Writes the last stored frame and the effect of taking `action`
+        after observing it to the buffer, in one `session.run`."""
+        next_idx = (idx + 1) % self.size
+        num_in_buffer = min(self.size, self.num_in_buffer + 1)
+        self.session.run(self._store_op, feed_dict={
+            self._idx_ph: idx,
+            self._frame_ph: self._recent[-1],
+            self._action_ph: action,
+            self._reward_ph: reward,
+            self._done_ph: done,
+            self._counters_ph: [next_idx, num_in_buffer],
+        })
+        self.next_idx, self.num_in_buffer = next_idx, num_in_buffer
+        self._recent_done = done
+
+    def encode_recent_observation(self):
+        """Same as ReplayBuffer.encode_recent_observation, from the numpy copy
+        of the last `frame_history_len` frames."""
+        if len(self.frame_shape) == 1:
+            return self._recent.reshape(-1)
+        img_h, img_w = self.frame_shape[0], self.frame_shape[1]
+        return self._recent.transpose(1, 2, 0, 3).reshape(img_h, img_w, -1)
+
+class Checkpointer(object):
+    def __init__(self, session, variables, checkpoint_dir):
+        """Saves `variables`, plus a dict of other training state, to
+        `checkpoint_dir/checkpoint.npz` without stalling the caller.
+
+        `save` only copies the variables out of the session (the staging
+        snapshot); writing the file happens on a background thread.
+        The file is written under a temporary name and then renamed, so a
+        crash never leaves a half-written checkpoint behind.
+
+        Parameters
+        ----------
+        session: tf.Session
+            Session holding the variables.
+        variables: [tf.Variable]
+            Variables to save and restore, e.g. tf.global_variables().
+        checkpoint_dir: str
+            Directory of the checkpoint; created if needed.
+        """
+        self._session = session
+        self._variables = sorted(variables, key=lambda v: v.name)
+        self._path = checkpoint_path(checkpoint_dir)
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        # Holds at most one snapshot, so a slow disk makes `save` wait
+        # rather than pile up copies of the weights.
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, state):
+        """Snapshots the variables and queues them to be written with
+        `state`, a JSON-serializable dict."""
+        self._raise_error()
+        values = self._session.run(self._variables)
+        self._queue.put((values, dict(state)))
+
+    def restore(self):
+        """Loads the variables from the checkpoint, if there is one.
+
+        Returns
+        -------
+        state: dict or None
+            The `state` saved with them, or None if there is no checkpoint.
+        """
+        if not os.path.exists(self._path):
+            return None
+        with np.load(self._path) as data:
+            for var in self._variables:
+                var.load(data[var.name], self._session)
+            return json.loads(str(data['__state__']))
+
+    def close(self):
+        """Waits for pending writes to finish."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            values, state = item
+            arrays = {var.name: value for var, value in zip(self._variables, values)}
+            arrays['__state__'] = np.array(json.dumps(state))
+            try:
+                with open(self._path + '.tmp', 'wb') as f:
+                    np.savez(f, **arrays)
+                os.rename(self._path + '.tmp', self._path)
+            except Exception as e:
+                self._error = e
+                return
+
+def checkpoint_path(checkpoint_dir):
+    return os.path.join(checkpoint_dir, 'checkpoint.npz')
 
+def load_checkpoint_state(checkpoint_dir):
+    """Returns the state dict of the checkpoint in `checkpoint_dir`, or None."""
+    path = checkpoint_path(checkpoint_dir)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return json.loads(str(data['__state__']))
@@ -0,0 +1,121 @@
+"""
+Greedy evaluation of a Q network saved by `dqn.learn(save_path=...)`.
+
+Steps `--num_envs` Atari environments in lockstep and picks the actions of all
+of them with one batched forward pass, so scoring a checkpoint over many
+episodes costs far fewer `session.run` calls than playing them one at a time.
+Episodes are whole games scored with the game's own (unclipped) rewards, and
+actions are epsilon-greedy with a fixed `--eval_epsilon`. Usage:
+
+    python run_dqn_atari.py --game Pong --seed 1 --save_path checkpoints/Pong_s001
+    python eval_dqn.py --game Pong --checkpoint checkpoints/Pong_s001 --num_episodes 30
+"""
+
+import argparse
+import time
+import gym
+import numpy as np
+import tensorflow as tf
+
+from atari_wrappers import wrap_deepmind
+from run_dqn_atari import GAME_TO_ID, atari_model, set_global_seeds
+
+
+def get_eval_env(env_id, seed):
+    env = gym.make(env_id)
+    env.seed(seed)
+    return wrap_deepmind(env, episode_life=False, clip_rewards=False)
+
+
+def evaluate(envs, session, q_values, obs_ph, num_episodes, frame_history_len=4,
+             eval_epsilon=0.05, max_episode_steps=27000):
+    """Plays `num_episodes` episodes spread over `envs`, returns their scores.
+
+    Observations are stacked like in the replay buffer: the last
+    `frame_history_len` frames, with zeros before the start of the episode.
+    Episodes longer than `max_episode_steps` (agent steps) are cut off, so a
+    policy that stalls can't stall the evaluation.
+    """
+    num_envs = len(envs)
+    num_actions = envs[0].action_space.n
+    img_h, img_w, img_c = envs[0].observation_space.shape
+    stacked = np.zeros((num_envs, img_h, img_w, frame_history_len * img_c), dtype=np.uint8)
+    scores = np.zeros(num_envs)
+    lengths = np.zeros(num_envs, dtype=np.int64)
+    active = np.zeros(num_envs, dtype=np.bool)
+    finished_scores = []
+
+    num_started = 0
+    for i in range(min(num_envs, num_episodes)):
+        stacked[i, :, :, -img_c:] = envs[i].reset()
+        active[i] = True
+        num_started += 1
+
+    while active.any():
+        idxes = np.flatnonzero(active)
+        actions = np.argmax(session.run(q_values, feed_dict={obs_ph: stacked[idxes]}), axis=1)
+        explore = np.random.rand(len(idxes)) < eval_epsilon
+        actions[explore] = np.random.randint(num_actions, size=explore.sum())
+
+        for i, action in zip(idxes, actions):
+            obs, reward, done, _ = envs[i].step(action)
+            scores[i] += reward
+            lengths[i] += 1
+            if done or lengths[i] >= max_episode_steps:
+                finished_scores.append(scores[i])
+                scores[i], lengths[i] = 0.0, 0
+                stacked[i] = 0
+                if num_started < num_episodes:
+                    obs = envs[i].reset()
+                    num_started += 1
+                else:
+                    active[i] = False
+                    continue
+            stacked[i, :, :, :-img_c] = stacked[i, :, :, img_c:]
+            stacked[i, :, :, -img_c:] = obs
+    return np.array(finished_scores)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--game', type=str, default='Pong')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Path the Q network was saved to by dqn.learn.')
+    parser.add_argument('--num_envs', type=int, default=8)
+    parser.add_argument('--num_episodes', type=int, default=30)
+    parser.add_argument('--eval_epsilon', type=float, default=0.05)
+    parser.add_argument('--max_episode_steps', type=int, default=27000)
+    parser.add_argument('--frame_history_len', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    set_global_seeds(args.seed)
+    env_id = gym.benchmark_spec('Atari40M').tasks[GAME_TO_ID[args.game]].env_id
+    envs = [get_eval_env(env_id, args.seed + i) for i in range(args.num_envs)]
+
+    img_h, img_w, img_c = envs[0].observation_space.shape
+    obs_ph = tf.placeholder(tf.uint8, [None, img_h, img_w, args.frame_history_len * img_c])
+    q_values = atari_model(tf.cast(obs_ph, tf.float32) / 255.0, envs[0].action_space.n,
+                           scope="q_func")
+    session = tf.Session()
+    tf.train.Saver(var_list=tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='q_func')
+                   ).restore(session, args.checkpoint)
+
+    t_start = time.time()
+    scores = evaluate(envs, session, q_values, obs_ph, args.num_episodes,
+                      frame_history_len=args.frame_history_len,
+                      eval_epsilon=args.eval_epsilon,
+                      max_episode_steps=args.max_episode_steps)
+    seconds = time.time() - t_start
+    print("checkpoint: {}".format(args.checkpoint))
+    print("episodes: {} ({} envs, epsilon {})".format(len(scores), args.num_envs, args.eval_epsilon))
+    print("mean score: {:.2f} (std {:.2f})".format(np.mean(scores), np.std(scores)))
+    print("median score: {:.2f}".format(np.median(scores)))
+    print("min / max score: {:.2f} / {:.2f}".format(np.min(scores), np.max(scores)))
+    print("elapsed time: {:.1f} seconds".format(seconds))
+    for env in envs:
+        env.close()
+
+
+if __name__ == "__main__":
+    main()
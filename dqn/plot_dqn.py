@@ -1,7 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
 import seaborn as sns
+from training_log import load_training_log
 plt.style.use('seaborn-darkgrid')
 np.set_printoptions(edgeitems=100,
                     linewidth=100,
@@ -45,9 +45,9 @@ pong_labels = ['seed=1','seed=2']
 
 for i in range(0,2):
     index_str = str(i+1)
-    with open(LOGDIR+'Pong_s00'+index_str+'.pkl', 'rb') as f:
-        pong_data.append( np.array(pickle.load(f)) )
-        pong_eps.append( np.array(pickle.load(f)) )
+    data, eps = load_training_log(LOGDIR+'Pong_s00'+index_str)
+    pong_data.append(data)
+    pong_eps.append(eps)
     pong_data[i] = np.maximum(pong_data[i], -21)
     pong_t.append((pong_data[i][:,0]) / 1000000.0)
     pong_mean.append(pong_data[i][:,1])
@@ -103,9 +103,9 @@ breakout_labels = ['seed=1','seed=2']
 
 for i in range(0,2):
     index_str = str(i+1)
-    with open(LOGDIR+'Breakout_s00'+index_str+'.pkl', 'rb') as f:
-        breakout_data.append( np.array(pickle.load(f)) )
-        breakout_eps.append( np.array(pickle.load(f)) )
+    data, eps = load_training_log(LOGDIR+'Breakout_s00'+index_str)
+    breakout_data.append(data)
+    breakout_eps.append(eps)
     breakout_data[i] = np.maximum(breakout_data[i], -21)
     breakout_t.append((breakout_data[i][:,0]) / 1000000.0)
     breakout_mean.append(breakout_data[i][:,1])
@@ -160,9 +160,9 @@ beamrider_labels = ['seed=1','seed=2']
 
 for i in range(0,2):
     index_str = str(i+1)
-    with open(LOGDIR+'BeamRider_s00'+index_str+'.pkl', 'rb') as f:
-        beamrider_data.append( np.array(pickle.load(f)) )
-        beamrider_eps.append( np.array(pickle.load(f)) )
+    data, eps = load_training_log(LOGDIR+'BeamRider_s00'+index_str)
+    beamrider_data.append(data)
+    beamrider_eps.append(eps)
     beamrider_data[i] = np.maximum(beamrider_data[i], -21)
     beamrider_t.append((beamrider_data[i][:,0]) / 1000000.0)
     beamrider_mean.append(beamrider_data[i][:,1])
@@ -218,9 +218,9 @@ enduro_labels = ['seed=1','seed=2']
 
 for i in range(0,2):
     index_str = str(i+1)
-    with open(LOGDIR+'Enduro_s00'+index_str+'.pkl', 'rb') as f:
-        enduro_data.append( np.array(pickle.load(f)) )
-        enduro_eps.append( np.array(pickle.load(f)) )
+    data, eps = load_training_log(LOGDIR+'Enduro_s00'+index_str)
+    enduro_data.append(data)
+    enduro_eps.append(eps)
     enduro_data[i] = np.maximum(enduro_data[i], -21)
     enduro_t.append((enduro_data[i][:,0]) / 1000000.0)
     enduro_mean.append(enduro_data[i][:,1])
@@ -10,6 +10,7 @@ import argparse
 import sys
 
 import dqn
+import dqn_apex
 from dqn_utils import *
 from atari_wrappers import *
 
@@ -30,13 +31,7 @@ def atari_model(img_in, num_actions, scope, reuse=False):
 
         return out
 
-def atari_learn(env,
-                session,
-                num_timesteps,
-                log_file = './logs_pkls/rewards.pkl'):
-    # This is just a rough estimate
-    num_iterations = float(num_timesteps) / 4.0
-
+def atari_optimizer(num_iterations):
     lr_multiplier = 1.0
     lr_schedule = PiecewiseSchedule([
                                          (0,                   1e-4 * lr_multiplier),
@@ -44,16 +39,42 @@ def atari_learn(env,
                                          (num_iterations / 2,  5e-5 * lr_multiplier),
                                     ],
                                     outside_value=5e-5 * lr_multiplier)
-    optimizer = dqn.OptimizerSpec(
+    return dqn.OptimizerSpec(
         constructor=tf.train.AdamOptimizer,
         kwargs=dict(epsilon=1e-4),
         lr_schedule=lr_schedule
     )
 
+def atari_learn(env,
+                session,
+                num_timesteps,
+                log_file = './logs_pkls/rewards.pkl',
+                replay_buffer_dir = None,
+                prioritized_replay = False,
+                num_prefetch_batches = 0,
+                replay_sequence_len = 1,
+                replay_buffer_size = 1000000,
+                frame_codec = None,
+                tf_replay_buffer = False,
+                save_path = None,
+                checkpoint_dir = None,
+                checkpoint_freq = 250000,
+                resume = False):
+    # This is just a rough estimate
+    num_iterations = float(num_timesteps) / 4.0
+    optimizer = atari_optimizer(num_iterations)
+
+    # The Monitor of a resumed run starts counting from zero again.
+    prior_env_steps = 0
+    if resume and checkpoint_dir is not None:
+        state = load_checkpoint_state(checkpoint_dir)
+        if state is not None:
+            prior_env_steps = state['env_steps']
+
     def stopping_criterion(env, t):
         # notice that here t is the number of steps of the wrapped env,
         # which is different from the number of steps in the underlying env
-        return get_wrapper_by_name(env, "Monitor").get_total_steps() >= num_timesteps
+        return prior_env_steps + get_wrapper_by_name(env, "Monitor").get_total_steps() >= num_timesteps
 
     exploration_schedule = PiecewiseSchedule(
         [
@@ -70,7 +91,7 @@ def atari_learn(env,
         session=session,
         exploration=exploration_schedule,
         stopping_criterion=stopping_criterion,
-        replay_buffer_size=1000000,
+        replay_buffer_size=replay_buffer_size,
         batch_size=32,
         gamma=0.99,
         learning_starts=50000,
@@ -78,11 +99,51 @@ def atari_learn(env,
         frame_history_len=4,
         target_update_freq=10000,
         grad_norm_clipping=10,
-        log_file=log_file
+        log_file=log_file,
+        replay_buffer_dir=replay_buffer_dir,
+        prioritized_replay=prioritized_replay,
+        prioritized_replay_beta=LinearSchedule(num_iterations, 1.0, initial_p=0.4),
+        num_prefetch_batches=num_prefetch_batches,
+        replay_sequence_len=replay_sequence_len,
+        frame_codec=frame_codec,
+        tf_replay_buffer=tf_replay_buffer,
+        save_path=save_path,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_freq=checkpoint_freq,
+        resume=resume
     )
     env.close()
 
 
+def atari_learn_apex(task,
+                     seed,
+                     num_actors,
+                     num_timesteps,
+                     log_file = './logs_pkls/rewards.pkl',
+                     replay_buffer_size = 1000000,
+                     save_path = None):
+    # Actors count steps of the wrapped env, i.e. roughly num_timesteps / 4.
+    num_iterations = float(num_timesteps) / 4.0
+    dqn_apex.learn(
+        env_fn=lambda actor_id: get_env(task, seed + actor_id, actor_id=actor_id),
+        q_func=atari_model,
+        optimizer_spec=atari_optimizer(num_iterations),
+        session_fn=get_session,
+        num_actors=num_actors,
+        max_steps=int(num_iterations),
+        replay_buffer_size=replay_buffer_size,
+        batch_size=32,
+        gamma=0.99,
+        learning_starts=50000,
+        frame_history_len=4,
+        target_update_freq=2500,
+        grad_norm_clipping=10,
+        seed=seed,
+        log_file=log_file,
+        save_path=save_path
+    )
+
+
 def get_available_gpus():
     from tensorflow.python.client import device_lib
     local_device_protos = device_lib.list_local_devices()
@@ -120,47 +181,96 @@ def get_session():
     return session
 
 
-def get_env(task, seed):
+def get_env(task, seed, actor_id=None):
     env_id = task.env_id
     env = gym.make(env_id)
     set_global_seeds(seed)
     env.seed(seed)
     expt_dir = '/tmp/hw3_vid_dir2/'
-    env = wrappers.Monitor(env, osp.join(expt_dir, "gym"), force=True)
+    monitor_dir = osp.join(expt_dir, "gym")
+    if actor_id is not None:
+        monitor_dir = osp.join(monitor_dir, "actor{}".format(actor_id))
+    env = wrappers.Monitor(env, monitor_dir, force=True)
     env = wrap_deepmind(env)
     return env
 
 
+# Games that we'll be testing, and their index in the Atari40M benchmark.
+GAME_TO_ID = {'BeamRider':0,
+              'Breakout':1,
+              'Enduro':2,
+              'Pong':3,
+              'Qbert':4}
+
+
 def main():
-    # Games that we'll be testing.
-    game_to_ID = {'BeamRider':0,
-                  'Breakout':1,
-                  'Enduro':2,
-                  'Pong':3,
-                  'Qbert':4}
 
     # Get some arguments here. Note: num_timesteps default uses tasks default.
     parser = argparse.ArgumentParser()
     parser.add_argument('--game', type=str, default='Pong')
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--num_timesteps', type=int, default=40000000)
+    parser.add_argument('--replay_buffer_dir', type=str, default=None)
+    parser.add_argument('--prioritized_replay', action='store_true')
+    parser.add_argument('--num_prefetch_batches', type=int, default=0)
+    parser.add_argument('--replay_sequence_len', type=int, default=1)
+    parser.add_argument('--num_actors', type=int, default=0)
+    parser.add_argument('--replay_buffer_size', type=int, default=1000000)
+    parser.add_argument('--frame_codec', type=str, default=None, choices=['zlib', 'lz4'])
+    parser.add_argument('--tf_replay_buffer', action='store_true')
+    parser.add_argument('--save_path', type=str, default=None)
+    parser.add_argument('--checkpoint_dir', type=str, default=None)
+    parser.add_argument('--checkpoint_freq', type=int, default=250000)
+    parser.add_argument('--resume', action='store_true')
     args = parser.parse_args()
+    if args.num_actors > 0:
+        # The Ape-X actors write to shared, uncompressed, uniformly sampled
+        # segments, and the learner has no checkpoints.
+        unsupported = [name for name in ('replay_buffer_dir', 'prioritized_replay',
+                                         'num_prefetch_batches', 'replay_sequence_len',
+                                         'frame_codec', 'tf_replay_buffer', 'checkpoint_dir',
+                                         'checkpoint_freq', 'resume')
+                       if getattr(args, name) != parser.get_default(name)]
+        if unsupported:
+            parser.error("--num_actors can't be combined with {}".format(
+                    ", ".join("--" + name for name in unsupported)))
 
     # Choose the game to play and set log file.
     benchmark = gym.benchmark_spec('Atari40M')
-    task = benchmark.tasks[game_to_ID[args.game]]
+    task = benchmark.tasks[GAME_TO_ID[args.game]]
     log_name = args.game+"_s"+str(args.seed).zfill(3)+".pkl"
 
     # Run training. Should change the seed if possible!
     # Also, the actual # of iterations run is _roughly_ num_timesteps/4.
     seed = args.seed
+    if args.num_actors > 0:
+        print("task = {}".format(task))
+        atari_learn_apex(task,
+                         seed,
+                         num_actors=args.num_actors,
+                         num_timesteps=args.num_timesteps,
+                         log_file=log_name,
+                         replay_buffer_size=args.replay_buffer_size,
+                         save_path=args.save_path)
+        return
     env = get_env(task, seed)
     session = get_session()
     print("task = {}".format(task))
     atari_learn(env, 
                 session, 
                 num_timesteps=args.num_timesteps,
-                log_file=log_name)
+                log_file=log_name,
+                replay_buffer_dir=args.replay_buffer_dir,
+                prioritized_replay=args.prioritized_replay,
+                num_prefetch_batches=args.num_prefetch_batches,
+                replay_sequence_len=args.replay_sequence_len,
+                replay_buffer_size=args.replay_buffer_size,
+                frame_codec=args.frame_codec,
+                tf_replay_buffer=args.tf_replay_buffer,
+                save_path=args.save_path,
+                checkpoint_dir=args.checkpoint_dir,
+                checkpoint_freq=args.checkpoint_freq,
+                resume=args.resume)
 
 if __name__ == "__main__":
     main()
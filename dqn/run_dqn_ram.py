@@ -26,7 +26,9 @@ def atari_model(ram_in, num_actions, scope, reuse=False):
 
 def atari_learn(env,
                 session,
-                num_timesteps):
+                num_timesteps,
+                frame_history_len=1,
+                tf_replay_buffer=False):
     # This is just a rough estimate
     num_iterations = float(num_timesteps) / 4.0
 
@@ -68,9 +70,10 @@ def atari_learn(env,
         gamma=0.99,
         learning_starts=50000,
         learning_freq=4,
-        frame_history_len=1,
+        frame_history_len=frame_history_len,
         target_update_freq=10000,
-        grad_norm_clipping=10
+        grad_norm_clipping=10,
+        tf_replay_buffer=tf_replay_buffer
     )
     env.close()
 
@@ -111,11 +114,18 @@ def get_env(seed):
     return env
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frame_history_len', type=int, default=1,
+                        help='Number of RAM observations stacked end to end as input.')
+    parser.add_argument('--tf_replay_buffer', action='store_true')
+    args = parser.parse_args()
+
     # Run training
     seed = 0 # Use a seed of zero (you may want to randomize the seed!)
     env = get_env(seed)
     session = get_session()
-    atari_learn(env, session, num_timesteps=int(4e7))
+    atari_learn(env, session, num_timesteps=int(4e7), frame_history_len=args.frame_history_len,
+                tf_replay_buffer=args.tf_replay_buffer)
 
 if __name__ == "__main__":
     main()
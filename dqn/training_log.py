@@ -0,0 +1,111 @@
+"""
+Append-only training log for the DQN scripts.
+
+Replaces re-pickling the whole history every time something is logged. Two
+files of little-endian float64 records are appended to as training goes on:
+
+    <prefix>.scores      (t, mean reward of last 100 episodes, best such mean,
+                          reward of the last episode) per log line
+    <prefix>.episodes    one reward per finished episode
+
+Only numpy is needed to read them (see `load_training_log`), so `plot_dqn.py`
+doesn't have to import TensorFlow or gym. Old runs saved as `<prefix>.pkl`
+still load.
+"""
+
+import os.path as osp
+import pickle
+from collections import deque
+import numpy as np
+
+RECORD_DTYPE = np.dtype('<f8')
+NUM_SCORE_COLUMNS = 4
+
+
+class TrainingLog(object):
+    def __init__(self, path_prefix, window=100, resume_t=None, resume_num_episodes=None):
+        """Starts a new log (overwriting an old one at the same place), or
+        continues one when resuming from a checkpoint.
+
+        Also keeps the running statistics printed by the training loops, so
+        they are updated once per finished episode rather than recomputed
+        from the whole history.
+
+        Parameters
+        ----------
+        path_prefix: str
+            Path of the log files without extension, e.g. 'logs_pkls/Pong_s001'.
+        window: int
+            Number of recent episodes averaged for `mean_episode_reward`.
+        resume_t, resume_num_episodes: int or None
+            When resuming, the timestep and number of episodes at the
+            checkpoint. The existing log is cut back to them (dropping what
+            was logged after the checkpoint) and appended to.
+        """
+        scores = np.zeros((0, NUM_SCORE_COLUMNS))
+        episode_rewards = np.zeros(0)
+        if resume_t is not None and osp.exists(path_prefix + '.scores'):
+            scores, episode_rewards = load_training_log(path_prefix)
+            scores = scores[scores[:, 0] <= resume_t]
+            episode_rewards = episode_rewards[:resume_num_episodes]
+
+        self._window = window
+        self._scores_file = open(path_prefix + '.scores', 'wb')
+        self._episodes_file = open(path_prefix + '.episodes', 'wb')
+        self._scores_file.write(scores.astype(RECORD_DTYPE).tobytes())
+        self._recent_rewards = deque(maxlen=window)
+        self.num_episodes = 0
+        self.last_episode_reward = -float('nan')
+        self.mean_episode_reward = -float('nan')
+        self.best_mean_episode_reward = -float('inf')
+        if len(scores) > 0:
+            self.best_mean_episode_reward = scores[:, 2].max()
+        self.add_episodes(episode_rewards)
+
+    def add_episodes(self, rewards):
+        """Records the rewards of newly finished episodes."""
+        if len(rewards) == 0:
+            return
+        rewards = np.asarray(rewards, dtype=RECORD_DTYPE)
+        self._episodes_file.write(rewards.tobytes())
+        self._recent_rewards.extend(rewards)
+        self.num_episodes += len(rewards)
+        self.last_episode_reward = float(rewards[-1])
+        self.mean_episode_reward = np.mean(self._recent_rewards)
+        if self.num_episodes > self._window:
+            self.best_mean_episode_reward = max(self.best_mean_episode_reward,
+                                                self.mean_episode_reward)
+
+    def add_scores(self, t):
+        """Appends a score record for timestep `t` and flushes both files."""
+        record = np.array([t, self.mean_episode_reward, self.best_mean_episode_reward,
+                           self.last_episode_reward], dtype=RECORD_DTYPE)
+        self._scores_file.write(record.tobytes())
+        self._episodes_file.flush()
+        self._scores_file.flush()
+
+    def close(self):
+        self._scores_file.close()
+        self._episodes_file.close()
+
+
+def load_training_log(path_prefix):
+    """Loads a log written by TrainingLog, or the older pickled format.
+
+    Returns
+    -------
+    scores: np.array
+        Array of shape (num_logs, 4), columns as in the `.scores` file.
+    episode_rewards: np.array
+        Reward of every finished episode.
+    """
+    if osp.exists(path_prefix + '.scores'):
+        scores = np.fromfile(path_prefix + '.scores', dtype=RECORD_DTYPE)
+        # A run that is still going may have written a partial record.
+        scores = scores[:len(scores) // NUM_SCORE_COLUMNS * NUM_SCORE_COLUMNS]
+        episode_rewards = np.fromfile(path_prefix + '.episodes', dtype=RECORD_DTYPE)
+        return scores.reshape(-1, NUM_SCORE_COLUMNS), episode_rewards
+    with open(path_prefix + '.pkl', 'rb') as f:
+        scores = np.array(pickle.load(f))
+        episode_rewards = np.array(pickle.load(f))
+    return scores, episode_rewards
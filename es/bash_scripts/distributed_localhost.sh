@@ -0,0 +1,20 @@
+#!/bin/bash
+# Master and workers on one computer, talking over TCP like they would across
+# a cluster. Workers can be killed or added while it runs. They start first and
+# keep retrying until the master has opened its port.
+NUM_WORKERS=4
+PORT=5555
+for i in $(seq 1 $NUM_WORKERS); do
+    python distributed.py --host localhost --port $PORT &
+done
+python main.py InvertedPendulum-v1 \
+    --es_iters 700 \
+    --lrate_es 0.005 \
+    --log_every_t_iter 2 \
+    --master_port $PORT \
+    --npop 200 \
+    --seed 5 \
+    --sigma 0.1 \
+    --snapshot_every_t_iter 50 \
+    --test_trajs 10
+wait
@@ -0,0 +1,344 @@
+"""
+Master/worker Evolution Strategies over plain TCP, for running the population
+on several computers.
+
+The master is `main.py` with `--master_port`. Workers can be started (and
+stopped) at any time, on any computer that can reach the master:
+
+    python main.py HalfCheetah-v1 --npop 200 --master_port 5555
+    python distributed.py --host <master host> --port 5555
+
+On connecting, a worker is sent the master's arguments (as JSON), and builds
+its own env, policy and noise table from them. The table has the same size and
+seed as the master's, so an offset means the same perturbation everywhere.
+
+Every iteration the master broadcasts (iteration, weights, noise_seed), and
+both sides draw the iteration's noise offsets from `noise_seed`. The mirrored
+pairs are then handed out in tasks of `--pairs_per_task` pairs (along with the
+iteration's episode cap) to whichever worker is idle, and each task comes back
+as compact records of (noise_idx, ret_pos, ret_neg, steps_pos, steps_neg,
+trunc_pos, trunc_neg), the last two flagging episodes cut off at the cap. If a
+worker leaves, its task goes back in the queue; if one joins, it gets the
+current broadcast and starts taking tasks.
+
+Messages are a (type, length) header and a payload of packed numbers; nothing
+is unpickled, so workers can't run code on the master or vice versa.
+"""
+
+import argparse
+import json
+import select
+import socket
+import struct
+import time
+from collections import deque
+import numpy as np
+
+MSG_CONFIG  = 0  # master -> worker: JSON of the master's args.
+MSG_WEIGHTS = 1  # master -> worker: (iteration, noise_seed), float32 weights.
+MSG_TASK    = 2  # master -> worker: (iteration, start, end, max_steps).
+MSG_RESULT  = 3  # worker -> master: (iteration, busy seconds), RESULT_DTYPE records.
+
+HEADER = struct.Struct('<BI')
+WEIGHTS_HEADER = struct.Struct('<qq')
+TASK = struct.Struct('<qqqq')
+RESULT_HEADER = struct.Struct('<qd')
+RESULT_DTYPE = np.dtype([('noise_idx', '<i8'), ('ret_pos', '<f8'), ('ret_neg', '<f8'),
+                         ('steps_pos', '<i8'), ('steps_neg', '<i8'),
+                         ('trunc_pos', '?'), ('trunc_neg', '?')])
+
+
+def _send(sock, msg_type, payload):
+    sock.sendall(HEADER.pack(msg_type, len(payload)) + payload)
+
+
+def _recv_exactly(sock, num_bytes):
+    chunks = []
+    while num_bytes > 0:
+        chunk = sock.recv(min(num_bytes, 1 << 20))
+        if not chunk:
+            raise EOFError("Connection closed.")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv(sock):
+    msg_type, length = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return msg_type, _recv_exactly(sock, length)
+
+
+class _Worker(object):
+    """ The master's view of one connected worker. """
+    def __init__(self, sock, worker_id):
+        self.sock = sock
+        self.worker_id = worker_id
+        self.buffer = b''
+        self.task = None
+        self.since = time.time()
+
+
+class Master(object):
+
+    def __init__(self, args, port, pairs_per_task=4):
+        """ Listens for workers on `port` (all interfaces).
+
+        Args:
+            args: The argparse from the user, sent to each worker.
+            port: TCP port to listen on.
+            pairs_per_task: Mirrored pairs per task. Smaller tasks balance
+                the work better but cost more messages.
+        """
+        self.config = json.dumps(vars(args)).encode('utf-8')
+        self.pairs_per_task = pairs_per_task
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(128)
+        self.workers = {}
+        self.next_worker_id = 0
+        self.weights_msg = None
+        self.last_stats = []
+        print("ES master listening on port {}".format(port))
+
+    def _accept(self):
+        sock, addr = self.listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        worker = _Worker(sock, self.next_worker_id)
+        self.next_worker_id += 1
+        try:
+            _send(sock, MSG_CONFIG, self.config)
+            if self.weights_msg is not None:
+                _send(sock, MSG_WEIGHTS, self.weights_msg)
+        except socket.error:
+            sock.close()
+            return
+        self.workers[sock] = worker
+        print("worker {} joined from {} ({} connected)".format(
+                worker.worker_id, addr[0], len(self.workers)))
+
+    def _drop(self, worker, pending, reason=None):
+        """ Forgets a worker that left, or disconnects one that misbehaved
+        (for `reason`), putting its task back in `pending`. Returns the
+        seconds it was connected during this iteration. """
+        if reason is not None:
+            print("dropping worker {}: {}".format(worker.worker_id, reason))
+        if worker.task is not None:
+            pending.appendleft(worker.task)
+        del self.workers[worker.sock]
+        worker.sock.close()
+        print("worker {} left ({} connected)".format(worker.worker_id, len(self.workers)))
+        return time.time() - worker.since
+
+    def evaluate(self, iteration, weights, noise_seed, noise_idxes, max_steps=None):
+        """ Has the workers evaluate the mirrored pairs of `noise_idxes`
+        around `weights`, which they draw themselves from `noise_seed`.
+
+        Blocks until every pair is done, waiting for workers if there are
+        none. Returns the (len(noise_idxes),2) returns, episode lengths and
+        truncation flags, like `ESAgent._evaluate_pairs`, and puts timing statistics in
+        `self.last_stats`:
+
+            NumWorkers: workers connected at the end of the evaluation.
+            WorkerUtilization: fraction of the workers' connected time spent
+                on the tasks of this iteration.
+            StragglerSeconds: time from the first worker going idle for lack
+                of tasks to the last task coming back.
+            RequeuedTasks: tasks handed out again because a worker left or
+                was dropped for sending something other than valid results.
+        """
+        t_start = time.time()
+        num = len(noise_idxes)
+        self.weights_msg = (WEIGHTS_HEADER.pack(iteration, noise_seed) +
+                            np.asarray(weights, dtype=np.float32).tobytes())
+        pending = deque((start, min(start + self.pairs_per_task, num))
+                        for start in range(0, num, self.pairs_per_task))
+        scores_n2 = np.zeros((num,2))
+        steps_n2 = np.zeros((num,2), dtype=np.int64)
+        truncated_n2 = np.zeros((num,2), dtype=bool)
+        task_max_steps = 0 if max_steps is None else max_steps
+        max_length = RESULT_HEADER.size + self.pairs_per_task * RESULT_DTYPE.itemsize
+        num_done = 0
+        busy_secs = 0.0
+        connected_secs = 0.0
+        t_first_idle = None
+        num_requeued = 0
+        waiting = False
+
+        for worker in list(self.workers.values()):
+            worker.since = t_start
+            try:
+                _send(worker.sock, MSG_WEIGHTS, self.weights_msg)
+            except socket.error:
+                connected_secs += self._drop(worker, pending)
+
+        while num_done < num:
+            # Hand out tasks to idle workers.
+            for worker in list(self.workers.values()):
+                if worker.task is not None:
+                    continue
+                if not pending:
+                    if t_first_idle is None:
+                        t_first_idle = time.time()
+                    continue
+                worker.task = pending.popleft()
+                start, end = worker.task
+                try:
+                    _send(worker.sock, MSG_TASK, TASK.pack(iteration, start, end, task_max_steps))
+                except socket.error:
+                    connected_secs += self._drop(worker, pending)
+                    num_requeued += 1
+            if not self.workers and not waiting:
+                print("waiting for workers to connect ...")
+                waiting = True
+
+            readable, _, _ = select.select([self.listener] + list(self.workers), [], [], 1.0)
+            for sock in readable:
+                if sock is self.listener:
+                    self._accept()
+                    waiting = False
+                    continue
+                worker = self.workers[sock]
+                try:
+                    data = sock.recv(1 << 20)
+                except socket.error:
+                    data = b''
+                if not data:
+                    num_requeued += worker.task is not None
+                    connected_secs += self._drop(worker, pending)
+                    continue
+                worker.buffer += data
+                # Whatever a peer sends must not stop the run: one that sends
+                # something other than results is dropped like one that left.
+                error = None
+                while len(worker.buffer) >= HEADER.size:
+                    msg_type, length = HEADER.unpack(worker.buffer[:HEADER.size])
+                    if msg_type != MSG_RESULT:
+                        error = "unexpected message type {}".format(msg_type)
+                        break
+                    if not RESULT_HEADER.size <= length <= max_length:
+                        error = "result message of {} bytes".format(length)
+                        break
+                    if len(worker.buffer) < HEADER.size + length:
+                        break
+                    payload = worker.buffer[HEADER.size:HEADER.size+length]
+                    worker.buffer = worker.buffer[HEADER.size+length:]
+                    itr, secs = RESULT_HEADER.unpack(payload[:RESULT_HEADER.size])
+                    if itr != iteration or worker.task is None:
+                        continue
+                    start, end = worker.task
+                    if length != RESULT_HEADER.size + (end - start) * RESULT_DTYPE.itemsize:
+                        error = "result of {} bytes for {} pairs".format(length, end - start)
+                        break
+                    records = np.frombuffer(payload[RESULT_HEADER.size:], dtype=RESULT_DTYPE)
+                    if not np.array_equal(records['noise_idx'], noise_idxes[start:end]):
+                        error = "it drew different noise (different noise table?)"
+                        break
+                    scores_n2[start:end,0] = records['ret_pos']
+                    scores_n2[start:end,1] = records['ret_neg']
+                    steps_n2[start:end,0] = records['steps_pos']
+                    steps_n2[start:end,1] = records['steps_neg']
+                    truncated_n2[start:end,0] = records['trunc_pos']
+                    truncated_n2[start:end,1] = records['trunc_neg']
+                    num_done += end - start
+                    busy_secs += secs
+                    worker.task = None
+                if error is not None:
+                    num_requeued += worker.task is not None
+                    connected_secs += self._drop(worker, pending, reason=error)
+
+        t_end = time.time()
+        for worker in self.workers.values():
+            connected_secs += t_end - worker.since
+        self.last_stats = [
+            ("NumWorkers",        len(self.workers)),
+            ("WorkerUtilization", busy_secs / max(connected_secs, 1e-8)),
+            ("StragglerSeconds",  0.0 if t_first_idle is None else t_end - t_first_idle),
+            ("RequeuedTasks",     num_requeued),
+        ]
+        return scores_n2, steps_n2, truncated_n2
+
+    def close(self):
+        """ Disconnects the workers, which makes them exit. """
+        for sock in list(self.workers):
+            sock.close()
+        self.workers = {}
+        self.listener.close()
+
+
+def _connect(host, port, timeout):
+    """ Connects to the master, retrying with exponential backoff (up to 5
+    seconds apart) for `timeout` seconds, since workers may well be started
+    before the master has built its noise table and opened its port.
+    """
+    t_give_up = time.time() + timeout
+    delay = 0.1
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except socket.error as e:
+            if time.time() + delay > t_give_up:
+                raise
+            print("can't reach the master at {}:{} ({}), retrying in {:.1f}s".format(
+                    host, port, e, delay))
+            time.sleep(delay)
+            delay = min(2 * delay, 5.0)
+
+
+def run_worker(host, port, connect_timeout=600):
+    """ Connects to the master and evaluates its tasks until it disconnects.
+    Gives up if the master can't be reached for `connect_timeout` seconds.
+    """
+    import utils
+    from es import ESAgent
+    sock = _connect(host, port, connect_timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    msg_type, payload = _recv(sock)
+    assert msg_type == MSG_CONFIG
+    args = argparse.Namespace(**json.loads(payload.decode('utf-8')))
+    args.verbose = False
+    args.render = False
+    noise = utils.SharedNoiseTable(args.noise_table_size, seed=args.seed)
+    agent = ESAgent(utils.get_cpu_session(), args, noise=noise)
+    print("connected to the master at {}:{}".format(host, port))
+
+    iteration, weights, noise_idxes = None, None, None
+    while True:
+        try:
+            msg_type, payload = _recv(sock)
+        except (EOFError, socket.error):
+            print("the master disconnected")
+            break
+        if msg_type == MSG_WEIGHTS:
+            iteration, noise_seed = WEIGHTS_HEADER.unpack(payload[:WEIGHTS_HEADER.size])
+            weights = np.frombuffer(payload[WEIGHTS_HEADER.size:], dtype=np.float32)
+            noise_idxes = noise.sample_index(agent.num_ws, args.npop//2, seed=noise_seed)
+        elif msg_type == MSG_TASK:
+            itr, start, end, max_steps = TASK.unpack(payload)
+            assert itr == iteration, "Error: task for weights this worker doesn't have."
+            t_start = time.time()
+            scores_n2, steps_n2, truncated_n2 = agent._evaluate_pairs(
+                    weights, noise_idxes[start:end], max_steps if max_steps > 0 else None)
+            records = np.zeros(end - start, dtype=RESULT_DTYPE)
+            records['noise_idx'] = noise_idxes[start:end]
+            records['ret_pos'] = scores_n2[:,0]
+            records['ret_neg'] = scores_n2[:,1]
+            records['steps_pos'] = steps_n2[:,0]
+            records['steps_neg'] = steps_n2[:,1]
+            records['trunc_pos'] = truncated_n2[:,0]
+            records['trunc_neg'] = truncated_n2[:,1]
+            _send(sock, MSG_RESULT,
+                  RESULT_HEADER.pack(itr, time.time() - t_start) + records.tobytes())
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost',
+            help='Host name or address of the master.')
+    parser.add_argument('--port', type=int, default=5555,
+            help='The `--master_port` of the master.')
+    parser.add_argument('--connect_timeout', type=float, default=600,
+            help='Seconds to keep retrying to reach the master.')
+    args = parser.parse_args()
+    run_worker(args.host, args.port, args.connect_timeout)
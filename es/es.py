@@ -1,12 +1,15 @@
 """
 This is Natural Evolution Strategies, designed to run on one computer and not a
-cluster.
+cluster. With `--num_workers`, the population is evaluated by a pool of worker
+processes on that computer, each with its own env and policy network.
 
 (c) May 2017 by Daniel Seita, though obviously based on OpenAI's work/idea.
 """
 
+import argparse
 import gym
 import logz
+import multiprocessing
 import numpy as np
 import os
 import pickle
@@ -20,9 +23,41 @@ from gym import wrappers
 np.set_printoptions(edgeitems=100, linewidth=100, suppress=True, precision=5)
 
 
+# The policy of a worker process, built by `_init_worker`.
+_worker_agent = None
+
+
+def _init_worker(args, noise):
+    """ Builds this worker's env and policy, in its own single-threaded CPU
+    session. Initial weights don't matter, they are overwritten every task.
+    """
+    global _worker_agent
+    worker_args = argparse.Namespace(**vars(args))
+    worker_args.verbose = False
+    worker_args.render = False
+    _worker_agent = ESAgent(utils.get_cpu_session(), worker_args, noise=noise)
+
+
+def _evaluate_in_worker(task):
+    weights, noise_idxes, max_steps = task
+    return _worker_agent._evaluate_pairs(weights, noise_idxes, max_steps)
+
+
+def make_worker_pool(args, noise):
+    """ Starts `args.num_workers` worker processes for `ESAgent.run_es`, all
+    reading the shared noise table `noise` (a utils.SharedNoiseTable).
+
+    Call this *before* making the TensorFlow session of the main process,
+    since a process must not fork once TensorFlow has a session.
+    """
+    return multiprocessing.Pool(processes=args.num_workers,
+                                initializer=_init_worker, initargs=(args, noise))
+
+
 class ESAgent:
 
-    def __init__(self, session, args, log_dir=None, continuous=True):
+    def __init__(self, session, args, log_dir=None, continuous=True, pool=None,
+                 noise=None, master=None):
         """ An Evolution Strategies agent.
 
         It uses the same network architecture from OpenAI's paper, and I think
@@ -36,12 +71,21 @@ class ESAgent:
             log_dir: The log directory for the logging, if any.
             continuous: Whether the agent acts in a continuous or discrete
                 action space. (Right now only continuous is supported.)
+            pool: A worker pool from `make_worker_pool` to evaluate the
+                population with, or None to evaluate it in this process.
+            noise: The utils.SharedNoiseTable perturbations are taken from.
+                Only needed for `run_es`.
+            master: A distributed.Master whose remote workers evaluate the
+                population instead, or None.
         """
         assert continuous == True, "Error: only continuous==True is supported."
         tf.set_random_seed(args.seed)
         self.sess = session
         self.args = args
         self.log_dir = log_dir
+        self.pool = pool
+        self.noise = noise
+        self.master = master
         self.env = gym.make(args.envname)
         ob_dim = self.env.observation_space.shape[0]
         ac_dim = self.env.action_space.shape[0]
@@ -69,6 +113,12 @@ class ESAgent:
             start += size
         self.set_params_op = tf.group(*updates)
 
+        # The whole population at once, see `_evaluate_pairs_batched`.
+        self.batch_population = getattr(args, 'batch_population', False)
+        if self.batch_population:
+            self.pop_envs = []
+            self._make_population_network(ob_dim)
+
         if args.verbose:
             self._print_summary()
         self.sess.run(tf.global_variables_initializer())
@@ -98,7 +148,48 @@ class ESAgent:
             return out
 
 
-    def _compute_return(self, test=False, store_info=False):
+    def _make_population_network(self, ob_dim):
+        """ The policy network for `npop` weight vectors at once.
+
+        Each weight and bias is stacked over the population in a variable of
+        shape (npop,)+shape, which `self.set_pop_params_op` fills from the
+        (npop,numw) feed `self.pop_weights_pw`, once per iteration. Each step,
+        `self.pop_sampled_ac` maps the observations `self.pop_ob_no` of the
+        members in `self.pop_idx` to their actions, with one batched matmul
+        per layer.
+        """
+        npop = self.args.npop
+        self.pop_weights_pw = tf.placeholder(tf.float32, shape=[npop, self.num_ws])
+        self.pop_idx = tf.placeholder(tf.int32, shape=[None])
+        self.pop_ob_no = tf.placeholder(tf.float32, shape=[None, ob_dim])
+        updates = []
+        pop_ws = []
+        start = 0
+        with tf.variable_scope("ESPopulation"):
+            for (i,shape) in enumerate(self.shapes):
+                size = np.prod(shape)
+                w = tf.get_variable("w{}".format(i), shape=[npop]+shape, trainable=False,
+                                    initializer=tf.zeros_initializer())
+                updates.append(
+                        tf.assign(w, tf.reshape(self.pop_weights_pw[:,start:start+size], [npop]+shape))
+                )
+                pop_ws.append(tf.gather(w, self.pop_idx))
+                start += size
+        self.set_pop_params_op = tf.group(*updates)
+
+        # Same layers as `_make_network`: (weights, biases) pairs, tanh except
+        # for the last one. The observations become (n,1,ob_dim) row vectors.
+        out = tf.expand_dims(self.pop_ob_no, 1)
+        for i in range(0, len(pop_ws), 2):
+            assert len(self.shapes[i]) == 2 and len(self.shapes[i+1]) == 1
+            out = tf.matmul(out, pop_ws[i]) + tf.expand_dims(pop_ws[i+1], 1)
+            if i+2 < len(pop_ws):
+                out = tf.nn.tanh(out)
+        self.pop_sampled_ac = out[:,0,:]
+
+
+    def _compute_return(self, test=False, store_info=False, return_steps=False,
+                        max_steps=None):
         """ Runs the current neural network policy. 
 
         For now, we assume we run **one** episode. Also, we expand the
@@ -111,11 +202,16 @@ class ESAgent:
                 done as a result fo the `test` method.
             store_info: True if storing info is desired, meaning that we return
                 observations and actions.
+            return_steps: True to also return the episode length, and whether
+                the episode was cut off at `max_steps` rather than ending on
+                its own (ignored if `store_info` is True).
+            max_steps: Cut the episode off after this many steps, if that is
+                sooner than the env's time step limit.
 
         Returns:
             The scalar return to be evaluated by the ES agent.
         """
-        max_steps = self.env.spec.timestep_limit
+        max_steps = self._episode_limit(max_steps)
         obs = self.env.reset()
         done = False
         steps = 0
@@ -140,10 +236,115 @@ class ESAgent:
 
         if store_info:
             return total_rew, observations, actions
+        elif return_steps:
+            return total_rew, steps, (not done)
         else:
             return total_rew
 
 
+    def _episode_limit(self, max_steps=None):
+        limit = self.env.spec.timestep_limit
+        return limit if max_steps is None else min(max_steps, limit)
+
+
+    def _evaluate_pairs(self, weights, noise_idxes, max_steps=None):
+        """ Mirrored sampling around `weights`, one pair per noise index.
+
+        Returns three arrays of shape (len(noise_idxes),2), with the returns,
+        the episode lengths and whether the episodes were cut off of the +eps_j
+        and -eps_j perturbations. Episodes are cut off after `max_steps` steps,
+        if given; one that ends on its own on that very step is not counted as
+        cut off. Worker processes call this too.
+        """
+        if self.batch_population:
+            return self._evaluate_pairs_batched(weights, noise_idxes, max_steps)
+        scores_n2 = []
+        steps_n2 = []
+        truncated_n2 = []
+        for idx in noise_idxes:
+            eps = self.noise.get(idx, self.num_ws)
+            self.sess.run(self.set_params_op,
+                          feed_dict={self.new_weights_v: weights + self.args.sigma * eps})
+            rews_pos, steps_pos, trunc_pos = self._compute_return(return_steps=True,
+                                                                  max_steps=max_steps)
+            self.sess.run(self.set_params_op,
+                          feed_dict={self.new_weights_v: weights - self.args.sigma * eps})
+            rews_neg, steps_neg, trunc_neg = self._compute_return(return_steps=True,
+                                                                  max_steps=max_steps)
+            scores_n2.append([rews_pos,rews_neg])
+            steps_n2.append([steps_pos,steps_neg])
+            truncated_n2.append([trunc_pos,trunc_neg])
+        return (np.array(scores_n2).reshape((len(noise_idxes),2)),
+                np.array(steps_n2, dtype=np.int64).reshape((len(noise_idxes),2)),
+                np.array(truncated_n2, dtype=bool).reshape((len(noise_idxes),2)))
+
+
+    def _evaluate_pairs_batched(self, weights, noise_idxes, max_steps=None):
+        """ `_evaluate_pairs` with every member's episode run in lockstep.
+
+        Member 2j is +eps_j and member 2j+1 is -eps_j, each with its own copy
+        of the env (made when first needed). Each time step, one session call
+        computes the actions of all members whose episodes are still going,
+        so there is one weight assignment per call instead of one per member,
+        and one forward pass per time step instead of one per member and step.
+        """
+        num = 2 * len(noise_idxes)
+        while len(self.pop_envs) < num:
+            self.pop_envs.append(gym.make(self.args.envname))
+        envs = self.pop_envs[:num]
+
+        pop_weights = np.zeros((self.args.npop, self.num_ws), dtype=np.float32)
+        for (j,idx) in enumerate(noise_idxes):
+            eps = self.noise.get(idx, self.num_ws)
+            pop_weights[2*j]   = weights + self.args.sigma * eps
+            pop_weights[2*j+1] = weights - self.args.sigma * eps
+        self.sess.run(self.set_pop_params_op, feed_dict={self.pop_weights_pw: pop_weights})
+
+        max_steps = self._episode_limit(max_steps)
+        obs = np.array([env.reset() for env in envs])
+        returns = np.zeros(num)
+        lengths = np.zeros(num, dtype=np.int64)
+        active = np.ones(num, dtype=bool)
+        steps = 0
+        while active.any() and steps < max_steps:
+            idxes = np.flatnonzero(active)
+            actions = self.sess.run(self.pop_sampled_ac,
+                                    feed_dict={self.pop_ob_no: obs[idxes], self.pop_idx: idxes})
+            for (i,action) in zip(idxes, actions):
+                obs[i], r, done, _ = envs[i].step(action)
+                returns[i] += r
+                lengths[i] += 1
+                if done:
+                    active[i] = False
+            steps += 1
+        # Members still going reached `max_steps` without their env being done.
+        return (returns.reshape((len(noise_idxes),2)),
+                lengths.reshape((len(noise_idxes),2)),
+                active.reshape((len(noise_idxes),2)))
+
+
+    def _evaluate_population(self, iteration, weights, noise_seed, noise_idxes,
+                             max_steps=None):
+        """ Like `_evaluate_pairs`, but split across the worker pool or the
+        remote workers of the master, if any.
+
+        Pool workers only receive the weights and their noise indices. Each
+        gets a few chunks of pairs rather than one, so that workers which
+        finish early (e.g. with shorter episodes) pick up the remaining
+        chunks. Remote workers work out the indices from `noise_seed`.
+        """
+        if self.master is not None:
+            return self.master.evaluate(iteration, weights, noise_seed, noise_idxes,
+                                        max_steps)
+        if self.pool is None:
+            return self._evaluate_pairs(weights, noise_idxes, max_steps)
+        num_chunks = min(len(noise_idxes), 4 * self.args.num_workers)
+        tasks = [(weights, chunk, max_steps)
+                 for chunk in np.array_split(noise_idxes, num_chunks)]
+        results = self.pool.map(_evaluate_in_worker, tasks, chunksize=1)
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
     def _print_summary(self):
         """ Just for debugging assistance. """
         print("\nES Agent NN weight shapes:\n{}".format(self.shapes))
@@ -163,9 +364,16 @@ class ESAgent:
         Tricks used:
             - Antithetic (i.e. mirrored) sampling.
             - Rank transformation, using OpenAI's code.
+            - Parallel evaluation of the population with `--num_workers`.
+              Perturbations are identified by indices into a fixed block of
+              Gaussian noise shared by all processes, so only those and the
+              current weights are sent to the workers.
+            - Remote workers over TCP, see `distributed.py`.
+            - With `--adaptive_truncation`, capping the perturbed episodes at
+              `--truncation_factor` times the mean episode length of the last
+              iteration, like OpenAI. The test roll-outs are never capped.
 
         Tricks avoided:
-            - Fixed Gaussian block. I like to just regenerate here.
             - Virtual batch normalization, seems to be only for Atari games.
             - Weight decay. Not sure how to do this.
             - Action discretization. For now, it adds extra complexity.
@@ -174,6 +382,8 @@ class ESAgent:
         """
         args = self.args
         t_start = time.time()
+        truncation = getattr(args, 'adaptive_truncation', False)
+        max_steps = None
 
         for i in range(args.es_iters):
             if (i % args.log_every_t_iter == 0):
@@ -181,35 +391,38 @@ class ESAgent:
             stats = defaultdict(list)
 
             # Set stuff up for perturbing weights and determining fitness.
+            t_iter = time.time()
             weights_old = self.sess.run(self.weights_v) # Shape (numw,)
-            eps_nw = np.random.randn(args.npop/2, self.num_ws)
-            scores_n2 = []
-
-            for j in range(args.npop/2):
-                # Mirrored sampling, positive case, +eps_j.
-                weights_new_pos = weights_old + args.sigma * eps_nw[j]
-                self.sess.run(self.set_params_op, 
-                              feed_dict={self.new_weights_v: weights_new_pos})
-                rews_pos = self._compute_return()
-
-                # Mirrored sampling, negative case, -eps_j.
-                weights_new_neg = weights_old - args.sigma * eps_nw[j]
-                self.sess.run(self.set_params_op, 
-                              feed_dict={self.new_weights_v: weights_new_neg})
-                rews_neg = self._compute_return()
-
-                scores_n2.append([rews_pos,rews_neg])
+            noise_seed = np.random.randint(2**31-1)
+            noise_idxes = self.noise.sample_index(self.num_ws, args.npop//2, seed=noise_seed)
+            scores_n2, steps_n2, truncated_n2 = self._evaluate_population(
+                    i, weights_old, noise_seed, noise_idxes, max_steps)
+            rollout_secs = time.time() - t_iter
+
+            # Episodes still going at the cap were cut off. The cap is the
+            # same for every member, so the ranks still compare like with
+            # like: returns over the first `max_steps` steps. At the env's own
+            # time limit nothing is skipped.
+            cap = self._episode_limit(max_steps)
+            if cap >= self.env.spec.timestep_limit:
+                truncated_n2 = np.zeros(steps_n2.shape, dtype=bool)
+            # At most this many steps were skipped, at the rate of this iteration.
+            skipped_steps = np.sum(truncated_n2) * (self.env.spec.timestep_limit - cap)
+            saved_secs = skipped_steps * rollout_secs / max(np.sum(steps_n2), 1)
+            if truncation:
+                max_steps = max(int(args.truncation_factor * np.mean(steps_n2)), 1)
 
             # Determine the new weights based on OpenAI's rank updating.
-            proc_returns_n2 = utils.compute_centered_ranks(np.array(scores_n2))
+            proc_returns_n2 = utils.compute_centered_ranks(scores_n2)
             F_n = proc_returns_n2[:,0] - proc_returns_n2[:,1]
-            grad = np.dot(eps_nw.T, F_n)
+            grad = self.noise.weighted_sum(noise_idxes, F_n, self.num_ws)
 
             # Apply the gradient update. TODO: Change this to ADAM.
             alpha = (args.lrate_es / (args.sigma*args.npop))
             next_weights = weights_old + alpha * grad
             self.sess.run(self.set_params_op, 
                           feed_dict={self.new_weights_v: next_weights})
+            iter_secs = time.time() - t_iter
             
             # Report relevant logs.
             if (i % args.log_every_t_iter == 0):
@@ -228,6 +441,15 @@ class ESAgent:
                 logz.log_tabular("ScoresStd",        np.std(scores_n2))
                 logz.log_tabular("ScoresMax",        np.max(scores_n2))
                 logz.log_tabular("ScoresMin",        np.min(scores_n2))
+                logz.log_tabular("IterSeconds",      iter_secs)
+                logz.log_tabular("RolloutSeconds",   rollout_secs)
+                logz.log_tabular("StepsThisIter",    np.sum(steps_n2))
+                logz.log_tabular("EpisodeCap",       cap)
+                logz.log_tabular("TruncationRate",   np.mean(truncated_n2))
+                logz.log_tabular("SavedSecondsMax",  saved_secs)
+                if self.master is not None:
+                    for (key,value) in self.master.last_stats:
+                        logz.log_tabular(key, value)
                 logz.log_tabular("TotalTimeHours",   hours)
                 logz.log_tabular("TotalIterations",  i)
                 logz.dump_tabular()
@@ -10,7 +10,9 @@ import os
 import pickle
 import tensorflow as tf
 import utils
-from es import ESAgent
+from distributed import Master
+from es import ESAgent, make_worker_pool
+from utils import SharedNoiseTable
 
 
 if __name__ == "__main__":
@@ -20,6 +22,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('envname', type=str, 
             help='The OpenAI gym environment name (case sensitive).')
+    parser.add_argument('--adaptive_truncation', action='store_true',
+            help='Cap perturbed episodes at a multiple of the last mean length.')
+    parser.add_argument('--batch_population', action='store_true',
+            help='Run the population in lockstep with batched forward passes.')
     parser.add_argument('--do_not_save', action='store_true',
             help='Sets the log_dir to be None.')
     parser.add_argument('--es_iters', type=int, default=100,
@@ -28,8 +34,16 @@ if __name__ == "__main__":
             help='Controls the amount of time information is logged.')
     parser.add_argument('--lrate_es', type=float, default=0.001,
             help='Learning rate for the ES gradient update.')
+    parser.add_argument('--master_port', type=int, default=0,
+            help='Listen on this port for distributed.py workers (0 = none).')
+    parser.add_argument('--noise_table_size', type=int, default=25000000,
+            help='Entries of the shared float32 Gaussian noise table.')
     parser.add_argument('--npop', type=int, default=200, 
             help='Weight vectors to sample for ES (INCLUDING the mirroring')
+    parser.add_argument('--num_workers', type=int, default=0,
+            help='Worker processes evaluating the population (0 = none).')
+    parser.add_argument('--pairs_per_task', type=int, default=4,
+            help='Mirrored pairs per task sent to a distributed.py worker.')
     parser.add_argument('--render', action='store_true',
             help='Use `--render` to visualize trajectories each iteration.')
     parser.add_argument('--seed', type=int, default=0,
@@ -40,11 +54,23 @@ if __name__ == "__main__":
             help='Save the model every t iterations so we can inspect later.')
     parser.add_argument('--test_trajs', type=int, default=10, 
             help='Number of evaluation trajectories after each iteration.')
+    parser.add_argument('--truncation_factor', type=float, default=2.0,
+            help='The multiple used by `--adaptive_truncation`.')
     parser.add_argument('--verbose', action='store_true',
             help='Use `--verbose` for a few additional debugging messages.')
     args = parser.parse_args()
     assert args.npop % 2 == 0 # Just to be consistent with my other code.
 
+    # The noise table and workers must be made before this process makes its
+    # session, since the workers are forked.
+    noise = SharedNoiseTable(args.noise_table_size, seed=args.seed)
+    pool = None
+    if args.num_workers > 0:
+        pool = make_worker_pool(args, noise)
+    master = None
+    if args.master_port > 0:
+        master = Master(args, args.master_port, pairs_per_task=args.pairs_per_task)
+
     # Make the TensorFlow session and do some logic with handling arguments.
     session = utils.get_tf_session()
     log_dir = None
@@ -56,5 +82,10 @@ if __name__ == "__main__":
             pickle.dump(args, f)
 
     # Build and run evolution strategies.
-    es_agent = ESAgent(session, args, log_dir)
+    es_agent = ESAgent(session, args, log_dir, pool=pool, noise=noise, master=master)
     es_agent.run_es()
+    if master is not None:
+        master.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
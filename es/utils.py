@@ -4,6 +4,8 @@ Random supporting methods.
 (c) May 2017 by Daniel Seita
 """
 
+import ctypes
+import multiprocessing
 import numpy as np
 import sys
 import tensorflow as tf
@@ -50,6 +52,12 @@ def compute_centered_ranks(x):
 
     Finally, they *further* divide that vector by (n*2) before feeding it to the
     update. That should represent the (1/npop) which I've been doing.
+
+    With adaptive truncation, some returns in x are of episodes that were cut
+    off. That's fine as long as every entry had the same cap, which is how
+    `ESAgent.run_es` does it: the ranks then order the returns of the first
+    `cap` steps, i.e. of a slightly shorter-horizon task. Don't mix returns
+    evaluated with different caps in one call.
     """
     y = compute_ranks(x.ravel()).reshape(x.shape).astype(np.float32)
     y /= (x.size - 1)
@@ -57,6 +65,50 @@ def compute_centered_ranks(x):
     return y
 
 
+class SharedNoiseTable(object):
+
+    def __init__(self, size, seed=0, chunk=1000000):
+        """ OpenAI's fixed block of Gaussian noise, as float32 in shared memory.
+
+        Made once before the worker processes are forked, so they all read the
+        same table without copying it. A perturbation of a weight vector with
+        `num_ws` entries is identified by its offset `idx` into the table, and
+        is `table[idx:idx+num_ws]`. The table is filled `chunk` entries at a
+        time, so it never exists in float64.
+        """
+        self.noise = np.frombuffer(multiprocessing.RawArray(ctypes.c_float, int(size)),
+                                   dtype=np.float32)
+        rng = np.random.RandomState(seed)
+        for start in range(0, size, chunk):
+            end = min(start + chunk, size)
+            self.noise[start:end] = rng.randn(end - start)
+
+    def get(self, idx, num_ws):
+        return self.noise[idx:idx+num_ws]
+
+    def sample_index(self, num_ws, num, seed=None):
+        """ Offsets of `num` perturbations with `num_ws` entries each. With a
+        `seed`, the same offsets come out in every process.
+        """
+        assert num_ws <= len(self.noise), "Error: noise table smaller than the weights."
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        return rng.randint(0, len(self.noise) - num_ws + 1, size=num)
+
+    def weighted_sum(self, idxes, weights, num_ws, batch_size=500):
+        """ Returns sum_j weights[j] * table[idxes[j]:idxes[j]+num_ws].
+
+        This is the ES gradient (OpenAI's `batched_weighted_sum`), with at
+        most `batch_size` perturbations in memory at once.
+        """
+        total = np.zeros(num_ws, dtype=np.float32)
+        for start in range(0, len(idxes), batch_size):
+            batch_idxes = idxes[start:start+batch_size]
+            batch_eps = np.stack([self.get(idx, num_ws) for idx in batch_idxes])
+            total += np.dot(np.asarray(weights[start:start+batch_size], dtype=np.float32),
+                            batch_eps)
+        return total
+
+
 def get_tf_session():
     """ Returning a session. Set options here (e.g. for GPUs) if desired. """
     tf.reset_default_graph()
@@ -74,6 +126,18 @@ def get_tf_session():
     return session
 
 
+def get_cpu_session():
+    """ A single-threaded CPU session, for the ES worker processes. Running
+    one tiny network per process is faster than sharing the cores (or a GPU)
+    between many processes.
+    """
+    tf.reset_default_graph()
+    tf_config = tf.ConfigProto(device_count={'GPU': 0},
+                               inter_op_parallelism_threads=1,
+                               intra_op_parallelism_threads=1)
+    return tf.Session(config=tf_config)
+
+
 def normc_initializer(std=1.0):
     """ Initialize array with normalized columns """
     def _initializer(shape, dtype=None, partition_info=None): #pylint: disable=W0613